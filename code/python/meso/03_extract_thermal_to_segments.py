@@ -4,6 +4,8 @@
 segment_thermal.py
 Extrae variables térmicas desde TIFF hacia segmentos (líneas o buffers),
 crea métricas (mean/max) y la categoría 'peligro_cat', y guarda salida en GPKG y CSV.
+Si existe el cubo multianual (preprocessing/02_build_thermal_cube.py) agrega
+además la media anual por segmento (`Ta_2014`, …, `UHI_2024`) leída del Zarr.
 
 Requiere:
   conda install -c conda-forge geopandas rasterio rasterstats shapely pyproj rtree
@@ -12,16 +14,35 @@ o
 """
 
 from pathlib import Path
+import importlib.util
+import math
 import warnings
+import numpy as np
 import geopandas as gpd
 import pandas as pd
+from affine import Affine
 from rasterio import open as rio_open
+from rasterio.features import geometry_mask
 from rasterstats import zonal_stats
 
 # ================== CONFIGURA TUS RUTAS ========================
 DIR_STREETS = Path("/Users/danielaresendiz/Library/CloudStorage/OneDrive-UniversityCollegeLondon(2)/Dissertation/01_data/street_network")
 DIR_RASTERS = Path("/Users/danielaresendiz/Library/CloudStorage/OneDrive-UniversityCollegeLondon(2)/Dissertation/01_data/Heat")
 
+# COG (preprocessing/03_convert_climatology_cog.py): teselados + nodata unificado →
+# cada lote solo lee las teselas que toca. Se eligen ráster por ráster: si un
+# COG falta (conversión parcial) se lee el GeoTIFF original.
+DIR_COG = DIR_RASTERS / "cog"
+
+def clim_path(name: str) -> Path:
+    """COG si existe, si no el GeoTIFF original."""
+    cog = DIR_COG / name
+    return cog if cog.exists() else DIR_RASTERS / name
+
+# Cubo multianual (preprocessing/02_build_thermal_cube.py): si existe, cada lote de
+# segmentos lee solo los chunks de su bbox (todos los años vienen en el mismo chunk)
+CUBE_PATH = DIR_RASTERS / "thermal_cube.zarr"
+
 # Busca un shapefile de segmentos (ajusta el patrón si el nombre es otro)
 CANDIDATOS = list(DIR_STREETS.glob("**/*segment*analysis*.shp")) or list(DIR_STREETS.glob("**/*segment*.shp"))
 if not CANDIDATOS:
@@ -33,14 +54,17 @@ OUT_CSV  = SEGMENT_SHP.with_name("segmentos_con_termico.csv")
 
 # Ráster a extraer: archivo → estadísticas → nombres finales
 SPECS = [
-    {"path": DIR_RASTERS / "Albedo_clim.tif",   "stats": ["mean"],       "rename": {"mean": "Albedo_mean"}},
-    {"path": DIR_RASTERS / "LST_day_clim.tif",  "stats": ["mean"],       "rename": {"mean": "LST_mean"}},
-    {"path": DIR_RASTERS / "NDVI_clim.tif",     "stats": ["mean"],       "rename": {"mean": "NDVI_mean"}},
-    {"path": DIR_RASTERS / "NDBI_clim.tif",     "stats": ["mean"],       "rename": {"mean": "NDBI_mean"}},
-    {"path": DIR_RASTERS / "UHI_air_clim.tif",  "stats": ["mean","max"], "rename": {"mean": "UHI_mean", "max": "UHI_max"}},
-    {"path": DIR_RASTERS / "Ta_clim.tif",       "stats": ["mean","max"], "rename": {"mean": "Ta_mean",  "max": "Ta_max"}},
+    {"path": clim_path("Albedo_clim.tif"),  "stats": ["mean"],       "rename": {"mean": "Albedo_mean"}},
+    {"path": clim_path("LST_day_clim.tif"), "stats": ["mean"],       "rename": {"mean": "LST_mean"}},
+    {"path": clim_path("NDVI_clim.tif"),    "stats": ["mean"],       "rename": {"mean": "NDVI_mean"}},
+    {"path": clim_path("NDBI_clim.tif"),    "stats": ["mean"],       "rename": {"mean": "NDBI_mean"}},
+    {"path": clim_path("UHI_air_clim.tif"), "stats": ["mean","max"], "rename": {"mean": "UHI_mean", "max": "UHI_max"}},
+    {"path": clim_path("Ta_clim.tif"),      "stats": ["mean","max"], "rename": {"mean": "Ta_mean",  "max": "Ta_max"}},
 ]
 
+# Variables del cubo → prefijo de columna (una columna por año: Ta_2014, …)
+CUBE_VARS = {"Ta": "Ta", "LST": "LST", "UHI_air": "UHI"}
+
 # ================== PARÁMETROS ================================
 BUFFER_M   = 10.0   # metros para líneas; pon 0 si ya son buffers (polígonos)
 CHUNK_SIZE = 1000   # procesa por lotes para no atascarse
@@ -51,6 +75,24 @@ def son_lineas(gdf: gpd.GeoDataFrame) -> bool:
     tipos = set(gdf.geometry.geom_type.unique())
     return tipos.issubset({"LineString", "MultiLineString"})
 
+def geoms_muestreo(gdf_in: gpd.GeoDataFrame, r_crs, buffer_m=0.0) -> gpd.GeoSeries:
+    """Geometrías a muestrear en el CRS del ráster: si son líneas y se pide buffer, se hace en CRS MÉTRICO (UTM)."""
+    geoms = gdf_in.geometry.to_crs(r_crs)
+    if son_lineas(gdf_in) and buffer_m and buffer_m > 0:
+        try:
+            metric_crs = gdf_in.estimate_utm_crs()  # UTM local
+        except Exception:
+            metric_crs = "EPSG:3857"  # respaldo métrico
+        if VERBOSE:
+            print(f"   · bufferizando {buffer_m} m en {metric_crs}…")
+        gdf_metric = gdf_in.to_crs(metric_crs)
+        # Evita warning de buffer en CRS geográfico
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            buffers = gdf_metric.geometry.buffer(buffer_m, cap_style=2)
+        geoms = gpd.GeoSeries(buffers, crs=metric_crs).to_crs(r_crs)
+    return geoms
+
 def extraer_stats(gdf_in: gpd.GeoDataFrame, raster_path: Path, stats, rename_map, buffer_m=0.0) -> gpd.GeoDataFrame:
     """Extrae stats desde un ráster hacia las geometrías, con buffer en CRS métrico y procesamiento por lotes."""
     if not raster_path.exists():
@@ -66,22 +108,7 @@ def extraer_stats(gdf_in: gpd.GeoDataFrame, raster_path: Path, stats, rename_map
 
     # Geometrías en CRS del ráster (lo que pide rasterstats)
     gdf_raster = gdf_in.to_crs(r_crs).copy()
-
-    # Preparar geometrías a muestrear: si son líneas y se pide buffer, hazlo en CRS MÉTRICO (UTM) y regresa al CRS del ráster
-    geoms = gdf_raster.geometry
-    if son_lineas(gdf_in) and buffer_m and buffer_m > 0:
-        try:
-            metric_crs = gdf_in.estimate_utm_crs()  # UTM local
-        except Exception:
-            metric_crs = "EPSG:3857"  # respaldo métrico
-        if VERBOSE:
-            print(f"   · bufferizando {buffer_m} m en {metric_crs}…")
-        gdf_metric = gdf_in.to_crs(metric_crs)
-        # Evita warning de buffer en CRS geográfico
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            buffers = gdf_metric.geometry.buffer(buffer_m, cap_style=2)
-        geoms = gpd.GeoSeries(buffers, crs=metric_crs).to_crs(r_crs)
+    geoms = geoms_muestreo(gdf_in, r_crs, buffer_m)
 
     # Inicializa columnas de salida
     cols_finales = {s: rename_map.get(s, f"{raster_path.stem}_{s}") for s in stats}
@@ -112,6 +139,103 @@ def extraer_stats(gdf_in: gpd.GeoDataFrame, raster_path: Path, stats, rename_map
 
     return gdf_raster.to_crs(gdf_in.crs)
 
+def _api_cubo():
+    """Funciones de lectura del cubo (open_cube, read_window, window_transform) de preprocessing/02."""
+    ruta = Path(__file__).resolve().parents[1] / "preprocessing" / "02_build_thermal_cube.py"
+    spec = importlib.util.spec_from_file_location("build_thermal_cube", ruta)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+def pixeles_por_geometria(geoms, affine, shape):
+    """
+    Rasteriza cada geometría UNA vez sobre la ventana del lote (centro de píxel,
+    como zonal_stats con all_touched=False). Devuelve (índice plano del píxel,
+    posición de la geometría) para todos los pares píxel-geometría; las
+    geometrías que se solapan (cruces de calles) conservan cada una sus píxeles.
+    """
+    H, W = shape
+    pix, lab = [], []
+    for k, geom in enumerate(geoms):
+        if geom is None or geom.is_empty:
+            continue
+        xmin, ymin, xmax, ymax = geom.bounds
+        c0 = max(int(math.floor((xmin - affine.c) / affine.a)), 0)
+        c1 = min(int(math.ceil((xmax - affine.c) / affine.a)), W)
+        r0 = max(int(math.floor((ymax - affine.f) / affine.e)), 0)
+        r1 = min(int(math.ceil((ymin - affine.f) / affine.e)), H)
+        if r0 >= r1 or c0 >= c1:
+            continue
+        m = geometry_mask([geom], out_shape=(r1 - r0, c1 - c0), invert=True, all_touched=False,
+                          transform=affine * Affine.translation(c0, r0))
+        rr, cc = np.nonzero(m)
+        pix.append((rr + r0) * W + (cc + c0))
+        lab.append(np.full(rr.size, k))
+    if not pix:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    return np.concatenate(pix), np.concatenate(lab)
+
+def extraer_cubo(gdf_in: gpd.GeoDataFrame, cube_path: Path, var_prefix: dict, buffer_m=0.0) -> gpd.GeoDataFrame:
+    """
+    Media anual por segmento desde el cubo Zarr (time, variable, y, x). Por lote se
+    lee con read_window() la ventana que cubre su bbox (solo los chunks que toca),
+    se rasteriza cada geometría una sola vez y todas las capas (año, variable) se
+    reducen juntas con np.bincount (NaN = sin dato).
+    """
+    api = _api_cubo()
+    cube = api.open_cube(cube_path)
+    years = list(cube.attrs["years"])
+    all_vars = list(cube.attrs["variables"])
+    faltan = [v for v in var_prefix if v not in all_vars]
+    if faltan:
+        print(f"⚠️ Variables sin capa en el cubo → salto: {faltan}")
+    variables = [v for v in var_prefix if v in all_vars]
+    crs = cube.attrs.get("crs")
+    if crs is None:
+        raise ValueError(f"El cubo {cube_path.name} no tiene CRS. Reconstrúyelo desde GeoTIFF con CRS.")
+    geografico = crs.upper() in ("EPSG:4326", "OGC:CRS84")
+    res = abs(cube.attrs["transform"][0])
+
+    geoms = geoms_muestreo(gdf_in, crs, buffer_m)
+
+    out = gdf_in.copy()
+    for v in variables:
+        for yr in years:
+            out[f"{var_prefix[v]}_{yr}"] = np.nan
+    cols = [f"{var_prefix[v]}_{yr}" for yr in years for v in variables]   # orden de las capas (año, variable)
+
+    n = len(out)
+    if VERBOSE:
+        print(f"   · medias anuales {[var_prefix[v] for v in variables]} × {len(years)} años en {n} segmentos (chunks de {CHUNK_SIZE})")
+    for i in range(0, n, CHUNK_SIZE):
+        j = min(i + CHUNK_SIZE, n)
+        if VERBOSE:
+            print(f"     [{i:>6}-{j:>6})", end="\r")
+        g = geoms.iloc[i:j]
+        xmin, ymin, xmax, ymax = g.total_bounds
+        cx, cy = (xmin + xmax) / 2.0, (ymin + ymax) / 2.0
+        lado = max(xmax - xmin, ymax - ymin) + 2 * res          # un píxel de holgura por lado
+        if geografico:
+            lado *= 111_320.0   # read_window pide metros; cubre también el eje x (cos ≤ 1)
+        block, _, _ = api.read_window(cx, cy, lado, variables=variables, cube=cube)
+        if block.size == 0:
+            continue
+        affine = api.window_transform(cx, cy, lado, cube=cube)
+
+        pix, lab = pixeles_por_geometria(g.to_numpy(), affine, block.shape[-2:])
+        planos = block.reshape(-1, block.shape[-2] * block.shape[-1])[:, pix]   # (año×variable, pares)
+        ok = np.isfinite(planos)
+        k = len(g)
+        ids = (np.arange(planos.shape[0])[:, None] * k + lab[None, :]).ravel()
+        suma = np.bincount(ids, weights=np.where(ok, planos, 0.0).ravel(), minlength=planos.shape[0] * k)
+        cnt = np.bincount(ids, weights=ok.ravel(), minlength=planos.shape[0] * k)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            media = np.where(cnt > 0, suma / cnt, np.nan).reshape(planos.shape[0], k)
+        out.loc[out.index[i:j], cols] = media.T
+    if VERBOSE:
+        print("")
+    return out
+
 def clasificar_peligro(ta):
     """Devuelve 1 si 26 ≤ Ta_mean < 28; 2 si Ta_mean ≥ 28; 0 en otros casos o NaN."""
     if pd.isna(ta):
@@ -138,11 +262,24 @@ def main():
 
     out = gdf.copy()
 
+    # Conversión COG parcial: avisar qué rásters se leen aún del GeoTIFF original
+    if DIR_COG.is_dir():
+        sin_cog = [spec["path"].name for spec in SPECS if spec["path"].parent != DIR_COG]
+        if sin_cog:
+            print(f"⚠️ Sin COG en {DIR_COG.name}/ (se lee el GeoTIFF original): {sin_cog}")
+
     # Extraer ráster uno por uno
     for spec in SPECS:
         print(f"→ {spec['path'].name} : {spec['stats']}")
         out = extraer_stats(out, spec["path"], spec["stats"], spec["rename"], buffer_m=BUFFER_M)
 
+    # Series anuales desde el cubo Zarr (lectura por ventana, sin reabrir los GeoTIFF anuales)
+    if CUBE_PATH.exists():
+        print(f"→ {CUBE_PATH.name} : {list(CUBE_VARS)}")
+        out = extraer_cubo(out, CUBE_PATH, CUBE_VARS, buffer_m=BUFFER_M)
+    else:
+        print(f"⚠️ Sin cubo {CUBE_PATH.name} → solo climatología (corre preprocessing/02_build_thermal_cube.py)")
+
     # Clasificación de peligro a partir de Ta_mean
     out["peligro_cat"] = out["Ta_mean"].apply(clasificar_peligro).astype(int)
 
@@ -31,9 +31,47 @@ Parámetros de tolerancia
 ------------------------
 - `EPS_G=0.02`, `EPS_F=0.10`, `EPS_L=0.5` (ajustables).
 
+Clasificación vectorizada
+-------------------------
+`classify_vectorized` evalúa las nueve cajas de `RANGES` (exactas y
+expandidas por tolerancia, en la misma llamada) contra los arreglos
+FSI/GSI/L con broadcasting y toma la primera coincidencia según
+`PRIORITY_ORDER` con `argmax`. Las funciones escalares `classify_exact` /
+`classify_with_tolerance` se conservan como referencia y se comparan contra
+una muestra (`QA_SAMPLE_N`) en cada corrida.
+
+Barrido de tolerancias (`--sweep`)
+----------------------------------
+Clasifica todas las manzanas bajo cada triple de `SWEEP_EPS_G × SWEEP_EPS_F ×
+SWEEP_EPS_L` en una sola pasada vectorizada (por lotes de filas) y escribe
+`<GPKG>_SMv2_sweep.csv`: conteos por tipología y tasa de re-clasificación de
+'Mixto' por triple. Con `--stability` añade `<GPKG>_SMv2_sweep_estabilidad.csv`
+(código modal por manzana y fracción de triples que lo asignan). En este modo
+**no** se reescribe el layer del GPKG.
+
+Tabla de consulta (`--build-lookup`)
+------------------------------------
+Compila `RANGES` / `PRIORITY_ORDER` / tolerancias en una tabla 3-D
+(GSI × FSI × L) guardada en `<GPKG>_SMv2_lookup.npz`. Los ejes no son bins
+uniformes sino celdas alineadas a los cortes de las reglas (cada límite
+`lo`, `hi`, `lo−eps`, `hi+eps` y GSI=0): una celda por valor de corte
+(límites inclusivos) y una por intervalo abierto entre cortes, más una celda
+NaN. Dentro de cada celda todas las comparaciones de las reglas dan lo mismo,
+así que la tabla es **exacta**, no una aproximación. Clasificar = tres
+`searchsorted` + un gather (`classify_lookup`). Antes de guardar se verifica
+contra la ruta por reglas en cada corte, cortes ± `nextafter` y puntos medios.
+El '0P' depende de `n_props` y se sigue aplicando aparte.
+
+Run:
+  python 04_classify_spacematrix_typology.py
+  python 04_classify_spacematrix_typology.py --sweep [--stability]
+  python 04_classify_spacematrix_typology.py --build-lookup
+
 """
 
 from pathlib import Path
+import argparse
+import itertools
 import json
 import numpy as np
 import pandas as pd
@@ -52,6 +90,20 @@ EPS_G = 0.02  # GSI ±0.02
 EPS_F = 0.10  # FSI ±0.10
 EPS_L = 0.50  # L  ±0.5
 
+QA_SAMPLE_N = 5000  # filas comparadas contra la ruta escalar de referencia
+
+# Barrido de sensibilidad (--sweep): malla de triples (EPS_G, EPS_F, EPS_L)
+SWEEP_EPS_G = (0.0, 0.01, 0.02, 0.03, 0.05)
+SWEEP_EPS_F = (0.0, 0.05, 0.10, 0.20, 0.30)
+SWEEP_EPS_L = (0.0, 0.25, 0.50, 1.00, 1.50)
+SWEEP_CHUNK = 20000  # filas por lote (memoria ~ lote × triples × 27 bytes)
+SWEEP_CSV   = GPKG.with_name(GPKG.stem + "_SMv2_sweep.csv")
+STABILITY_CSV = GPKG.with_name(GPKG.stem + "_SMv2_sweep_estabilidad.csv")
+
+# Tabla de consulta (--build-lookup)
+LOOKUP_NPZ   = GPKG.with_name(GPKG.stem + "_SMv2_lookup.npz")
+LOOKUP_CHUNK = 250000  # filas por lote en la verificación de exactitud
+
 # =========================== CATÁLOGO ========================================
 CATALOG = {
     "00": ("Sin datos", "FSI/GSI faltantes o GSI ≤ 0."),
@@ -126,133 +178,340 @@ def classify_with_tolerance(FSI, GSI, L_equiv):
             return code, True  # re-clasificado por tolerancia
     return "10", False
 
-# ========================== LECTURA ==========================================
-print("Capas disponibles:", list_layers(GPKG))
-
-gdf = gpd.read_file(GPKG, layer=LAYER_IN, engine="pyogrio")
-
-# Normalizar tipos
-for col in ["FSI", "GSI", "L_equiv", "OSR", "n_props"]:
-    if col in gdf.columns:
-        gdf[col] = pd.to_numeric(gdf[col], errors="coerce")
-
-# L_equiv si falta
-if "L_equiv" not in gdf.columns:
-    gdf["L_equiv"] = np.where((gdf["GSI"] > 0) & (~gdf["FSI"].isna()), gdf["FSI"] / gdf["GSI"], np.nan)
-
-# ======================== CLASIFICACIÓN BASE =================================
-print("Clasificando (rangos exactos)…", flush=True)
-
-gdf["typology_code_base"] = [
-    classify_exact(F, G, L) for F, G, L in gdf[["FSI", "GSI", "L_equiv"]].itertuples(index=False, name=None)
-]
-gdf["typology_name_base"] = [CATALOG.get(c, ("Desconocida", ""))[0] for c in gdf["typology_code_base"]]
-
-# ================== FLAGS: MIXTO_DQ y MIXTO_limite ===========================
-# MIXTO_DQ: FSI=0 & GSI>0 & n_props=0  → código '0P'
-print("Marcando MIXTO_DQ (FSI=0 & GSI>0 & n_props=0)…", flush=True)
-
-n_props_series = gdf["n_props"] if "n_props" in gdf.columns else pd.Series(np.nan, index=gdf.index)
-flag_mixto_dq = (
-    (gdf["typology_code_base"] == "10") &
-    (gdf["FSI"].fillna(0) == 0) &
-    (gdf["GSI"].fillna(0) > 0) &
-    (n_props_series.fillna(0).astype(float) == 0)
-)
-
-gdf["flag_mixto_dq"] = flag_mixto_dq.astype(int)
-
-# MIXTO_limite: base=10 pero cae en rangos con tolerancia → se re-clasifica
-print("Reclasificando MIXTO_limite (tolerancias)…", flush=True)
-
-reclass_codes = []
-reclass_flags = []
-for F, G, L, base in gdf[["FSI","GSI","L_equiv","typology_code_base"]].itertuples(index=False, name=None):
-    if base != "10":
-        reclass_codes.append(base)
-        reclass_flags.append(0)
-        continue
-    code2, used_tol = classify_with_tolerance(F, G, L)
-    reclass_codes.append(code2)
-    reclass_flags.append(1 if (used_tol and code2 != "10") else 0)
-
-# Si ya es MIXTO_DQ, prevalece '0P' por encima de re-clasificación por tolerancia
-reclass_codes = pd.Series(reclass_codes, index=gdf.index)
-reclass_codes.loc[flag_mixto_dq] = "0P"
-
-gdf["typology_code_final"] = reclass_codes
-
-# Nombre final
-gdf["typology_sm_final"] = [CATALOG.get(c, ("Desconocida",""))[0] for c in gdf["typology_code_final"]]
-
-# Flag explícito de MIXTO_limite aplicado
-gdf["flag_mixto_limite"] = (pd.Series(reclass_flags, index=gdf.index).astype(int))
-# Pero si terminó como '0P', no es "limite" sino DQ → set 0
-gdf.loc[gdf["typology_code_final"]=="0P", "flag_mixto_limite"] = 0
-
-# Diagnóstico básico
-gdf["diag_reason"] = ""
-gdf.loc[gdf["typology_code_final"]=="0P", "diag_reason"] = "FSI=0 & GSI>0 & n_props=0"
-gdf.loc[(gdf["typology_code_base"]=="10") & (gdf["typology_code_final"]!="0P") & (gdf["typology_code_final"]!="10"), "diag_reason"] = "Reclasificada por tolerancia"
-
-# ======================== RESUMEN / QA =======================================
-print("Generando resumen de QA…", flush=True)
-
-def _count(s, val):
-    return int((s==val).sum())
-
-total = int(gdf.shape[0])
-base_mixto = _count(gdf["typology_code_base"], "10")
-final_mixto = _count(gdf["typology_code_final"], "10")
-zeroP = _count(gdf["typology_code_final"], "0P")
-reclass_tol = int(((gdf["typology_code_base"]=="10") & (gdf["typology_code_final"]!="10") & (gdf["typology_code_final"]!="0P")).sum())
-
-summary = pd.DataFrame({
-    "metric": [
-        "total_rows",
-        "mixto_base_n",
-        "mixto_final_n",
-        "0P_n (FSI=0 & GSI>0 & n_props=0)",
-        "reclasificados_por_tolerancia_n"
-    ],
-    "value": [total, base_mixto, final_mixto, zeroP, reclass_tol]
-})
-
-# Guardar resumen y parámetros
-summary.to_csv(SUMMARY_CSV, index=False)
-
-params = {
-    "ranges": RANGES,
-    "priority": PRIORITY_ORDER,
-    "tolerancias": {"EPS_G":EPS_G, "EPS_F":EPS_F, "EPS_L":EPS_L},
-    "catalogo": {k:v[0] for k,v in CATALOG.items()},
-}
+# Cajas en orden de prioridad: (9, 6) = GSI_min, GSI_max, FSI_min, FSI_max, L_min, L_max
+_BOXES = np.array([RANGES[c] for c in PRIORITY_ORDER], dtype=float)
+# Índices 0..8 → PRIORITY_ORDER; 9 → "10" (mixto); 10 → "00" (sin datos)
+_CODES = np.array(PRIORITY_ORDER + ["10", "00"], dtype=object)
+_IDX_MIXTO, _IDX_NODATA = len(PRIORITY_ORDER), len(PRIORITY_ORDER) + 1
+
+def _prepare_arrays(FSI, GSI, L_equiv):
+    """Arreglos float, máscara de datos válidos y L (FSI/GSI si falta L_equiv)."""
+    F = np.asarray(FSI, dtype=float)
+    G = np.asarray(GSI, dtype=float)
+    Le = np.asarray(L_equiv, dtype=float)
+    valid = ~np.isnan(F) & ~np.isnan(G) & (G > 0)
+    with np.errstate(all="ignore"):
+        L = np.where(np.isnan(Le), np.where(G > 0, F / G, np.nan), Le)
+    return F, G, L, valid
+
+def _first_match(F, G, L, eps):
+    """
+    eps: (k, 3) tolerancias (eps_g, eps_f, eps_l). Devuelve (n, k) con el índice
+    de la primera caja que contiene cada punto (orden PRIORITY_ORDER) o -1.
+    """
+    eps = np.atleast_2d(np.asarray(eps, dtype=float))
+    e = np.repeat(eps, 2, axis=1)[:, None, :]                 # (k, 1, 6)
+    lo = _BOXES[None, :, 0::2] - e[..., 0::2]                  # (k, 9, 3)
+    hi = _BOXES[None, :, 1::2] + e[..., 1::2]
+    X = np.stack([G, F, L], axis=-1)[:, None, None, :]         # (n, 1, 1, 3)
+    inside = ((X >= lo) & (X <= hi)).all(axis=-1)              # (n, k, 9)
+    return np.where(inside.any(axis=-1), inside.argmax(axis=-1), -1)
+
+def classify_vectorized(FSI, GSI, L_equiv, eps_g=EPS_G, eps_f=EPS_F, eps_l=EPS_L):
+    """
+    Equivalente vectorizado de classify_exact + classify_with_tolerance.
+    Devuelve (code_base, code_tol, used_tol): códigos de la pasada exacta, códigos
+    tras MIXTO_limite y bandera de re-clasificación por tolerancia.
+    """
+    F, G, L, valid = _prepare_arrays(FSI, GSI, L_equiv)
+    base_idx, final_idx = _resolve_idx(F, G, L, valid, (eps_g, eps_f, eps_l))
+    used_tol = final_idx != base_idx
+    return _CODES[base_idx], _CODES[final_idx], used_tol
+
+def _resolve_idx(F, G, L, valid, eps):
+    """Índices (base, final) sobre `_CODES` para una tolerancia (eps_g, eps_f, eps_l)."""
+    first = _first_match(F, G, L, [(0.0, 0.0, 0.0), eps])
+    exact, tol = first[:, 0], first[:, 1]
+    base_idx = np.where(~valid, _IDX_NODATA, np.where(exact >= 0, exact, _IDX_MIXTO))
+    final_idx = np.where(valid & (exact < 0) & (tol >= 0), tol, base_idx)
+    return base_idx, final_idx
+
+# ----- Tabla de consulta exacta (celdas alineadas a los cortes) -----
+def _axis_breaks(col, eps):
+    """Cortes ordenados de un eje: límites exactos, límites ± eps (y 0 para GSI)."""
+    lo, hi = _BOXES[:, 2 * col], _BOXES[:, 2 * col + 1]
+    extra = [0.0] if col == 0 else []
+    return np.unique(np.concatenate([lo, hi, lo - eps, hi + eps, extra]))
+
+def _axis_cells(x, breaks):
+    """
+    Celda de cada valor: 2j = intervalo abierto antes de breaks[j], 2j+1 = breaks[j]
+    exacto, 2m = por encima del último corte, 2m+1 = NaN.
+    """
+    j = np.searchsorted(breaks, x, side="left")
+    on = (j < breaks.size) & (breaks[np.minimum(j, breaks.size - 1)] == x)
+    return np.where(np.isnan(x), 2 * breaks.size + 1, 2 * j + on)
+
+def _axis_representatives(breaks):
+    """Un valor por celda (mismo orden que `_axis_cells`)."""
+    mids = np.r_[breaks[0] - 1.0, (breaks[:-1] + breaks[1:]) / 2.0]
+    reps = np.empty(2 * breaks.size + 2)
+    reps[0:-2:2], reps[1:-2:2] = mids, breaks
+    reps[-2], reps[-1] = breaks[-1] + 1.0, np.nan
+    return reps
+
+def build_lookup(eps_g=EPS_G, eps_f=EPS_F, eps_l=EPS_L):
+    """Compila las reglas en tablas (GSI × FSI × L) de índices base y final sobre `_CODES`."""
+    eps = (eps_g, eps_f, eps_l)
+    breaks = [_axis_breaks(c, e) for c, e in enumerate(eps)]
+    G, F, L = (a.ravel() for a in np.meshgrid(*[_axis_representatives(b) for b in breaks], indexing="ij"))
+    valid = ~np.isnan(F) & ~np.isnan(G) & (G > 0)
+    base_idx, final_idx = _resolve_idx(F, G, L, valid, eps)
+    shape = tuple(2 * b.size + 2 for b in breaks)
+    return {
+        "breaks_g": breaks[0], "breaks_f": breaks[1], "breaks_l": breaks[2],
+        "base": base_idx.reshape(shape).astype(np.int8),
+        "final": final_idx.reshape(shape).astype(np.int8),
+        "codes": _CODES.astype(str), "eps": np.array(eps),
+    }
+
+def classify_lookup(FSI, GSI, L_equiv, table):
+    """Misma salida que `classify_vectorized`, por consulta a la tabla."""
+    F, G, L, _ = _prepare_arrays(FSI, GSI, L_equiv)
+    cell = (_axis_cells(G, table["breaks_g"]), _axis_cells(F, table["breaks_f"]),
+            _axis_cells(L, table["breaks_l"]))
+    base_idx, final_idx = table["base"][cell], table["final"][cell]
+    codes = np.asarray(table["codes"], dtype=object)
+    return codes[base_idx], codes[final_idx], final_idx != base_idx
+
+def check_lookup(table, chunk=LOOKUP_CHUNK):
+    """
+    Verifica la tabla contra la ruta por reglas en todas las combinaciones de
+    valores de prueba por eje: cortes, cortes ± nextafter, puntos medios, NaN.
+    Devuelve el número de combinaciones probadas.
+    """
+    eps_g, eps_f, eps_l = table["eps"]
+    probes = []
+    for b in (table["breaks_g"], table["breaks_f"], table["breaks_l"]):
+        probes.append(np.unique(np.r_[b, np.nextafter(b, -np.inf), np.nextafter(b, np.inf),
+                                      _axis_representatives(b)[:-1]]).tolist() + [np.nan])
+    G, F, L = (a.ravel() for a in np.meshgrid(*map(np.asarray, probes), indexing="ij"))
+    for i in range(0, G.size, chunk):
+        sl = slice(i, i + chunk)
+        ref = classify_vectorized(F[sl], G[sl], L[sl], eps_g, eps_f, eps_l)
+        got = classify_lookup(F[sl], G[sl], L[sl], table)
+        for r, g in zip(ref, got):
+            bad = np.flatnonzero(r != g)
+            assert bad.size == 0, (f"Tabla ≠ reglas en GSI={G[sl][bad[0]]}, FSI={F[sl][bad[0]]}, "
+                                   f"L={L[sl][bad[0]]}: {r[bad[0]]} vs {g[bad[0]]}")
+    return G.size
+
+def sweep_tolerances(FSI, GSI, L_equiv, flag_dq, eps_grid, chunk=SWEEP_CHUNK):
+    """
+    Clasifica bajo cada triple de `eps_grid` (k, 3). Devuelve una matriz (n, k)
+    de índices sobre `_CODES + ['0P']`, con la misma lógica que la corrida
+    base (0P prevalece sobre la re-clasificación por tolerancia).
+    """
+    F, G, L, valid = _prepare_arrays(FSI, GSI, L_equiv)
+    dq = np.asarray(flag_dq, dtype=bool)
+    eps_grid = np.asarray(eps_grid, dtype=float)
+    out = np.empty((F.size, len(eps_grid)), dtype=np.int8)
+    for i in range(0, F.size, chunk):
+        sl = slice(i, i + chunk)
+        exact = _first_match(F[sl], G[sl], L[sl], [(0.0, 0.0, 0.0)])
+        tol = _first_match(F[sl], G[sl], L[sl], eps_grid)
+        base = np.where(~valid[sl, None], _IDX_NODATA, np.where(exact >= 0, exact, _IDX_MIXTO))
+        idx = np.where(valid[sl, None] & (exact < 0) & (tol >= 0), tol, base)
+        out[sl] = np.where(dq[sl, None], len(_CODES), idx)
+    return out
+
+# ======================== MAIN ===============================================
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sweep", action="store_true", help="Barrido de tolerancias (no reescribe el GPKG)")
+    ap.add_argument("--stability", action="store_true", help="Con --sweep: estabilidad por manzana")
+    ap.add_argument("--build-lookup", action="store_true", help="Compila la tabla de consulta y sale")
+    args = ap.parse_args()
+
+    # ===================== MODO TABLA DE CONSULTA ================================
+    if args.build_lookup:
+        print("Compilando tabla de consulta (GSI × FSI × L)…", flush=True)
+        table = build_lookup()
+        n_checked = check_lookup(table)
+        print(f"   · celdas {table['final'].shape} ({table['final'].size:,}); "
+              f"exacta en {n_checked:,} combinaciones de prueba ✅")
+        np.savez_compressed(LOOKUP_NPZ, **table)
+        print(f"Listo ✅  Tabla en {LOOKUP_NPZ}  (uso: np.load(..., allow_pickle=False) + classify_lookup)")
+        return
+
+    # ========================== LECTURA ==========================================
+    print("Capas disponibles:", list_layers(GPKG))
+
+    gdf = gpd.read_file(GPKG, layer=LAYER_IN, engine="pyogrio")
+
+    # Normalizar tipos
+    for col in ["FSI", "GSI", "L_equiv", "OSR", "n_props"]:
+        if col in gdf.columns:
+            gdf[col] = pd.to_numeric(gdf[col], errors="coerce")
+
+    # L_equiv si falta
+    if "L_equiv" not in gdf.columns:
+        gdf["L_equiv"] = np.where((gdf["GSI"] > 0) & (~gdf["FSI"].isna()), gdf["FSI"] / gdf["GSI"], np.nan)
+
+    # ======================== CLASIFICACIÓN BASE =================================
+    print("Clasificando (rangos exactos + tolerancias, vectorizado)…", flush=True)
+
+    code_base, code_tol, used_tol = classify_vectorized(gdf["FSI"], gdf["GSI"], gdf["L_equiv"])
+
+    # QA: la ruta vectorizada debe coincidir con la escalar de referencia
+    _qa = gdf[["FSI", "GSI", "L_equiv"]].sample(min(QA_SAMPLE_N, len(gdf)), random_state=0)
+    for pos, (F, G, L) in zip(gdf.index.get_indexer(_qa.index), _qa.itertuples(index=False, name=None)):
+        ref_code, ref_tol = classify_with_tolerance(F, G, L)
+        assert (classify_exact(F, G, L), ref_code, ref_tol) == (code_base[pos], code_tol[pos], bool(used_tol[pos])), \
+            f"Clasificación vectorizada ≠ escalar en fila {pos}: FSI={F}, GSI={G}, L={L}"
+
+    gdf["typology_code_base"] = code_base
+    gdf["typology_name_base"] = [CATALOG.get(c, ("Desconocida", ""))[0] for c in gdf["typology_code_base"]]
+
+    # ================== FLAGS: MIXTO_DQ y MIXTO_limite ===========================
+    # MIXTO_DQ: FSI=0 & GSI>0 & n_props=0  → código '0P'
+    print("Marcando MIXTO_DQ (FSI=0 & GSI>0 & n_props=0)…", flush=True)
+
+    n_props_series = gdf["n_props"] if "n_props" in gdf.columns else pd.Series(np.nan, index=gdf.index)
+    flag_mixto_dq = (
+        (gdf["typology_code_base"] == "10") &
+        (gdf["FSI"].fillna(0) == 0) &
+        (gdf["GSI"].fillna(0) > 0) &
+        (n_props_series.fillna(0).astype(float) == 0)
+    )
 
-# ======================== SALIDA =============================================
-print(f"→ Escribiendo layer '{LAYER_OUT}' en {GPKG.name}")
-# Evitar perder columnas originales; dejamos nuevas columnas añadidas
-out_cols = list(gdf.columns)
-
-gdf.to_file(GPKG, layer=LAYER_OUT, driver="GPKG", engine="pyogrio")
-
-csv_out = GPKG.with_suffix(".csv")
-print(f"→ Espejo CSV: {csv_out}")
-(gdf.drop(columns="geometry", errors="ignore")
-    .to_csv(csv_out, index=False, encoding="utf-8"))
-
-# Nota/Markdown con parámetros y resumen
-lines = []
-lines.append("# Spacematrix Tipologías – v2 (con QA)\n\n")
-lines.append("## Resumen de parámetros\n")
-lines.append(f"- PRIORITY_ORDER: {PRIORITY_ORDER}\n")
-lines.append(f"- Tolerancias: EPS_G={EPS_G}, EPS_F={EPS_F}, EPS_L={EPS_L}\n\n")
-lines.append("## Catálogo\n")
-for k,(nm,ds) in CATALOG.items():
-    lines.append(f"- **{k}**: {nm} – {ds}\n")
-lines.append("\n## Resumen QA (confirmación de criterios)\n")
-lines.append(summary.to_csv(index=False))
-lines.append("\n\n**Criterios confirmados:**\n- '0P' sólo se asigna cuando **FSI=0 & GSI>0 & n_props=0**.\n- 'Mixto' re-clasificado por tolerancia únicamente cuando cae en rangos expandidos ±(EPS_G, EPS_F, EPS_L).\n")
-
-NOTE_MD.write_text("".join(lines), encoding="utf-8")
-
-print("Listo ✅  (SM v2 con 0P y tolerancias, resumen exportado)")
+    gdf["flag_mixto_dq"] = flag_mixto_dq.astype(int)
+
+    # ===================== MODO BARRIDO DE TOLERANCIAS ===========================
+    if args.sweep:
+        grid = list(itertools.product(SWEEP_EPS_G, SWEEP_EPS_F, SWEEP_EPS_L))
+        print(f"Barrido de tolerancias: {len(grid)} triples × {len(gdf)} manzanas…", flush=True)
+        codes_all = np.append(_CODES, "0P")
+        idx = sweep_tolerances(gdf["FSI"], gdf["GSI"], gdf["L_equiv"], flag_mixto_dq, grid)
+        n, k = idx.shape
+
+        # Conteos (triple × código) con un solo bincount
+        counts = np.bincount((np.arange(k) * len(codes_all) + idx).ravel(),
+                             minlength=k * len(codes_all)).reshape(k, len(codes_all))
+        mixto_base = int(((code_base == "10") & ~flag_mixto_dq.to_numpy()).sum())
+        reclass_n = mixto_base - counts[:, _IDX_MIXTO]
+
+        sweep = pd.DataFrame(grid, columns=["eps_g", "eps_f", "eps_l"])
+        order = PRIORITY_ORDER[::-1] + ["10", "0P", "00"]
+        pos = {c: i for i, c in enumerate(codes_all)}
+        for c in order:
+            sweep[f"n_{c}"] = counts[:, pos[c]]
+        sweep["reclasificados_n"] = reclass_n
+        sweep["reclass_rate_mixto"] = reclass_n / mixto_base if mixto_base else np.nan
+        sweep["reclass_rate_total"] = reclass_n / n if n else np.nan
+        sweep.to_csv(SWEEP_CSV, index=False)
+        print(f"→ Resumen del barrido: {SWEEP_CSV}")
+        print(sweep[["eps_g", "eps_f", "eps_l", "n_10", "reclass_rate_mixto"]]
+              .sort_values("reclass_rate_mixto").to_string(index=False))
+
+        if args.stability:
+            # Código modal por manzana y fracción de triples que lo asignan
+            per_row = np.bincount((np.arange(n)[:, None] * len(codes_all) + idx).ravel(),
+                                  minlength=n * len(codes_all)).reshape(n, len(codes_all))
+            modal = per_row.argmax(axis=1)
+            stab = pd.DataFrame({
+                "typology_code_base": code_base,
+                "typology_code_modal": codes_all[modal],
+                "stability": per_row[np.arange(n), modal] / k,
+                "n_codes": (per_row > 0).sum(axis=1),
+            }, index=gdf.index)
+            if "CVEGEO" in gdf.columns:
+                stab.insert(0, "CVEGEO", gdf["CVEGEO"])
+            stab.to_csv(STABILITY_CSV, index=False, encoding="utf-8")
+            print(f"→ Estabilidad por manzana: {STABILITY_CSV} "
+                  f"(estables en todos los triples: {(stab['n_codes'] == 1).mean():.1%})")
+
+        print("Listo ✅  (barrido de tolerancias; layer del GPKG sin cambios)")
+        return
+
+    # MIXTO_limite: base=10 pero cae en rangos con tolerancia → se re-clasifica
+    print("Reclasificando MIXTO_limite (tolerancias)…", flush=True)
+
+    # code_tol == code_base salvo en mixtos que caen en rangos expandidos (used_tol)
+    reclass_codes = code_tol
+    reclass_flags = used_tol.astype(int)
+
+    # Si ya es MIXTO_DQ, prevalece '0P' por encima de re-clasificación por tolerancia
+    reclass_codes = pd.Series(reclass_codes, index=gdf.index)
+    reclass_codes.loc[flag_mixto_dq] = "0P"
+
+    gdf["typology_code_final"] = reclass_codes
+
+    # Nombre final
+    gdf["typology_sm_final"] = [CATALOG.get(c, ("Desconocida",""))[0] for c in gdf["typology_code_final"]]
+
+    # Flag explícito de MIXTO_limite aplicado
+    gdf["flag_mixto_limite"] = (pd.Series(reclass_flags, index=gdf.index).astype(int))
+    # Pero si terminó como '0P', no es "limite" sino DQ → set 0
+    gdf.loc[gdf["typology_code_final"]=="0P", "flag_mixto_limite"] = 0
+
+    # Diagnóstico básico
+    gdf["diag_reason"] = ""
+    gdf.loc[gdf["typology_code_final"]=="0P", "diag_reason"] = "FSI=0 & GSI>0 & n_props=0"
+    gdf.loc[(gdf["typology_code_base"]=="10") & (gdf["typology_code_final"]!="0P") & (gdf["typology_code_final"]!="10"), "diag_reason"] = "Reclasificada por tolerancia"
+
+    # ======================== RESUMEN / QA =======================================
+    print("Generando resumen de QA…", flush=True)
+
+    def _count(s, val):
+        return int((s==val).sum())
+
+    total = int(gdf.shape[0])
+    base_mixto = _count(gdf["typology_code_base"], "10")
+    final_mixto = _count(gdf["typology_code_final"], "10")
+    zeroP = _count(gdf["typology_code_final"], "0P")
+    reclass_tol = int(((gdf["typology_code_base"]=="10") & (gdf["typology_code_final"]!="10") & (gdf["typology_code_final"]!="0P")).sum())
+
+    summary = pd.DataFrame({
+        "metric": [
+            "total_rows",
+            "mixto_base_n",
+            "mixto_final_n",
+            "0P_n (FSI=0 & GSI>0 & n_props=0)",
+            "reclasificados_por_tolerancia_n"
+        ],
+        "value": [total, base_mixto, final_mixto, zeroP, reclass_tol]
+    })
+
+    # Guardar resumen y parámetros
+    summary.to_csv(SUMMARY_CSV, index=False)
+
+    params = {
+        "ranges": RANGES,
+        "priority": PRIORITY_ORDER,
+        "tolerancias": {"EPS_G":EPS_G, "EPS_F":EPS_F, "EPS_L":EPS_L},
+        "catalogo": {k:v[0] for k,v in CATALOG.items()},
+    }
+
+    # ======================== SALIDA =============================================
+    print(f"→ Escribiendo layer '{LAYER_OUT}' en {GPKG.name}")
+    # Evitar perder columnas originales; dejamos nuevas columnas añadidas
+    out_cols = list(gdf.columns)
+
+    gdf.to_file(GPKG, layer=LAYER_OUT, driver="GPKG", engine="pyogrio")
+
+    csv_out = GPKG.with_suffix(".csv")
+    print(f"→ Espejo CSV: {csv_out}")
+    (gdf.drop(columns="geometry", errors="ignore")
+        .to_csv(csv_out, index=False, encoding="utf-8"))
+
+    # Nota/Markdown con parámetros y resumen
+    lines = []
+    lines.append("# Spacematrix Tipologías – v2 (con QA)\n\n")
+    lines.append("## Resumen de parámetros\n")
+    lines.append(f"- PRIORITY_ORDER: {PRIORITY_ORDER}\n")
+    lines.append(f"- Tolerancias: EPS_G={EPS_G}, EPS_F={EPS_F}, EPS_L={EPS_L}\n\n")
+    lines.append("## Catálogo\n")
+    for k,(nm,ds) in CATALOG.items():
+        lines.append(f"- **{k}**: {nm} – {ds}\n")
+    lines.append("\n## Resumen QA (confirmación de criterios)\n")
+    lines.append(summary.to_csv(index=False))
+    lines.append("\n\n**Criterios confirmados:**\n- '0P' sólo se asigna cuando **FSI=0 & GSI>0 & n_props=0**.\n- 'Mixto' re-clasificado por tolerancia únicamente cuando cae en rangos expandidos ±(EPS_G, EPS_F, EPS_L).\n")
+
+    NOTE_MD.write_text("".join(lines), encoding="utf-8")
+
+    print("Listo ✅  (SM v2 con 0P y tolerancias, resumen exportado)")
+
+
+if __name__ == "__main__":
+    main()
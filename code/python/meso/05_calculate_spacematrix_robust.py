@@ -2,17 +2,40 @@
 """
 Space Matrix v3 LITE — B robusto (unión de huellas) + F fortalecido (rescates)
 Genera por manzana: A, B, F, FSI, GSI, L_equiv, OSR, dq_flag,
-n_props, n_predios, area_predios_tot_m2 (+ QC por municipio).
+n_props, n_predios, area_predios_tot_m2 (+ QC por municipio y, por punto de
+catastro rescatado, su manzana, nivel de rescate y distancia: qc_puntos_rescate_*.csv).
+
+B: recorte vectorizado huella ∩ manzana (pares del índice espacial) y área de la
+unión por manzana; solo las manzanas con huellas solapadas requieren `union_all`
+(en paralelo), el resto se suma con bincount.
+Puntos→manzana (catastro, centroides de predios, predios): un solo STRtree sobre
+manzanas; devuelve posiciones enteras y los agregados se hacen con bincount.
 
 Run:
   PYTHONUNBUFFERED=1 python space_matrix_v3_lite_robusto.py --out-tag v3lite_fixBF
+  PYTHONUNBUFFERED=1 python space_matrix_v3_lite_robusto.py --out-tag v3lite_fixBF --by-mun --workers 8
+
+--by-mun: una partición por MUN (CVEGEO[2:5]) en paralelo; huellas/puntos se leen por
+bbox + PARTITION_MARGIN y las manzanas vecinas entran como contexto de los rescates,
+así que el resultado es el mismo que el de la corrida global.
+--stream-footprints: huellas en lotes Arrow (--batch-size) con unión acumulada por
+manzana; la memoria pico la fija el tamaño de lote, no la capa completa.
+--incremental: guarda huellas (hash) de las entradas de cada manzana; en la siguiente
+corrida recalcula solo las manzanas cuyas entradas cambiaron y parcha el GPKG en sitio
+(UPDATE) y el CSV.
 """
 
 import geopandas as gpd
 import pandas as pd
 import numpy as np
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import argparse
+import os
+import sqlite3
+import sys
+import pyogrio
+import shapely
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -24,6 +47,10 @@ MIN_B_AREA_M2 = 10.0      # filtra slivers de huella (B)
 MAX_JOIN_DIST = 120       # 1er rescate nearest puntos→manzana (m)
 RESCUE_JOIN_DIST = 200    # 2º rescate nearest para faltantes (m)
 NEAREST_PREDIOS = 20      # tolerancia p/ centroids de predios→manzana (m)
+UNION_CHUNK = 500         # manzanas con solapes por tarea del pool (B)
+PARTITION_MARGIN = max(MAX_JOIN_DIST, RESCUE_JOIN_DIST, NEAREST_PREDIOS)  # --by-mun (m)
+STREAM_BATCH = 50000      # huellas por lote Arrow (--stream-footprints)
+WORKERS = max(1, (os.cpu_count() or 2) - 1)
 
 # RUTAS (ajusta si es necesario)
 BASE_CITY = Path("/Users/danielaresendiz/Library/CloudStorage/OneDrive-UniversityCollegeLondon(2)/Dissertation/01_data/Data_catastro/citywide_build")
@@ -48,35 +75,134 @@ def clean_buildings(gdf: gpd.GeoDataFrame, min_area=MIN_B_AREA_M2):
     g = g[g["_area"] >= float(min_area)].drop(columns=["_area"])
     return g
 
-def join_points_to_manz(points: gpd.GeoDataFrame, manz: gpd.GeoDataFrame, max_dist=MAX_JOIN_DIST):
-    """Join puntos→manzana con interior/covered_by + nearest como rescate."""
-    idx = manz[["manzana_id","geometry"]]
-
-    # 1) dentro o covered_by
-    try:
-        j = gpd.sjoin(points, idx, how="left", predicate="covered_by")
-    except Exception:
-        j = gpd.sjoin(points, idx, how="left", predicate="within")
-
-    j_first = j[["manzana_id"]].groupby(level=0).first()
-    res = points.join(j_first, how="left")
-
-    # 2) nearest para faltantes
-    miss = res["manzana_id"].isna()
-    if miss.any():
-        j2 = gpd.sjoin_nearest(points.loc[miss], idx, how="left",
-                               max_distance=max_dist, distance_col="dist_m")
-        res.loc[j2.index, "manzana_id"] = j2["manzana_id"].values
-    return res
-
-def join_points_to_manz_rescue(points_missing: gpd.GeoDataFrame, manz: gpd.GeoDataFrame, max_dist=RESCUE_JOIN_DIST):
-    """Segundo rescate nearest para puntos aún sin manzana tras el primer join."""
-    if points_missing.empty:
-        return points_missing.assign(manzana_id=pd.NA)
-    idx = manz[["manzana_id","geometry"]]
-    j = gpd.sjoin_nearest(points_missing, idx, how="left",
-                          max_distance=max_dist, distance_col="dist_m2")
-    return j[["manzana_id"]]
+def _union_area_chunk(groups):
+    """Área de la unión de cada grupo de piezas (una lista por manzana)."""
+    return [shapely.union_all(g).area for g in groups]
+
+def b_union_by_manz(build: gpd.GeoDataFrame, manz: gpd.GeoDataFrame, workers=WORKERS):
+    """
+    B por manzana (área de la unión de huellas recortadas), alineado por posición con `manz`.
+    Pares huella–manzana desde el índice espacial → recorte vectorizado `shapely.intersection`.
+    Manzanas sin piezas solapadas: la unión (cobertura) mide la suma de áreas → bincount.
+    Manzanas con solapes: `union_all` por grupo en un pool de procesos.
+    """
+    bg = build.geometry.to_numpy()
+    mg = manz.geometry.to_numpy()
+    ib, im = manz.sindex.query(build.geometry, predicate="intersects")
+    pieces = shapely.intersection(bg[ib], mg[im])
+    area = shapely.area(pieces)
+    ok = area > 0
+    pieces, im, area = pieces[ok], im[ok], area[ok]
+
+    # Solapes entre piezas de la MISMA manzana (compartir muro no cuenta: área 0)
+    a, b = shapely.STRtree(pieces).query(pieces, predicate="intersects")
+    sel = (a < b) & (im[a] == im[b])
+    a, b = a[sel], b[sel]
+    ov = shapely.area(shapely.intersection(pieces[a], pieces[b])) > 0
+    manz_ov = np.zeros(len(mg), dtype=bool)
+    manz_ov[im[a[ov]]] = True
+
+    plain = ~manz_ov[im]
+    B = np.bincount(im[plain], weights=area[plain], minlength=len(mg)).astype(float)
+
+    idx_ov = np.flatnonzero(~plain)
+    if idx_ov.size:
+        idx_ov = idx_ov[np.argsort(im[idx_ov], kind="stable")]
+        ids, starts = np.unique(im[idx_ov], return_index=True)
+        groups = np.split(pieces[idx_ov], starts[1:])
+        chunks = [groups[i:i + UNION_CHUNK] for i in range(0, len(groups), UNION_CHUNK)]
+        if workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                areas = [x for part in ex.map(_union_area_chunk, chunks) for x in part]
+        else:
+            areas = [x for c in chunks for x in _union_area_chunk(c)]
+        B[ids] = areas
+    return B, int(manz_ov.sum())
+
+def stream_b_union(manz: gpd.GeoDataFrame, bbox=None, batch_size=STREAM_BATCH):
+    """
+    B por manzana leyendo huellas en lotes Arrow (pyogrio.open_arrow, bbox opcional).
+    Cada lote se limpia (clean_buildings), se recorta contra el índice de manzanas y su
+    geometría se acumula por manzana con `shapely.union` vectorizado, en rondas por
+    número de pieza dentro de la manzana. Memoria pico ≈ lote + unión acumulada.
+    """
+    info = pyogrio.read_info(BUILDINGS_GPKG, layer=BUILDINGS_LAYER)
+    src_bbox = None
+    if bbox is not None:
+        src_bbox = tuple(gpd.GeoSeries([shapely.box(*bbox)], crs=CRS_METERS).to_crs(info["crs"]).total_bounds)
+
+    mg = manz.geometry.to_numpy()
+    acc = np.full(len(mg), shapely.Polygon(), dtype=object)
+    n_batches = 0
+    with pyogrio.open_arrow(BUILDINGS_GPKG, layer=BUILDINGS_LAYER, bbox=src_bbox, columns=[],
+                            batch_size=batch_size, use_pyarrow=True) as (meta, reader):
+        geom_col = meta["geometry_name"] or "wkb_geometry"
+        for batch in reader:
+            n_batches += 1
+            geoms = shapely.from_wkb(batch.column(geom_col).to_numpy(zero_copy_only=False))
+            build = clean_buildings(gpd.GeoDataFrame(geometry=geoms, crs=meta["crs"]))
+            if build.empty:
+                continue
+            ib, im = manz.sindex.query(build.geometry, predicate="intersects")
+            pieces = shapely.intersection(build.geometry.to_numpy()[ib], mg[im])
+            ok = shapely.area(pieces) > 0
+            pieces, im = pieces[ok], im[ok]
+            # Ronda r: la r-ésima pieza de cada manzana (sin índices repetidos por ronda)
+            order = np.argsort(im, kind="stable")
+            pieces, im = pieces[order], im[order]
+            rank = np.arange(im.size) - np.searchsorted(im, im, side="left")
+            for r in range(int(rank.max()) + 1 if rank.size else 0):
+                sel = rank == r
+                acc[im[sel]] = shapely.union(acc[im[sel]], pieces[sel])
+    return shapely.area(acc), n_batches
+
+def manz_point_index(manz: gpd.GeoDataFrame):
+    """Índice compartido puntos→manzana: un STRtree sobre las manzanas (geometrías preparadas)."""
+    geoms = manz.geometry.to_numpy()
+    shapely.prepare(geoms)
+    return shapely.STRtree(geoms), geoms
+
+def points_to_manz_pos(index, points, tiers=(MAX_JOIN_DIST,), return_dist=False):
+    """
+    Posición (entera) de la manzana de cada punto y nivel de asignación:
+    tier 0 = dentro o en el borde (covered_by): candidatos por bbox del árbol +
+    `intersects_xy` sobre las coordenadas crudas (si hay varias, la de menor posición);
+    tier k ≥ 1 = rescate nearest con distancia ≤ tiers[k-1] (UNA sola consulta
+    nearest a la tolerancia mayor; el nivel sale de la distancia);
+    pos = -1 / tier = -1 = sin manzana.
+    return_dist: agrega la distancia a la manzana asignada (0 en tier 0, NaN sin manzana).
+    """
+    tree, geoms = index
+    pts = np.asarray(points.geometry.to_numpy() if hasattr(points, "geometry") else points)
+    x, y = shapely.get_x(pts), shapely.get_y(pts)
+    pos = np.full(len(pts), np.iinfo(np.int64).max, dtype=np.int64)
+
+    ip, im = tree.query(pts)
+    hit = shapely.intersects_xy(geoms[im], x[ip], y[ip])
+    np.minimum.at(pos, ip[hit], im[hit])
+    tier = np.where(pos == np.iinfo(np.int64).max, -1, 0).astype(np.int8)
+    pos[tier < 0] = -1
+    dist_m = np.where(tier == 0, 0.0, np.nan)
+
+    tiers = np.sort(np.asarray(tiers, dtype=float))
+    miss = np.flatnonzero((tier < 0) & ~np.isnan(x))
+    if miss.size and tiers.size:
+        (jp, jm), dist = tree.query_nearest(pts[miss], max_distance=tiers[-1],
+                                            all_matches=False, return_distance=True)
+        pos[miss[jp]] = jm
+        tier[miss[jp]] = 1 + np.searchsorted(tiers, dist, side="left")
+        dist_m[miss[jp]] = dist
+    return (pos, tier, dist_m) if return_dist else (pos, tier)
+
+def count_by_pos(pos, n):
+    return np.bincount(pos[pos >= 0], minlength=n)
+
+def sum_by_pos(pos, values, n):
+    """Suma por manzana con min_count=1 (NaN si la manzana no tiene valores válidos)."""
+    values = np.asarray(values, dtype=float)
+    ok = (pos >= 0) & ~np.isnan(values)
+    s = np.bincount(pos[ok], weights=values[ok], minlength=n)
+    return np.where(np.bincount(pos[ok], minlength=n) > 0, s, np.nan)
 
 def add_mun_ageb(df: pd.DataFrame) -> pd.DataFrame:
     if "CVEGEO" in df.columns:
@@ -92,65 +218,30 @@ def qc_por_mun(df: pd.DataFrame) -> pd.DataFrame:
     falt_3 = ((d["sup_const_tot_m2"]<=0) & (d["B_m2"]<=0)).groupby(d["MUN"]).sum()
     tot  = d.groupby("MUN").size()
     npr  = d.groupby("MUN")["n_props"].sum(min_count=1)
+    npr_t1 = d.groupby("MUN")["n_props_t1"].sum() if "n_props_t1" in d else 0
+    npr_t2 = d.groupby("MUN")["n_props_t2"].sum() if "n_props_t2" in d else 0
     Ftot = d.groupby("MUN")["sup_const_tot_m2"].sum(min_count=1)
     Btot = d.groupby("MUN")["B_m2"].sum(min_count=1)
     qc = pd.DataFrame({
         "flag1_F<=0_B>0":falt_1, "flag2_F>0_B<=0":falt_2, "flag3_F<=0_B<=0":falt_3,
-        "total":tot, "n_props_total":npr, "F_total":Ftot, "B_total":Btot
+        "total":tot, "n_props_total":npr, "n_props_rescate_t1":npr_t1, "n_props_rescate_t2":npr_t2,
+        "F_total":Ftot, "B_total":Btot
     }).fillna(0)
     for c in ["flag1_F<=0_B>0","flag2_F>0_B<=0","flag3_F<=0_B<=0"]:
         qc[f"pct_{c}"] = 100*qc[c]/qc["total"].replace(0, np.nan)
     return qc.sort_values("flag1_F<=0_B>0", ascending=False)
 
 # ───────────────────────────────────────────────────────────────────────────────
-# MAIN
+# CÁLCULO (ciudad completa o una partición)
 # ───────────────────────────────────────────────────────────────────────────────
-if __name__ == "__main__":
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--out-tag", default="v3lite_fixBF", help="Sufijo para archivos/layer de salida")
-    args = ap.parse_args()
-
-    OUT_GPKG  = GWR_DIR / f"manzanas_master_con_GWR_spacematrix_{args.out_tag}.gpkg"
-    OUT_LAYER = f"manzanas_{args.out_tag}"
-    OUT_CSV   = GWR_DIR / f"manzanas_master_con_GWR_spacematrix_{args.out_tag}.csv"
+def _bbox_mask(bbox):
+    """bbox (xmin, ymin, xmax, ymax) en CRS_METERS → máscara para read_file (None = todo)."""
+    return None if bbox is None else gpd.GeoSeries([shapely.box(*bbox)], crs=CRS_METERS)
 
-    # 1) MANZANAS + A
-    print("Cargando manzanas…", flush=True)
-    manz = gpd.read_file(MANZ_GPKG).to_crs(CRS_METERS)
-    if "manzana_id" not in manz.columns:
-        manz = manz.reset_index(drop=False).rename(columns={"index":"manzana_id"})
-    manz["A_m2"] = manz.geometry.area
-
-    # 2) B (huellas) — overlay + UNIÓN por manzana (robusto)
-    print("Cargando footprints de edificios…", flush=True)
-    build_raw = gpd.read_file(BUILDINGS_GPKG, layer=BUILDINGS_LAYER)
-    build = clean_buildings(build_raw)
-
-    print("Intersecciones edificios ∩ manzana y UNIÓN por manzana…", flush=True)
-    bld = build[["geometry"]].reset_index(drop=True)
-    cand = gpd.sjoin(
-        gpd.GeoDataFrame(bld, geometry="geometry", crs=CRS_METERS),
-        manz[["manzana_id","geometry"]], how="inner", predicate="intersects"
-    )[["manzana_id","geometry"]]
-
-    g_bld = gpd.GeoDataFrame(cand, crs=CRS_METERS)
-    g_mnz = gpd.GeoDataFrame(manz[["manzana_id","geometry"]], crs=CRS_METERS)
-    inter = gpd.overlay(g_bld, g_mnz, how="intersection")
-
-    # UNIÓN geométrica por manzana y área (evita doble conteo)
-    B_union = (inter.groupby("manzana_id")["geometry"]
-                     .apply(lambda geoms: geoms.unary_union)
-                     .apply(lambda g: g.area if g is not None else 0.0)
-                     .rename("B_m2"))
-
-    manz = manz.merge(B_union, on="manzana_id", how="left").fillna({"B_m2":0.0})
-    # Seguridad numérica: B ≤ A
-    manz["B_m2"] = manz[["B_m2","A_m2"]].min(axis=1)
-    print(f"✔ B listo (B>0 en {manz['B_m2'].gt(0).sum()} manzanas)", flush=True)
-
-    # 3) F desde catastro_puntos (dos rescates)
-    print("Cargando catastro_puntos…", flush=True)
-    cat = gpd.read_file(CITY_GPKG, layer="catastro_puntos").to_crs(CRS_METERS)
+def load_catastro(bbox=None):
+    """catastro_puntos en CRS métrico con superficie_construccion/terreno normalizadas (índice = FID del GPKG)."""
+    cat = gpd.read_file(CITY_GPKG, layer="catastro_puntos", bbox=_bbox_mask(bbox),
+                        engine="pyogrio", fid_as_index=True).to_crs(CRS_METERS)
 
     # Normaliza nombres si vienen con otras etiquetas
     if "superficie_construccion" not in cat.columns and "sup_const_tot_m2" in cat.columns:
@@ -162,95 +253,344 @@ if __name__ == "__main__":
         cat[c] = pd.to_numeric(cat[c], errors="coerce")
         # Trata ceros como faltantes (0 no aporta construcción/terreno)
         cat.loc[cat[c].eq(0), c] = np.nan
+    return cat
+
+def read_optional_layer(layer, bbox=None):
+    try:
+        return gpd.read_file(CITY_GPKG, layer=layer, bbox=_bbox_mask(bbox)).to_crs(CRS_METERS)
+    except Exception:
+        return gpd.GeoDataFrame(columns=["geometry"], geometry="geometry", crs=CRS_METERS)
+
+def compute_spacematrix(manz: gpd.GeoDataFrame, own=None, bbox=None, workers=WORKERS, verbose=True,
+                        stream=False, batch_size=STREAM_BATCH):
+    """
+    A, B, F, FSI, GSI, L_equiv, OSR y dq_flag para las manzanas `own` (máscara; None = todas).
+    Las demás filas de `manz` son contexto: entran al índice de puntos para que los
+    rescates nearest den lo mismo que en la corrida global, pero no se devuelven.
+    `bbox` limita la lectura de huellas y puntos (None = ciudad completa).
+    `stream`: huellas en lotes Arrow (stream_b_union) en vez de cargar la capa entera.
+    Devuelve (manzanas, qc_puntos): qc_puntos = un registro por punto de catastro
+    rescatado (tier ≥ 1) hacia una manzana propia: punto_fid, manzana_id, tier, dist_m.
+    """
+    log = print if verbose else (lambda *a, **k: None)
+    own = np.ones(len(manz), dtype=bool) if own is None else np.asarray(own, dtype=bool)
+    out = manz.iloc[np.flatnonzero(own)].copy()
+    n_out = len(out)
+    out["A_m2"] = out.geometry.area
+
+    # Posición en `manz` → posición en `out` (-1 = manzana de contexto: no cuenta aquí)
+    remap = np.full(len(manz), -1, dtype=np.int64)
+    remap[own] = np.arange(n_out)
+    own_pos = lambda pos: np.where(pos >= 0, remap[pos], -1)
+
+    # 2) B (huellas) — recorte vectorizado + UNIÓN por manzana
+    if stream:
+        log(f"Footprints en lotes Arrow de {batch_size} (recorte + unión acumulada)…", flush=True)
+        B, n_batches = stream_b_union(out, bbox=bbox, batch_size=batch_size)
+        log(f"   · {n_batches} lotes", flush=True)
+    else:
+        log("Cargando footprints de edificios…", flush=True)
+        build_raw = gpd.read_file(BUILDINGS_GPKG, layer=BUILDINGS_LAYER, bbox=_bbox_mask(bbox))
+        build = clean_buildings(build_raw)
+
+        log("Recorte huellas ∩ manzana (vectorizado) y UNIÓN por manzana…", flush=True)
+        B, n_ov = b_union_by_manz(build, out, workers=workers)
+        log(f"   · {n_ov} manzanas con huellas solapadas (unión geométrica); resto por suma de áreas", flush=True)
+    out["B_m2"] = B
+    # Seguridad numérica: B ≤ A
+    out["B_m2"] = out[["B_m2","A_m2"]].min(axis=1)
+    log(f"✔ B listo (B>0 en {out['B_m2'].gt(0).sum()} manzanas)", flush=True)
 
-    # Primer join: interior/covered_by + nearest (MAX_JOIN_DIST)
-    print("Join Catastro → manzana (paso 1)…", flush=True)
-    join_p1 = join_points_to_manz(cat[["geometry","superficie_construccion","superficie_terreno"]], manz, max_dist=MAX_JOIN_DIST)
+    # 3) F desde catastro_puntos (rescates por nivel)
+    log("Cargando catastro_puntos…", flush=True)
+    cat = load_catastro(bbox)
 
-    # Segundo rescate para los que quedaron sin manzana
-    miss_idx = join_p1["manzana_id"].isna()
-    if miss_idx.any():
-        print(f"Rescate Catastro faltantes (paso 2, {RESCUE_JOIN_DIST} m)…", flush=True)
-        rescue = join_points_to_manz_rescue(join_p1.loc[miss_idx, ["geometry"]], manz, max_dist=RESCUE_JOIN_DIST)
-        join_p1.loc[miss_idx, "manzana_id"] = rescue["manzana_id"].values
+    # Un solo índice (STRtree) sobre manzanas para las tres capas de puntos
+    mindex = manz_point_index(manz)
 
-    # Agregados por manzana (min_count=1 evita sumar todo NaN a 0)
-    F_by_manz  = join_p1.groupby("manzana_id")["superficie_construccion"].sum(min_count=1).rename("sup_const_tot_m2")
-    Terr_by_m  = join_p1.groupby("manzana_id")["superficie_terreno"].sum(min_count=1).rename("sup_terreno_tot_m2")
-    n_props    = join_p1.groupby("manzana_id").size().rename("n_props")
+    # Join interior/covered_by + UN rescate nearest a RESCUE_JOIN_DIST; nivel por distancia
+    log(f"Join Catastro → manzana (dentro + nearest ≤{MAX_JOIN_DIST} / ≤{RESCUE_JOIN_DIST} m)…", flush=True)
+    pos_cat, tier_cat, dist_cat = points_to_manz_pos(mindex, cat, tiers=(MAX_JOIN_DIST, RESCUE_JOIN_DIST),
+                                                     return_dist=True)
+    pos_cat = own_pos(pos_cat)
+    n_tier = {t: int((tier_cat == t).sum()) for t in (0, 1, 2, -1)}
+    log(f"   · dentro={n_tier[0]}, rescate ≤{MAX_JOIN_DIST} m={n_tier[1]}, "
+        f"rescate ≤{RESCUE_JOIN_DIST} m={n_tier[2]}, sin manzana={n_tier[-1]}", flush=True)
 
-    manz = manz.merge(F_by_manz, on="manzana_id", how="left")
-    manz = manz.merge(Terr_by_m, on="manzana_id", how="left")
-    manz = manz.merge(n_props,   on="manzana_id", how="left")
+    # Agregados por manzana (min_count=1 evita sumar todo NaN a 0)
+    out["sup_const_tot_m2"]   = sum_by_pos(pos_cat, cat["superficie_construccion"], n_out)
+    out["sup_terreno_tot_m2"] = sum_by_pos(pos_cat, cat["superficie_terreno"], n_out)
+    out["n_props"]            = count_by_pos(pos_cat, n_out)
+    out["n_props_t1"]         = count_by_pos(np.where(tier_cat == 1, pos_cat, -1), n_out)
+    out["n_props_t2"]         = count_by_pos(np.where(tier_cat == 2, pos_cat, -1), n_out)
 
     # Rellenos controlados (mantén NaN donde no hay datos reales)
-    manz["sup_const_tot_m2"]   = manz["sup_const_tot_m2"].fillna(0.0)
-    manz["sup_terreno_tot_m2"] = manz["sup_terreno_tot_m2"].fillna(0.0)
-    manz["n_props"]            = manz["n_props"].fillna(0).astype(int)
-    print(f"✔ F listo (F>0 en {manz['sup_const_tot_m2'].gt(0).sum()} manzanas, n_props={int(manz['n_props'].sum())})", flush=True)
+    out["sup_const_tot_m2"]   = out["sup_const_tot_m2"].fillna(0.0)
+    out["sup_terreno_tot_m2"] = out["sup_terreno_tot_m2"].fillna(0.0)
+    out["n_props"]            = out["n_props"].fillna(0).astype(int)
+
+    # QC por punto: rescates hacia manzanas propias (los de manzanas de contexto son de otra partición)
+    sel = (tier_cat > 0) & (pos_cat >= 0)
+    qc_pts = pd.DataFrame({
+        "punto_fid": cat.index.to_numpy()[sel],
+        "manzana_id": out["manzana_id"].reset_index(drop=True).reindex(pos_cat[sel]).to_numpy(),
+        "tier": tier_cat[sel],
+        "dist_m": dist_cat[sel],
+    })
+    log(f"✔ F listo (F>0 en {out['sup_const_tot_m2'].gt(0).sum()} manzanas, n_props={int(out['n_props'].sum())})", flush=True)
 
     # 4) PREDIOS (conteo y áreas)
-    print("Cargando predios_centroides para conteo…", flush=True)
-    try:
-        g_cent = gpd.read_file(CITY_GPKG, layer="predios_centroides").to_crs(CRS_METERS)
-    except Exception:
-        g_cent = gpd.GeoDataFrame(columns=["geometry"], crs=CRS_METERS)
+    log("Cargando predios_centroides para conteo…", flush=True)
+    g_cent = read_optional_layer("predios_centroides", bbox)
     if not g_cent.empty:
-        jcnt = join_points_to_manz(g_cent[["geometry"]], manz, max_dist=NEAREST_PREDIOS)
-        n_predios_by_m = jcnt.groupby("manzana_id").size().rename("n_predios")
-        manz = manz.merge(n_predios_by_m, on="manzana_id", how="left")
+        cnt = count_by_pos(own_pos(points_to_manz_pos(mindex, g_cent, tiers=(NEAREST_PREDIOS,))[0]), n_out)
+        out["n_predios"] = np.where(cnt > 0, cnt, np.nan)
     else:
-        manz["n_predios"] = pd.NA
+        out["n_predios"] = pd.NA
 
-    print("Cargando predios (polígonos) solo para áreas…", flush=True)
-    try:
-        g_pred = gpd.read_file(CITY_GPKG, layer="predios").to_crs(CRS_METERS)
-    except Exception:
-        g_pred = gpd.GeoDataFrame(columns=["geometry"], crs=CRS_METERS)
+    log("Cargando predios (polígonos) solo para áreas…", flush=True)
+    g_pred = read_optional_layer("predios", bbox)
     if not g_pred.empty:
         g_pred = g_pred[g_pred.geometry.notna() & g_pred.is_valid].copy()
         g_pred["area_predio"] = g_pred.geometry.area
-        gc = g_pred.copy()
-        gc["geometry"] = gc.geometry.centroid
-        jarea = join_points_to_manz(gc[["geometry","area_predio"]], manz, max_dist=NEAREST_PREDIOS)
-        area_predios_tot = jarea.groupby("manzana_id")["area_predio"].sum(min_count=1).rename("area_predios_tot_m2")
-        manz = manz.merge(area_predios_tot, on="manzana_id", how="left")
-        if "n_predios" in manz.columns:
-            manz["area_predio_med_m2"] = (manz["area_predios_tot_m2"] / manz["n_predios"]).astype(float)
+        cent = shapely.centroid(g_pred.geometry.to_numpy())
+        pos_pred, _ = points_to_manz_pos(mindex, cent, tiers=(NEAREST_PREDIOS,))
+        out["area_predios_tot_m2"] = sum_by_pos(own_pos(pos_pred), g_pred["area_predio"], n_out)
+        if "n_predios" in out.columns:
+            out["area_predio_med_m2"] = (out["area_predios_tot_m2"] / out["n_predios"]).astype(float)
         else:
-            manz["area_predio_med_m2"] = np.nan
+            out["area_predio_med_m2"] = np.nan
     else:
-        manz["area_predios_tot_m2"] = pd.NA
-        manz["area_predio_med_m2"]  = pd.NA
+        out["area_predios_tot_m2"] = pd.NA
+        out["area_predio_med_m2"]  = pd.NA
 
     # 5) INDICADORES Space Matrix (con chequeos numéricos)
-    manz["FSI"] = (manz["sup_const_tot_m2"] / manz["A_m2"]).replace([np.inf,-np.inf], np.nan)
-    manz["GSI"] = (manz["B_m2"] / manz["A_m2"]).replace([np.inf,-np.inf], np.nan)
-    manz["L_equiv"] = np.where((manz["B_m2"]>0), manz["sup_const_tot_m2"] / manz["B_m2"], np.nan)
-    manz.loc[manz["FSI"] < 0, "FSI"] = np.nan
-    manz.loc[(manz["GSI"] < 0) | (manz["GSI"] > 1), "GSI"] = np.nan  # por si ruido numérico
-    manz["OSR"] = np.where((manz["FSI"]>0) & manz["GSI"].notna(), (1 - manz["GSI"]) / manz["FSI"], np.nan)
+    out["FSI"] = (out["sup_const_tot_m2"] / out["A_m2"]).replace([np.inf,-np.inf], np.nan)
+    out["GSI"] = (out["B_m2"] / out["A_m2"]).replace([np.inf,-np.inf], np.nan)
+    out["L_equiv"] = np.where((out["B_m2"]>0), out["sup_const_tot_m2"] / out["B_m2"], np.nan)
+    out.loc[out["FSI"] < 0, "FSI"] = np.nan
+    out.loc[(out["GSI"] < 0) | (out["GSI"] > 1), "GSI"] = np.nan  # por si ruido numérico
+    out["OSR"] = np.where((out["FSI"]>0) & out["GSI"].notna(), (1 - out["GSI"]) / out["FSI"], np.nan)
 
     # Campos no disponibles en LITE
-    manz["L_niveles"] = np.nan
-    manz["FSI_by_levels"] = np.nan
-    manz["OSR_by_levels"] = np.nan
-    manz["L_diff_equiv_minus_niveles"] = np.nan
+    out["L_niveles"] = np.nan
+    out["FSI_by_levels"] = np.nan
+    out["OSR_by_levels"] = np.nan
+    out["L_diff_equiv_minus_niveles"] = np.nan
+
+    # 6) FLAGS
+    out["dq_flag"] = 0
+    out.loc[(out["sup_const_tot_m2"]<=0) & (out["B_m2"]>0), "dq_flag"] = 1
+    out.loc[(out["sup_const_tot_m2"]>0) & (out["B_m2"]<=0), "dq_flag"] = 2
+    out.loc[(out["sup_const_tot_m2"]<=0) & (out["B_m2"]<=0), "dq_flag"] = 3
+    return out, qc_pts
+
+# ───────────────────────────────────────────────────────────────────────────────
+# MODO PARTICIONADO (--by-mun)
+# ───────────────────────────────────────────────────────────────────────────────
+def mun_partitions(manz: gpd.GeoDataFrame, margin=PARTITION_MARGIN):
+    """
+    Una partición por MUN (add_mun_ageb). Puntos/huellas se leen en bbox + margin;
+    las manzanas de contexto (bbox + 2·margin) cubren a cualquier vecina que pudiera
+    ganar un rescate nearest a una manzana propia. Orden global conservado en cada
+    partición para que los empates covered_by se resuelvan igual que en la corrida global.
+    """
+    mun = add_mun_ageb(manz.drop(columns="geometry"))["MUN"].to_numpy()
+    for m in sorted(pd.unique(mun)):
+        own = mun == m
+        xmin, ymin, xmax, ymax = manz.geometry[own].total_bounds
+        ctx = manz.sindex.query(shapely.box(xmin - 2*margin, ymin - 2*margin, xmax + 2*margin, ymax + 2*margin))
+        rows = np.union1d(np.flatnonzero(own), ctx)
+        bbox = (xmin - margin, ymin - margin, xmax + margin, ymax + margin)
+        yield m, manz.iloc[rows], own[rows], bbox
+
+def _run_partition(job):
+    m, part, own, bbox, stream, batch_size = job
+    return (m, *compute_spacematrix(part, own=own, bbox=bbox, workers=1, verbose=False,
+                                    stream=stream, batch_size=batch_size))
+
+def compute_by_mun(manz: gpd.GeoDataFrame, workers=WORKERS, stream=False, batch_size=STREAM_BATCH):
+    """Calcula cada MUN en un proceso y concatena en el orden original de `manz`."""
+    parts, pts = [], []
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        jobs = ((*job, stream, batch_size) for job in mun_partitions(manz))
+        for m, res, qc_pts in ex.map(_run_partition, jobs):
+            print(f"   · MUN {m}: {len(res)} manzanas (B>0 en {res['B_m2'].gt(0).sum()}, "
+                  f"n_props={int(res['n_props'].sum())})", flush=True)
+            parts.append(res)
+            pts.append(qc_pts)
+    qc_pts = pd.concat(pts, ignore_index=True).sort_values("punto_fid")
+    return pd.concat(parts).loc[manz.index], qc_pts.reset_index(drop=True)
+
+# ───────────────────────────────────────────────────────────────────────────────
+# MODO INCREMENTAL (--incremental): huellas de entrada por manzana
+# ───────────────────────────────────────────────────────────────────────────────
+def _hash_sum(pos, h, n):
+    """Huella por manzana: suma uint64 (con desborde) de los hashes de sus elementos + conteo."""
+    ok = pos >= 0
+    acc = np.zeros(n, dtype=np.uint64)
+    np.add.at(acc, pos[ok], h[ok])
+    return acc, np.bincount(pos[ok], minlength=n)
+
+def input_fingerprints(manz: gpd.GeoDataFrame) -> pd.DataFrame:
+    """
+    Huellas por manzana de todo lo que entra a su cálculo: su geometría, las huellas de
+    edificio que la tocan, los puntos de catastro / centroides de predios / predios que
+    se le asignan. Cada elemento se hashea (pd.util.hash_array) y se combina por suma.
+    """
+    n = len(manz)
+    fp = pd.DataFrame({"manzana_id": manz["manzana_id"].to_numpy(),
+                       "h_manz": pd.util.hash_array(shapely.to_wkb(manz.geometry.to_numpy()))})
+
+    raw = gpd.read_file(BUILDINGS_GPKG, layer=BUILDINGS_LAYER)
+    h = pd.util.hash_array(shapely.to_wkb(raw.geometry.to_numpy()))
+    ib, im = manz.sindex.query(raw.to_crs(CRS_METERS).geometry, predicate="intersects")
+    fp["h_build"], fp["n_build"] = _hash_sum(im, h[ib], n)
+
+    mindex = manz_point_index(manz)
+    cat = load_catastro()
+    pos, _ = points_to_manz_pos(mindex, cat, tiers=(MAX_JOIN_DIST, RESCUE_JOIN_DIST))
+    h = pd.util.hash_pandas_object(pd.DataFrame({
+        "x": cat.geometry.x, "y": cat.geometry.y,
+        "c": cat["superficie_construccion"], "t": cat["superficie_terreno"]}), index=False).to_numpy()
+    fp["h_cat"], fp["n_cat"] = _hash_sum(pos, h, n)
+
+    g_cent = read_optional_layer("predios_centroides")
+    pos = points_to_manz_pos(mindex, g_cent, tiers=(NEAREST_PREDIOS,))[0]
+    h = pd.util.hash_array(shapely.to_wkb(g_cent.geometry.to_numpy()))
+    fp["h_cent"], fp["n_cent"] = _hash_sum(pos, h, n)
+
+    g_pred = read_optional_layer("predios")
+    g_pred = g_pred[g_pred.geometry.notna() & g_pred.is_valid]
+    pos = points_to_manz_pos(mindex, shapely.centroid(g_pred.geometry.to_numpy()), tiers=(NEAREST_PREDIOS,))[0]
+    h = pd.util.hash_array(shapely.to_wkb(g_pred.geometry.to_numpy()))
+    fp["h_pred"], fp["n_pred"] = _hash_sum(pos, h, n)
+    return fp
+
+def changed_manzanas(fp_old: pd.DataFrame, fp_new: pd.DataFrame):
+    """Máscara de manzanas con entradas distintas; None si cambió el conjunto o la geometría de manzanas."""
+    if len(fp_old) != len(fp_new) or not (
+            (fp_old["manzana_id"].to_numpy() == fp_new["manzana_id"].to_numpy()).all() and
+            (fp_old["h_manz"].to_numpy() == fp_new["h_manz"].to_numpy()).all()):
+        return None
+    cols = [c for c in fp_new.columns if c.startswith(("h_", "n_"))]
+    return (fp_old[cols].to_numpy() != fp_new[cols].to_numpy()).any(axis=1)
+
+def _gpkg_blob_geom(blob):
+    """Geometría de un blob GPKG (cabecera 'GP' + envolvente opcional + WKB)."""
+    env = (0, 32, 48, 48, 64)[(blob[3] >> 1) & 0x07]
+    return shapely.from_wkb(bytes(blob[8 + env:]))
+
+def _gpkg_connect(gpkg: Path):
+    """sqlite3 sobre un GPKG con las funciones ST_* que usan los triggers del RTree de GDAL."""
+    con = sqlite3.connect(gpkg)
+    con.create_function("ST_IsEmpty", 1, lambda b: None if b is None else int(bool(b[3] & 0x10)), deterministic=True)
+    for i, name in enumerate(("ST_MinX", "ST_MinY", "ST_MaxX", "ST_MaxY")):
+        con.create_function(name, 1, lambda b, i=i: None if b is None else float(shapely.bounds(_gpkg_blob_geom(b))[i]),
+                            deterministic=True)
+    return con
+
+def patch_gpkg_rows(gpkg: Path, layer: str, res: pd.DataFrame, cols):
+    """UPDATE en sitio (sqlite3) de las columnas `cols` para las filas de `res`, por manzana_id."""
+    py = lambda v: None if pd.isna(v) else (v.item() if hasattr(v, "item") else v)
+    sets = ", ".join(f'"{c}" = ?' for c in cols)
+    rows = [[py(v) for v in vals] + [py(mid)]
+            for vals, mid in zip(res[cols].itertuples(index=False, name=None), res["manzana_id"])]
+    con = _gpkg_connect(gpkg)
+    try:
+        with con:
+            con.executemany(f'UPDATE "{layer}" SET {sets} WHERE "manzana_id" = ?', rows)
+    finally:
+        con.close()
+    return len(rows)
+
+# ───────────────────────────────────────────────────────────────────────────────
+# MAIN
+# ───────────────────────────────────────────────────────────────────────────────
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--out-tag", default="v3lite_fixBF", help="Sufijo para archivos/layer de salida")
+    ap.add_argument("--workers", type=int, default=WORKERS, help="Procesos para la unión de B / particiones")
+    ap.add_argument("--by-mun", action="store_true", help="Particiona por MUN y calcula en paralelo")
+    ap.add_argument("--stream-footprints", action="store_true", help="Huellas en lotes Arrow (memoria acotada)")
+    ap.add_argument("--batch-size", type=int, default=STREAM_BATCH, help="Huellas por lote con --stream-footprints")
+    ap.add_argument("--incremental", action="store_true", help="Recalcula solo manzanas con entradas cambiadas")
+    args = ap.parse_args()
+
+    OUT_GPKG  = GWR_DIR / f"manzanas_master_con_GWR_spacematrix_{args.out_tag}.gpkg"
+    OUT_LAYER = f"manzanas_{args.out_tag}"
+    OUT_CSV   = GWR_DIR / f"manzanas_master_con_GWR_spacematrix_{args.out_tag}.csv"
+    FP_PATH   = GWR_DIR / f"spacematrix_fingerprints_{args.out_tag}.parquet"
+    qc_path   = GWR_DIR / f"qc_por_mun_{args.out_tag}.csv"
+    qc_pts_path = GWR_DIR / f"qc_puntos_rescate_{args.out_tag}.csv"
 
-    # 6) FLAGS + QC
-    manz["dq_flag"] = 0
-    manz.loc[(manz["sup_const_tot_m2"]<=0) & (manz["B_m2"]>0), "dq_flag"] = 1
-    manz.loc[(manz["sup_const_tot_m2"]>0) & (manz["B_m2"]<=0), "dq_flag"] = 2
-    manz.loc[(manz["sup_const_tot_m2"]<=0) & (manz["B_m2"]<=0), "dq_flag"] = 3
+    # 1) MANZANAS
+    print("Cargando manzanas…", flush=True)
+    manz = gpd.read_file(MANZ_GPKG).to_crs(CRS_METERS)
+    if "manzana_id" not in manz.columns:
+        manz = manz.reset_index(drop=False).rename(columns={"index":"manzana_id"})
+    manz = manz.reset_index(drop=True)
+
+    # 1b) INCREMENTAL: compara huellas de entrada y parcha solo las manzanas cambiadas
+    fp_new = None
+    if args.incremental:
+        print("Huellas de entrada por manzana…", flush=True)
+        fp_new = input_fingerprints(manz)
+    if fp_new is not None and FP_PATH.exists() and OUT_GPKG.exists() and OUT_CSV.exists():
+        changed = changed_manzanas(pd.read_parquet(FP_PATH), fp_new)
+        if changed is None:
+            print("⚠️ Cambió el conjunto o la geometría de manzanas → recálculo completo", flush=True)
+        else:
+            n_chg = int(changed.sum())
+            print(f"   · {n_chg} de {len(manz)} manzanas con entradas cambiadas", flush=True)
+            if n_chg:
+                xmin, ymin, xmax, ymax = manz.geometry[changed].total_bounds
+                bbox = (xmin - PARTITION_MARGIN, ymin - PARTITION_MARGIN, xmax + PARTITION_MARGIN, ymax + PARTITION_MARGIN)
+                res, qc_pts = compute_spacematrix(manz, own=changed, bbox=bbox, workers=args.workers,
+                                                  stream=args.stream_footprints, batch_size=args.batch_size)
+                cols = [c for c in res.columns if c not in manz.columns]
+                n_up = patch_gpkg_rows(OUT_GPKG, OUT_LAYER, res, cols)
+                print(f"→ {OUT_GPKG.name}: {n_up} filas actualizadas en sitio (layer {OUT_LAYER})", flush=True)
+
+                # CSV espejo y QC desde la tabla parchada (mismo orden de manzanas)
+                table = pd.read_csv(OUT_CSV)
+                rows = np.flatnonzero(changed)
+                for c in cols:  # pd.NA (capas de predios ausentes) → NaN para columnas float
+                    table.loc[rows, c] = pd.to_numeric(res[c], errors="coerce").to_numpy()
+                table.to_csv(OUT_CSV, index=False)
+                qc_por_mun(table).to_csv(qc_path, index=True)
+                # QC por punto: reemplaza los rescates de las manzanas recalculadas
+                if qc_pts_path.exists():
+                    old = pd.read_csv(qc_pts_path)
+                    keep = ~(old["manzana_id"].astype(str).isin(res["manzana_id"].astype(str)) |
+                             old["punto_fid"].isin(qc_pts["punto_fid"]))
+                    qc_pts = pd.concat([old[keep], qc_pts], ignore_index=True).sort_values("punto_fid")
+                qc_pts.to_csv(qc_pts_path, index=False)
+                print(f"→ {OUT_CSV.name}, {qc_path.name} y {qc_pts_path.name} reescritos", flush=True)
+            fp_new.to_parquet(FP_PATH, index=False)
+            print("Listo ✅  (incremental)")
+            sys.exit(0)
+
+    # 2–6) B, F, predios, indicadores y flags
+    if args.by_mun:
+        print(f"Modo particionado por MUN ({args.workers} procesos, margen {PARTITION_MARGIN} m)…", flush=True)
+        manz, qc_pts = compute_by_mun(manz, workers=args.workers, stream=args.stream_footprints,
+                                      batch_size=args.batch_size)
+    else:
+        manz, qc_pts = compute_spacematrix(manz, workers=args.workers, stream=args.stream_footprints,
+                                           batch_size=args.batch_size)
 
     qc = qc_por_mun(manz.drop(columns="geometry", errors="ignore"))
-    qc_path = GWR_DIR / f"qc_por_mun_{args.out_tag}.csv"
     qc.to_csv(qc_path, index=True)
     print(f"QC por municipio escrito en: {qc_path}", flush=True)
+    qc_pts.to_csv(qc_pts_path, index=False)
+    print(f"QC por punto ({len(qc_pts)} rescates) escrito en: {qc_pts_path}", flush=True)
 
     # 7) EXPORTAR
     print(f"→ Escribiendo {OUT_GPKG.name} (layer {OUT_LAYER})", flush=True)
     manz.to_file(OUT_GPKG, layer=OUT_LAYER, driver="GPKG")
     print(f"→ Escribiendo {OUT_CSV.name}", flush=True)
     manz.drop(columns="geometry").to_csv(OUT_CSV, index=False)
+    if fp_new is not None:
+        fp_new.to_parquet(FP_PATH, index=False)
     print("Listo ✅  (B por unión, F con rescates y QC)")
@@ -14,20 +14,41 @@ Salida: <BASE>/citywide_build/
       * predios_centroides
       * catastro_puntos
   - cdmx_catastro.csv                   # los mismos puntos pero en CSV para revisión rápida
+  - _cache_catastro/*.parquet           # caché tipada por archivo (clave = hash del contenido)
   - qc_catastro_columns.csv             # auditoría de columnas detectadas por archivo
-  - qc_sources.csv                      # auditoría de archivos leídos y conteos
+  - qc_sources.csv                      # auditoría de archivos leídos, conteos y dedup por alcaldía (incl. colapsos entre alcaldías)
+  - qc_geom_fix.csv                     # geometrías inválidas reparadas/descartadas por alcaldía
 
 Principios de eficiencia:
   - Sin Shapefile de salida (evita GeometryCollection y límites del driver SHP).
-  - Sin dissolve ni buffer(0) globales; solo limpieza mínima y selectiva.
+  - Sin dissolve ni buffer(0) globales; solo limpieza mínima y selectiva:
+    make_valid vectorizado, en bloques paralelos y solo sobre filas inválidas.
   - Lectura tolerante (CSV/Excel, comas decimales, alias de columnas, WGS84/UTM).
   - Reproyección única a EPSG:32614 solo cuando hace falta.
+  - Lectura concurrente de las 48 fuentes (pyogrio + Arrow en un pool de hilos);
+    cada worker normaliza su archivo y el hilo principal solo concatena.
+  - Escritura de capas en bloque vía Arrow (pyogrio.write_dataframe).
+  - CSV/XLSX → Parquet tipado en caché por hash: solo se re-parsea el archivo
+    que cambió, y solo las columnas lon/lat/F/T detectadas por alias.
+  - Deduplicación de puntos de catastro por celda de rejilla (UTM) antes de
+    escribirlos: menos entradas para los joins punto→manzana de Spacematrix.
 """
 
+import hashlib
+import os
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import pandas as pd
 import geopandas as gpd
 import numpy as np
+import pyogrio
+import shapely
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 
 # ============== RUTAS (AJUSTADAS A TU CASO) ==============
 BASE = Path(
@@ -40,11 +61,17 @@ OUT_DIR  = BASE / "citywide_build"
 OUT_DIR.mkdir(parents=True, exist_ok=True)
 
 OUT_GPKG = OUT_DIR / "cdmx_citywide.gpkg"
+CACHE_DIR = OUT_DIR / "_cache_catastro"
 CRS_METERS = 32614  # UTM14N
 
 # ============== PARÁMETROS LIGEROS ==============
-SKIP_GEOM_FIX = True        # True = más rápido; pon False si detectas geometrías inválidas
+SKIP_GEOM_FIX = False       # True = no valida ni repara (solo descarta geometrías nulas)
+FIX_CHUNK = 20000           # filas por bloque en validación/reparación paralela
 MAKE_CENTROIDS = True       # True = genera capa de centroides para futuros joins
+READ_WORKERS = min(16, (os.cpu_count() or 2) * 2)  # hilos de lectura (I/O + GDAL sin GIL)
+USE_CSV_CACHE = True        # False = ignora la caché Parquet y re-parsea todos los CSV/XLSX
+DEDUP_GRID_M = 0.5          # lado de celda (m) para colapsar puntos repetidos; None/0 = sin dedup
+DEDUP_RULE = "max"          # superficies del grupo: "max" | "sum" | "first"
 
 # ============== HELPERS ==============
 ALIAS_LON = ["longitud","longitude","lon","x","Lon","X"]
@@ -55,16 +82,81 @@ ALIAS_T   = ["superficie_terreno","sup_terreno","area_terreno","terreno"]
 
 
 def _fix_geom_min(g: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    """Limpieza mínima y selectiva (solo si SKIP_GEOM_FIX=False)."""
-    if SKIP_GEOM_FIX:
-        # Descarta nulos; mantiene lo demás tal cual
-        return g[g.geometry.notna()].copy()
-    g = g[g.geometry.notna()].copy()
-    if not g.is_valid.all():
-        bad = ~g.is_valid
-        g.loc[bad, "geometry"] = g.loc[bad, "geometry"].buffer(0)
-        g = g[g.geometry.notna()]
-    return g
+    """Descarta geometrías nulas (la reparación se hace en repair_geoms)."""
+    return g[g.geometry.notna()].copy()
+
+
+def _polygonal_only(geoms: np.ndarray) -> np.ndarray:
+    """
+    make_valid vectorizado conservando solo las partes poligonales.
+    Colecciones mixtas → MultiPolygon con sus polígonos; resultados sin
+    área (líneas/puntos) → None.
+    """
+    mv = shapely.make_valid(geoms)
+    tid = shapely.get_type_id(mv)
+    out = np.where(np.isin(tid, (3, 6)), mv, None)
+
+    coll = np.flatnonzero(tid == 7)  # GeometryCollection
+    if len(coll):
+        parts, idx = shapely.get_parts(mv[coll], return_index=True)
+        # un MultiPolygon dentro de la colección se abre a sus polígonos
+        sub, sidx = shapely.get_parts(parts, return_index=True)
+        sub_idx = idx[sidx]
+        keep = shapely.get_type_id(sub) == 3
+        if keep.any():
+            # shapely.multipolygons exige índices 0..k-1 sin huecos; una colección
+            # sin partes poligonales (p. ej. un predio colapsado a líneas/puntos)
+            # antes de otra con polígonos deja un hueco → se remapean a densos
+            u, dense = np.unique(sub_idx[keep], return_inverse=True)
+            polys = shapely.multipolygons(sub[keep], indices=dense)
+            out[coll[u]] = polys
+    out[shapely.is_empty(out)] = None
+    return out
+
+
+def repair_geoms(g: gpd.GeoDataFrame, pool, layer: str):
+    """
+    Valida en bloques paralelos (shapely libera el GIL) y repara solo las
+    filas inválidas con _polygonal_only. Las que no conservan área se
+    descartan. Devuelve (g_reparado, resumen por alcaldía).
+    """
+    geoms = g.geometry.to_numpy()
+    blocks = [geoms[i:i + FIX_CHUNK] for i in range(0, len(geoms), FIX_CHUNK)]
+    valid = np.concatenate(list(pool.map(shapely.is_valid, blocks))) if blocks else np.ones(0, bool)
+    bad = np.flatnonzero(~valid)
+
+    if len(bad):
+        blocks = [geoms[bad[i:i + FIX_CHUNK]] for i in range(0, len(bad), FIX_CHUNK)]
+        fixed = np.concatenate(list(pool.map(_polygonal_only, blocks)))
+        geoms = geoms.copy()
+        geoms[bad] = fixed
+        dropped = bad[pd.isna(fixed)]
+    else:
+        dropped = np.zeros(0, np.int64)
+
+    alc = g["alcaldia"].to_numpy()
+    summary = (pd.DataFrame({
+        "capa": layer,
+        "alcaldia": alc,
+        "invalidas": ~valid,
+        "descartadas": np.isin(np.arange(len(g)), dropped),
+    }).groupby(["capa", "alcaldia"], as_index=False)
+      .agg(n=("invalidas", "size"), invalidas=("invalidas", "sum"), descartadas=("descartadas", "sum")))
+    summary.insert(4, "reparadas", summary["invalidas"] - summary["descartadas"])
+
+    out = g.copy()
+    out["geometry"] = gpd.GeoSeries(geoms, index=g.index, crs=g.crs)
+    out = out.drop(index=g.index[dropped]).reset_index(drop=True)
+    return out, summary
+
+
+def _log_repair(summary: pd.DataFrame) -> None:
+    tot = summary[["invalidas", "reparadas", "descartadas"]].sum()
+    print(f"  · Reparación: {int(tot.invalidas)} inválidas → {int(tot.reparadas)} reparadas, "
+          f"{int(tot.descartadas)} descartadas", flush=True)
+    for r in summary[summary["invalidas"] > 0].itertuples():
+        print(f"     - {r.alcaldia}: {r.invalidas}/{r.n} inválidas "
+              f"({r.reparadas} reparadas, {r.descartadas} descartadas)", flush=True)
 
 
 def _name_from_stem(p: Path) -> str:
@@ -77,125 +169,294 @@ def _alcaldia_from_cat_shp(p: Path) -> str:
     return s.split("CATASTRO2021_")[-1]
 
 
-def _read_any_csv(p: Path) -> pd.DataFrame:
-    if p.suffix.lower() in (".xls", ".xlsx"):
-        return pd.read_excel(p)
-    return pd.read_csv(p)
-
-
-def _coerce_decimals(df: pd.DataFrame, cols: list) -> None:
-    for c in cols:
-        if c in df.columns and df[c].dtype == object:
-            df[c] = df[c].str.replace(",", ".", regex=False)
-
+CAT_COLS = ["longitud","latitud","sup_const_tot_m2","sup_terreno_tot_m2"]
+_NUM_RE = r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$"
+
+
+def _file_hash(p: Path, chunk: int = 1 << 20) -> str:
+    h = hashlib.blake2b(digest_size=10)
+    with open(p, "rb") as fh:
+        for block in iter(lambda: fh.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _parse_numeric(col, decimal_comma: bool = False) -> np.ndarray:
+    """
+    Parser numérico vectorizado (pyarrow.compute), equivalente a
+    pd.to_numeric(errors="coerce"). Con decimal_comma=True las cadenas
+    '19,43' se leen como 19.43. Lo no numérico queda como NaN.
+    """
+    if isinstance(col, pd.Series):
+        col = pa.array(col.astype("string") if col.dtype == object else col, from_pandas=True)
+    if isinstance(col, pa.ChunkedArray):
+        col = col.combine_chunks()
+    if pa.types.is_string(col.type) or pa.types.is_large_string(col.type):
+        col = pc.utf8_trim_whitespace(col)
+        if decimal_comma:
+            col = pc.replace_substring(col, ",", ".")
+        ok = pc.match_substring_regex(col, _NUM_RE)
+        col = pc.if_else(ok, col, pa.scalar(None, col.type))
+    return pc.cast(col, pa.float64()).to_numpy(zero_copy_only=False)
+
+
+def _parse_catastro(p: Path):
+    """
+    Lee solo el encabezado + las columnas lon/lat/F/T (por alias) de un CSV/XLSX.
+    Devuelve (columnas_originales, DataFrame CAT_COLS | None si no hay coords).
+    """
+    excel = p.suffix.lower() in (".xls", ".xlsx")
+    cols = list((pd.read_excel(p, nrows=0) if excel else pd.read_csv(p, nrows=0)).columns)
+
+    lon = next((c for c in ALIAS_LON if c in cols), None)
+    lat = next((c for c in ALIAS_LAT if c in cols), None)
+    F   = next((c for c in ALIAS_F   if c in cols), None)
+    T   = next((c for c in ALIAS_T   if c in cols), None)
+    if not (lon and lat):
+        return cols, None
 
-# ============== 1) UNIR ALCALDÍAS (polígonos) ==============
-print("[1/4] Unificando polígonos de alcaldías…")
-rows = []
-for shp in sorted(ALC_SHPS.glob("*.shp")):
-    g = gpd.read_file(shp)
+    use = list(dict.fromkeys(c for c in (lon, lat, F, T) if c))
+    if excel:
+        df = pd.read_excel(p, usecols=use)
+        get = lambda c: df[c]
+    else:
+        tab = pacsv.read_csv(p, convert_options=pacsv.ConvertOptions(include_columns=use))
+        get = lambda c: tab.column(c)
+
+    n = len(df) if excel else tab.num_rows
+    out = pd.DataFrame({
+        # separador decimal ',' solo en coordenadas (como en la versión previa)
+        "longitud": _parse_numeric(get(lon), decimal_comma=True),
+        "latitud":  _parse_numeric(get(lat), decimal_comma=True),
+        "sup_const_tot_m2": _parse_numeric(get(F)) if F else np.full(n, np.nan),
+        "sup_terreno_tot_m2": _parse_numeric(get(T)) if T else np.full(n, np.nan),
+    })
+    # descarta registros sin coord
+    out = out.dropna(subset=["longitud","latitud"]).reset_index(drop=True)
+    return cols, out
+
+
+def _read_catastro_cached(p: Path):
+    """
+    _parse_catastro con caché Parquet por archivo. La clave es el hash del
+    contenido, así que un archivo modificado invalida solo su propia entrada.
+    """
+    if not USE_CSV_CACHE:
+        return _parse_catastro(p)
+    key = _file_hash(p)
+    cp = CACHE_DIR / f"{p.name}.{key}.parquet"
+    if cp.exists():
+        try:
+            t = pq.read_table(cp)
+            meta = t.schema.metadata
+            cols = meta[b"columnas"].decode("utf-8").split("\x1f") if meta[b"columnas"] else []
+            return cols, (t.to_pandas() if meta[b"coord"] == b"1" else None)
+        except Exception:
+            pass  # caché corrupta → se re-parsea
+
+    cols, out = _parse_catastro(p)
+    t = pa.Table.from_pandas(
+        out if out is not None else pd.DataFrame({c: np.empty(0) for c in CAT_COLS}),
+        preserve_index=False,
+    ).replace_schema_metadata({
+        "columnas": "\x1f".join(map(str, cols)),
+        "coord": "1" if out is not None else "0",
+    })
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    for old in CACHE_DIR.glob(f"{p.name}.*.parquet"):
+        old.unlink(missing_ok=True)
+    tmp = cp.with_suffix(f".{os.getpid()}.tmp")
+    pq.write_table(t, tmp)
+    os.replace(tmp, cp)
+    return cols, out
+
+
+def _read_shp_geoms(shp: Path) -> gpd.GeoDataFrame:
+    """Lee solo la geometría vía pyogrio/Arrow y la lleva a EPSG:32614."""
+    g = gpd.read_file(shp, engine="pyogrio", use_arrow=True, columns=[])
     if g.crs is None:
         g = g.set_crs(CRS_METERS)
     g = g.to_crs(CRS_METERS)
     g = _fix_geom_min(g)
-    g = g[["geometry"]].copy()
+    return g[["geometry"]].copy()
+
+
+def _load_alcaldia(shp: Path) -> gpd.GeoDataFrame:
+    g = _read_shp_geoms(shp)
     g["alcaldia"] = _name_from_stem(shp)
-    rows.append(g)
+    return g
+
+
+def _load_predios(shp: Path):
+    """Devuelve (GeoDataFrame, None) o (None, error) para reportar desde el hilo principal."""
+    try:
+        g = _read_shp_geoms(shp)
+    except Exception as e:
+        return None, e
+    g["alcaldia"] = _alcaldia_from_cat_shp(shp)
+    return g, None
+
+
+def _load_catastro(f: Path):
+    """
+    Lee y normaliza un CSV/XLSX de catastro con los ALIAS_*.
+    Devuelve (tmp | None, fila_auditoría | None, aviso | None).
+    """
+    try:
+        cols, tmp = _read_catastro_cached(f)
+    except Exception as e:
+        return None, None, f"  ⚠ no se pudo leer: {f.name} → {e}"
+    # auditoría de columnas
+    audit = {"archivo": f.name, "columnas": ",".join(sorted(map(str, cols)))}
+
+    if tmp is None:
+        return None, audit, f"  ⚠ sin columnas de coord: {f.name}"
+
+    tmp["alcaldia"] = f.stem.split("-catastro")[0].upper().replace("-", "_")
+    return tmp, audit, None
+
+
+def _alc_key(names) -> np.ndarray:
+    """Nombre de alcaldía comparable entre fuentes (mayúsculas, sin acentos, '_' como separador)."""
+    out = []
+    for n in names:
+        n = unicodedata.normalize("NFKD", str(n)).encode("ascii", "ignore").decode()
+        out.append(re.sub(r"[^A-Z0-9]+", "_", n.upper()).strip("_"))
+    return np.array(out, dtype=object)
+
+
+def dedup_points(g: gpd.GeoDataFrame, grid: float, rule: str = "max", g_alc: gpd.GeoDataFrame = None):
+    """
+    Colapsa puntos exactos o casi coincidentes: cada punto se ajusta a la
+    celda más cercana de una rejilla de lado `grid` (m, en CRS métrico) y se
+    conserva un registro por celda (con su alcaldía y coordenadas). Las
+    superficies del grupo se combinan con `rule`: "max", "sum" (NaN si todo
+    el grupo es NaN) o "first".
+    Registro conservado: el de la alcaldía cuyo polígono (`g_alc`) contiene la
+    celda; si ninguno coincide (o no hay polígonos), el primero en el orden
+    original. Así el desempate entre alcaldías vecinas no depende del orden
+    de lectura de los archivos.
+    Devuelve (g_dedup, removidos_por_alcaldía, removidos_a_favor_de_otra_alcaldía).
+    """
+    if rule not in ("max", "sum", "first"):
+        raise ValueError(f"DEDUP_RULE no soportada: {rule!r}")
+    if len(g) == 0:
+        return g, pd.Series(dtype="int64"), pd.Series(dtype="int64")
+
+    ix = np.round(g.geometry.x.to_numpy() / grid).astype(np.int64)
+    iy = np.round(g.geometry.y.to_numpy() / grid).astype(np.int64)
+    ix -= ix.min()
+    iy -= iy.min()
+    key = ix * (int(iy.max()) + 1) + iy
+    _, inv, size = np.unique(key, return_inverse=True, return_counts=True)
+
+    # Solo en celdas con >1 registro: ¿la alcaldía del registro es la del polígono que lo contiene?
+    alc = _alc_key(g["alcaldia"])
+    home_ok = np.zeros(len(g), dtype=bool)
+    multi = np.flatnonzero(size[inv] > 1)
+    if g_alc is not None and len(g_alc) and multi.size:
+        ip, ia = g_alc.sindex.query(g.geometry.to_numpy()[multi], predicate="within")
+        home_ok[multi[ip]] = alc[multi[ip]] == _alc_key(g_alc["alcaldia"].to_numpy()[ia])
+
+    # Orden: celda, luego coincidencia con el polígono, luego posición original
+    order = np.lexsort((np.arange(len(g)), ~home_ok, inv))
+    first = order[np.r_[True, inv[order][1:] != inv[order][:-1]]]
+
+    keep = np.sort(first)
+    out = g.iloc[keep].copy()
+    if rule != "first":
+        cols = ["sup_const_tot_m2", "sup_terreno_tot_m2"]
+        vals = g[cols].apply(pd.to_numeric, errors="coerce").groupby(inv)
+        agg = vals.max() if rule == "max" else vals.sum(min_count=1)
+        out[cols] = agg.to_numpy()[inv[keep]]
+
+    removed = (g["alcaldia"].value_counts()
+               .sub(out["alcaldia"].value_counts(), fill_value=0)
+               .astype("int64"))
+    keeper_alc = np.empty(size.size, dtype=object)
+    keeper_alc[inv[first]] = alc[first]
+    lost = np.ones(len(g), dtype=bool)
+    lost[first] = False
+    cross_mask = lost & (alc != keeper_alc[inv])
+    cross = g["alcaldia"][cross_mask].value_counts().astype("int64")
+    return out.reset_index(drop=True), removed, cross
+
+
+def _write_layer(g: gpd.GeoDataFrame, layer: str) -> None:
+    """Escritura en bloque vía Arrow; sobrescribe la capa si ya existe."""
+    pyogrio.write_dataframe(g, OUT_GPKG, layer=layer, driver="GPKG", use_arrow=True)
+
+
+# ============== 0) LECTURA CONCURRENTE ==============
+# Se encolan las tres familias de archivos a la vez; ex.map conserva el orden
+# de entrada, así que la concatenación es idéntica a la lectura secuencial.
+print(f"[0/4] Leyendo fuentes en paralelo ({READ_WORKERS} hilos)…", flush=True)
+ex = ThreadPoolExecutor(max_workers=READ_WORKERS)
+res_alc  = ex.map(_load_alcaldia, sorted(ALC_SHPS.glob("*.shp")))
+res_pred = ex.map(_load_predios,  sorted(CAT_SHPS.glob("catastro2021_*.shp")))
+res_cat  = ex.map(_load_catastro, sorted(CAT_CSVS.glob("*-catastro.*")))
+
+# ============== 1) UNIR ALCALDÍAS (polígonos) ==============
+print("[1/4] Unificando polígonos de alcaldías…")
+rows = list(res_alc)
 
 if rows:
     g_alc = gpd.GeoDataFrame(pd.concat(rows, ignore_index=True), crs=CRS_METERS)
 else:
     g_alc = gpd.GeoDataFrame(columns=["geometry","alcaldia"], crs=CRS_METERS)
 
-g_alc.to_file(OUT_GPKG, layer="alcaldias", driver="GPKG")
+qc_fix = []
+if not SKIP_GEOM_FIX:
+    g_alc, summ = repair_geoms(g_alc, ex, "alcaldias")
+    _log_repair(summ)
+    qc_fix.append(summ)
+
+_write_layer(g_alc, "alcaldias")
 print(f"  → alcaldías: {len(g_alc)} features | capa 'alcaldias' en {OUT_GPKG}")
 
 # ============== 2) UNIR PREDIOS (polígonos) ==============
 print("[2/4] Unificando predios (catastro2021_*.shp)…")
 rows = []
-for shp in sorted(CAT_SHPS.glob("catastro2021_*.shp")):
-    try:
-        g = gpd.read_file(shp)
-    except Exception as e:
-        print("  ⚠ no se pudo leer:", shp.name, "→", e)
+for shp, (g, err) in zip(sorted(CAT_SHPS.glob("catastro2021_*.shp")), res_pred):
+    if err is not None:
+        print("  ⚠ no se pudo leer:", shp.name, "→", err)
         continue
-    if g.crs is None:
-        g = g.set_crs(CRS_METERS)
-    g = g.to_crs(CRS_METERS)
-    g = _fix_geom_min(g)
-    g = g[["geometry"]].copy()
-    g["alcaldia"] = _alcaldia_from_cat_shp(shp)
     rows.append(g)
 
 g_pred = gpd.GeoDataFrame(pd.concat(rows, ignore_index=True), crs=CRS_METERS) if rows else \
          gpd.GeoDataFrame(columns=["geometry","alcaldia"], crs=CRS_METERS)
 
-g_pred.to_file(OUT_GPKG, layer="predios", driver="GPKG")
+if not SKIP_GEOM_FIX:
+    g_pred, summ = repair_geoms(g_pred, ex, "predios")
+    _log_repair(summ)
+    qc_fix.append(summ)
+
+_write_layer(g_pred, "predios")
 print(f"  → predios: {len(g_pred)} features | capa 'predios'")
 
 if MAKE_CENTROIDS and len(g_pred) > 0:
     print("  · Calculando centroides de predios…")
     g_cent = g_pred.copy()
     g_cent["geometry"] = g_cent.geometry.centroid
-    g_cent.to_file(OUT_GPKG, layer="predios_centroides", driver="GPKG")
+    _write_layer(g_cent, "predios_centroides")
     print("    → capa 'predios_centroides' lista")
 
 # ============== 3) UNIR CATASTRO (CSV/XLSX) ==============
 print("[3/4] Unificando CSV/XLSX de catastro (puntos con superficies)…")
 rows, audit = [], []
-for f in sorted(CAT_CSVS.glob("*-catastro.*")):
-    try:
-        df = _read_any_csv(f)
-    except Exception as e:
-        print("  ⚠ no se pudo leer:", f.name, "→", e)
-        continue
-    # auditoría de columnas
-    audit.append({"archivo": f.name, "columnas": ",".join(sorted(map(str, df.columns)))})
-
-    # normalización de separador decimal
-    _coerce_decimals(df, ALIAS_LON + ALIAS_LAT)
-
-    lon = next((c for c in ALIAS_LON if c in df.columns), None)
-    lat = next((c for c in ALIAS_LAT if c in df.columns), None)
-    F   = next((c for c in ALIAS_F   if c in df.columns), None)
-    T   = next((c for c in ALIAS_T   if c in df.columns), None)
-
-    if not (lon and lat):
-        print("  ⚠ sin columnas de coord:", f.name)
-        continue
-
-    tmp = pd.DataFrame({
-        "longitud": pd.to_numeric(df[lon], errors="coerce"),
-        "latitud":  pd.to_numeric(df[lat], errors="coerce"),
-        "sup_const_tot_m2": pd.to_numeric(df[F], errors="coerce") if F else pd.NA,
-        "sup_terreno_tot_m2": pd.to_numeric(df[T], errors="coerce") if T else pd.NA,
-    })
-    tmp["alcaldia"] = f.stem.split("-catastro")[0].upper().replace("-", "_")
-
-    # descarta registros sin coord
-    tmp = tmp.dropna(subset=["longitud","latitud"]).reset_index(drop=True)
-
-    rows.append(tmp)
+for tmp, aud, msg in res_cat:
+    if aud is not None:
+        audit.append(aud)
+    if msg:
+        print(msg)
+    if tmp is not None:
+        rows.append(tmp)
+ex.shutdown()
 
 cat_all = pd.concat(rows, ignore_index=True) if rows else \
           pd.DataFrame(columns=["longitud","latitud","sup_const_tot_m2","sup_terreno_tot_m2","alcaldia"])
 
-# Auditorías
-pd.DataFrame(audit).to_csv(OUT_DIR/"qc_catastro_columns.csv", index=False)
-(pd.DataFrame({
-    "fuente": ["alcaldias_shp","catastro_alcaldias_shp","catastro_alcaldias_cvs"],
-    "archivos_leidos": [len(list(ALC_SHPS.glob('*.shp'))),
-                         len(list(CAT_SHPS.glob('catastro2021_*.shp'))),
-                         len(list(CAT_CSVS.glob('*-catastro.*')))],
-}).assign(reg_catastro=len(cat_all))).to_csv(OUT_DIR/"qc_sources.csv", index=False)
-
-# Guardar CSV plano
-out_csv = OUT_DIR / "cdmx_catastro.csv"
-cat_all.to_csv(out_csv, index=False)
-print(f"  → catastro: {len(cat_all)} registros | {out_csv}")
-
-# Guardar puntos en GPKG reproyectados a 32614
-print("  · Generando capa 'catastro_puntos' en el GPKG…")
+# Puntos reproyectados a 32614 (se usan para dedup y para el GPKG)
 g_cat = gpd.GeoDataFrame(
     cat_all,
     geometry=gpd.points_from_xy(cat_all["longitud"], cat_all["latitud"]),
@@ -210,7 +471,55 @@ try:
 except Exception:
     g_cat = g_cat.to_crs(CRS_METERS)
 
-g_cat.to_file(OUT_GPKG, layer="catastro_puntos", driver="GPKG")
+# Dedup por rejilla (duplicados entre alcaldías vecinas y registros repetidos)
+n_bruto = g_cat["alcaldia"].value_counts()
+if DEDUP_GRID_M:
+    g_cat, removed, cross = dedup_points(g_cat, DEDUP_GRID_M, DEDUP_RULE, g_alc)
+    print(f"  · Dedup ({DEDUP_GRID_M} m, regla '{DEDUP_RULE}'): "
+          f"{int(removed.sum())} puntos colapsados de {int(n_bruto.sum())} "
+          f"({int(cross.sum())} a favor de otra alcaldía)", flush=True)
+    vacias = sorted(a for a in n_bruto.index if n_bruto[a] > 0 and removed.get(a, 0) >= n_bruto[a])
+    if vacias:
+        print(f"  ⚠ Alcaldías sin puntos tras el dedup (todos coinciden con otra fuente): {vacias}")
+else:
+    removed = pd.Series(0, index=n_bruto.index, dtype="int64")
+    cross = pd.Series(dtype="int64")
+cat_all = pd.DataFrame(g_cat.drop(columns="geometry"))
+
+# Auditorías
+pd.DataFrame(audit).to_csv(OUT_DIR/"qc_catastro_columns.csv", index=False)
+qc_src = pd.DataFrame({
+    "fuente": ["alcaldias_shp","catastro_alcaldias_shp","catastro_alcaldias_cvs"],
+    "archivos_leidos": [len(list(ALC_SHPS.glob('*.shp'))),
+                         len(list(CAT_SHPS.glob('catastro2021_*.shp'))),
+                         len(list(CAT_CSVS.glob('*-catastro.*')))],
+}).assign(reg_catastro=len(cat_all))
+qc_dedup = pd.DataFrame({
+    "fuente": "dedup_catastro",
+    "alcaldia": n_bruto.index,
+    "reg_catastro_bruto": n_bruto.to_numpy(),
+    "dedup_removidos": removed.reindex(n_bruto.index, fill_value=0).to_numpy(),
+    "dedup_otra_alcaldia": cross.reindex(n_bruto.index, fill_value=0).to_numpy(),
+}).sort_values("alcaldia")
+qc_dedup["reg_catastro"] = qc_dedup["reg_catastro_bruto"] - qc_dedup["dedup_removidos"]
+# Filas por fuente: solo archivos y total final; los conteos de dedup van por alcaldía
+qc = pd.concat([qc_src, qc_dedup], ignore_index=True).astype(
+    {c: "Int64" for c in ["archivos_leidos","reg_catastro_bruto","dedup_removidos","dedup_otra_alcaldia"]})
+qc = qc[["fuente","alcaldia","archivos_leidos","reg_catastro","reg_catastro_bruto",
+         "dedup_removidos","dedup_otra_alcaldia"]]
+qc.to_csv(OUT_DIR/"qc_sources.csv", index=False)
+
+if qc_fix:
+    pd.concat(qc_fix, ignore_index=True).to_csv(OUT_DIR/"qc_geom_fix.csv", index=False)
+
+# Guardar CSV plano
+out_csv = OUT_DIR / "cdmx_catastro.csv"
+cat_all.to_csv(out_csv, index=False)
+print(f"  → catastro: {len(cat_all)} registros | {out_csv}")
+
+# Guardar puntos en GPKG
+print("  · Generando capa 'catastro_puntos' en el GPKG…")
+_write_layer(g_cat, "catastro_puntos")
 print(f"    → capa 'catastro_puntos' lista en {OUT_GPKG}")
 
 print("[4/4] Hecho ✅  (GPKG unificado + CSV + auditorías)")
@@ -20,6 +20,7 @@ Salidas
 - **Nuevo GPKG** por corrida: `analisis_final_tipologias_prioridad_YYYYMMDD_HHMM.gpkg` (sin mezclar con el original).
 - **Nombre de capa** con sello de tiempo: `prioridad_SMxSS_YYYYMMDD_HHMM`.
 - **CSVs** con el mismo sello: `…_prioridad_YYYYMMDD_HHMM_manzanas.csv`, `…_prioridad_YYYYMMDD_HHMM_tipologias_hotcat_rank.csv`, `…_prioridad_YYYYMMDD_HHMM_thresholds.csv`, `…_prioridad_YYYYMMDD_HHMM_candidatas_global.csv`.
+- **Barrido** (`RUN_SWEEP=True`): `…_sweep_YYYYMMDD_HHMM.csv` (un renglón por escenario: conteos, zonas, Jaccard vs. referencia) y `…_sweep_YYYYMMDD_HHMM.npz` (bitsets de manzanas seleccionadas por escenario).
 
 Ajustes rápidos
 ---------------
@@ -37,10 +38,17 @@ Ajustes rápidos
 from __future__ import annotations
 from pathlib import Path
 from datetime import datetime
+import itertools
+import os
 import sys
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import pyarrow as pa
+import pyogrio
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 # =============== PARAMS ======================================================
 # Modo rápido: priorizar SOLO por Space Syntax (ignora tipologías y hot_cat en la selección)
@@ -82,7 +90,7 @@ MAX_PER_TYP_PER_ALC = 20      # tope por tipología dentro de cada alcaldía en
 SYNTAX_W_500   = 2.0     # peso para 500 m (peatonal)
 SYNTAX_W_1500  = 1.0     # peso para 1500 m (zona)
 TOP_PCT_COMPOSITE = 0.20  # selecciona top 20% por score compuesto (ajusta a 0.30 si quieres más)
-# Clustering espacial para formar ZONAS (disolver manzanas cercanas)
+# Clustering espacial para formar ZONAS (componentes conexas: manzanas a ≤ 2·buffer)
 ZONES_BUFFER_M   = 25.0  # buffer para unir vecinos (CRS métrico)
 ZONES_MIN_MANZ   = 8     # mínimo de manzanas por zona
 ZONES_TOP_K      = 50    # máximo de zonas a guardar (ordenadas por score medio y tamaño)
@@ -91,6 +99,25 @@ ZONES_TOP_K      = 50    # máximo de zonas a guardar (ordenadas por score medio
 OUT_LAYER_NAME = "prioridad_SMxSS"
 WRITE_TO_NEW_GPKG = True  # True -> escribe SIEMPRE a un GPKG nuevo con sello de tiempo  # True -> escribe a *_prioridad.gpkg
 
+# Barrido de escenarios: evalúa la rejilla (producto cartesiano) en un solo proceso,
+# con z-scores/percentiles calculados una vez, y termina sin escribir capas.
+# El escenario de referencia ("ref") son los PARAMS de arriba.
+RUN_SWEEP = False
+SWEEP_GRID_SYNTAX = {            # modo SOLO Syntax
+    "SYNTAX_W_500":      [1.0, 2.0, 3.0],
+    "SYNTAX_W_1500":     [0.5, 1.0],
+    "TOP_PCT_COMPOSITE": [0.15, 0.20, 0.30],
+}
+SWEEP_GRID_TYPO = {              # modo tipologías × movilidad
+    "HOT_WEIGHT_2":        [1.0, 2.0, 3.0],
+    "HOT_WEIGHT_1":        [0.5, 1.0],
+    "TOP_FRAC_500":        [0.10, 0.20, 0.30],
+    "TOP_FRAC_1500":       [0.10, 0.20, 0.30],
+    "QUOTA_PER_ALC":       [20, 40],
+    "UNION_QUOTA_PER_ALC": [60, 120],
+    "MAX_PER_TYP_PER_ALC": [10, 20],
+}
+
 # =============== HELPERS =====================================================
 
 def list_layers_safe(gpkg: Path):
@@ -99,7 +126,7 @@ def list_layers_safe(gpkg: Path):
         return fiona.listlayers(gpkg)
     except Exception:
         from pyogrio import list_layers
-        return list_layers(gpkg)
+        return [name for name, _ in list_layers(gpkg)]
 
 def pick_layer_by_columns(gpkg: Path, prefer: str | None = None):
     layers = list_layers_safe(gpkg)
@@ -140,21 +167,129 @@ def pct_rank(series: pd.Series) -> pd.Series:
     x = pd.to_numeric(series, errors="coerce")
     return 100.0 * x.rank(pct=True, method="average")
 
-def write_layer_safely(gdf: gpd.GeoDataFrame, out_gpkg: Path, layer_name: str) -> Path:
-    import fiona
-    # quita capa previa si existe en este archivo destino
+SORT_KEYS = ["priority_score", "rank_500_pct", "rank_1500_pct"]
+
+def sort_priority(df: pd.DataFrame, extra: list[str] | None = None) -> pd.DataFrame:
+    """Orden estable por prioridad (desc); `extra` = columnas previas en orden asc."""
+    extra = extra or []
+    return df.sort_values(extra + SORT_KEYS, ascending=[True]*len(extra) + [False]*len(SORT_KEYS),
+                          kind="stable")
+
+def cap_per_group(df: pd.DataFrame, by: list[str], cap: int) -> np.ndarray:
+    """
+    Máscara de cupo: conserva las primeras `cap` filas de cada grupo `by`
+    en el orden actual de `df` (cumcount tras un solo sort). Filas con
+    llave nula quedan fuera, como en groupby.
+    """
+    keys_ok = df[by].notna().all(axis=1).to_numpy()
+    return keys_ok & (df.groupby(by, sort=False, dropna=False).cumcount().to_numpy() < cap)
+
+def zone_pairs(geoms: np.ndarray, buffer_m: float):
+    """Aristas (i, j) del grafo "a ≤ 2·buffer_m" (equivale a que sus buffers se toquen)."""
+    return shapely.STRtree(geoms).query(geoms, predicate="dwithin", distance=2.0 * buffer_m)
+
+def zone_components(n: int, i: np.ndarray, j: np.ndarray, ok: np.ndarray) -> np.ndarray:
+    """
+    Componentes conexas dispersas sobre las aristas (i, j). Devuelve zone_id
+    (1..k, en orden de primera aparición) por nodo; NaN donde ok=False.
+    """
+    adj = coo_matrix((np.ones(len(i), dtype=bool), (i, j)), shape=(n, n))
+    _, lab = connected_components(adj, directed=False)
+    # renumera en orden de primera aparición, solo con geometrías válidas
+    _, first, inv = np.unique(lab[ok], return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(1, len(first) + 1)
+    out = np.full(n, np.nan)
+    out[ok] = rank[inv]
+    return out
+
+def zone_labels(geoms: np.ndarray, buffer_m: float) -> np.ndarray:
+    """
+    Zonas como componentes conexas del grafo "a ≤ 2·buffer_m": un solo
+    STRtree.query(dwithin) + componentes conexas; sin unary_union global.
+    NaN para geometrías nulas/vacías.
+    """
+    i, j = zone_pairs(geoms, buffer_m)
+    ok = ~(shapely.is_missing(geoms) | shapely.is_empty(geoms))
+    return zone_components(len(geoms), i, j, ok)
+
+def zone_geoms(geoms: np.ndarray, zone_id: np.ndarray, keep: np.ndarray, buffer_m: float) -> np.ndarray:
+    """Geometría (unión de buffers) solo para las zonas en `keep`."""
+    out = []
+    for z in keep:
+        with np.errstate(all="ignore"):
+            out.append(shapely.union_all(shapely.buffer(geoms[zone_id == z], buffer_m, quad_segs=16)))
+    return np.array(out, dtype=object)
+
+def sweep_scenarios(grid: dict) -> list[dict]:
+    """Escenario de referencia (PARAMS actuales) + producto cartesiano de `grid`."""
+    ref = {k: globals()[k] for k in grid}
+    out = [ref]
+    for combo in itertools.product(*grid.values()):
+        sc = dict(zip(grid, combo))
+        if sc != ref:
+            out.append(sc)
+    return out
+
+def write_sweep(rows: list[dict], masks: list[np.ndarray], ids: pd.Series, out_stem: Path) -> pd.DataFrame:
+    """
+    Resumen por escenario (CSV) + bitsets de manzanas seleccionadas (NPZ,
+    np.packbits sobre el orden de filas de la capa de entrada). La
+    superposición con la referencia se mide como Jaccard sobre los bitsets.
+    """
+    bits = np.packbits(np.asarray(masks, dtype=bool), axis=1)
+    popcount = lambda b: np.unpackbits(b, axis=1).sum(axis=1)
+    inter = popcount(bits & bits[0])
+    union = popcount(bits | bits[0])
+    res = pd.DataFrame(rows)
+    res.insert(0, "scenario", ["ref"] + [f"s{i:03d}" for i in range(1, len(rows))])
+    res["n_bitset"] = popcount(bits)
+    res["inter_ref"] = inter
+    res["jaccard_ref"] = np.where(union > 0, inter / np.maximum(union, 1), np.nan)
+    res.to_csv(out_stem.with_name(out_stem.name + ".csv"), index=False)
+    np.savez_compressed(out_stem.with_name(out_stem.name + ".npz"),
+                        bits=bits, n=len(ids), ids=ids.astype(str).to_numpy(dtype=str),
+                        scenario=res["scenario"].to_numpy(dtype=str))
+    print(f"✅ Barrido: {len(res)} escenarios → {out_stem.name}.csv / .npz")
+    return res
+
+def _ogr_geom_type(g: gpd.GeoDataFrame) -> str:
+    t = set(g.geom_type.dropna().unique())
+    return t.pop() if len(t) == 1 else "Unknown"
+
+def write_run(out_gpkg: Path, layers: list, tables: list = ()) -> Path:
+    """
+    Escribe todas las salidas de la corrida de una sola vez.
+      layers: [(nombre_capa, GeoDataFrame, csv | None)] → capa GPKG (si no está
+              vacía) + espejo CSV sin geometría.
+      tables: [(DataFrame, csv)] → solo CSV.
+    Las capas se escriben vía Arrow en un GPKG temporal (GDAL crea el índice
+    espacial al final de cada carga masiva) que se publica con os.replace; si
+    algo falla se borra el temporal y no se escribe ningún CSV. Los CSV NO
+    salen de las tablas Arrow: se escriben con pandas.to_csv desde los mismos
+    DataFrames (mismo formato que antes), solo después de publicar el GPKG.
+    """
+    tmp = out_gpkg.with_name(out_gpkg.stem + ".tmp.gpkg")
+    tmp.unlink(missing_ok=True)
     try:
-        if out_gpkg.exists():
-            layers_now = fiona.listlayers(out_gpkg)
-            if layer_name in layers_now:
-                fiona.remove(out_gpkg, layer=layer_name, driver="GPKG")
-    except Exception as e:
-        print("⚠️ No pude eliminar capa previa:", e)
-    # escribe y verifica
-    gdf.to_file(out_gpkg, layer=layer_name, driver="GPKG")
-    layers_final = fiona.listlayers(out_gpkg)
-    assert layer_name in layers_final, f"No encuentro la capa '{layer_name}' tras escribir."
-    print(f"✅ Escrito: {out_gpkg.name} / capa '{layer_name}' ({len(gdf)} filas)")
+        for name, g, _ in layers:
+            if not len(g):
+                continue
+            t = pa.table(g.to_arrow(index=False, geometry_encoding="WKB"))
+            pyogrio.write_arrow(t, tmp, layer=name, driver="GPKG",
+                                geometry_name=g.geometry.name, geometry_type=_ogr_geom_type(g),
+                                crs=g.crs.to_wkt() if g.crs else None)
+            print(f"✅ Capa: {out_gpkg.name} / '{name}' ({len(g)} filas)")
+        if tmp.exists():
+            os.replace(tmp, out_gpkg)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+    for _, g, csv in layers:
+        if csv is not None:
+            pd.DataFrame(g.drop(columns=g.geometry.name)).to_csv(csv, index=False)
+    for df, csv in tables:
+        df.to_csv(csv, index=False)
     return out_gpkg
 
 # =============== MAIN ========================================================
@@ -183,6 +318,50 @@ if __name__ == "__main__":
 
         gdf["mob_500"]  = zscore(gdf[col_NAIN_500]) + zscore(gdf[col_NACH_500])
         gdf["mob_1500"] = zscore(gdf[col_NAIN_1500]) + zscore(gdf[col_NACH_1500])
+
+        # ---- Barrido de escenarios (z-scores y grafo de vecindad una sola vez) ----
+        if RUN_SWEEP:
+            print("→ Barrido de escenarios (SOLO Syntax)…")
+            mob5, mob15 = gdf["mob_500"].to_numpy(), gdf["mob_1500"].to_numpy()
+            try:
+                metric_crs = gdf.estimate_utm_crs()
+            except Exception:
+                metric_crs = "EPSG:3857"
+            geoms_all = gdf.to_crs(metric_crs).geometry.to_numpy()
+            # el grafo entre seleccionadas es el subgrafo inducido del grafo global
+            I, J = zone_pairs(geoms_all, ZONES_BUFFER_M)
+            ok_all = ~(shapely.is_missing(geoms_all) | shapely.is_empty(geoms_all))
+            ranks, rows, masks = {}, [], []
+            for sc in sweep_scenarios(SWEEP_GRID_SYNTAX):
+                w = (sc["SYNTAX_W_500"], sc["SYNTAX_W_1500"])
+                if w not in ranks:
+                    score = w[0]*mob5 + w[1]*mob15
+                    ranks[w] = (score, pct_rank(pd.Series(score)).to_numpy())
+                score, rk = ranks[w]
+                m = rk >= 100.0*(1.0 - sc["TOP_PCT_COMPOSITE"])
+                idx = np.flatnonzero(m)
+                pos = np.full(len(m), -1)
+                pos[idx] = np.arange(len(idx))
+                e = m[I] & m[J]
+                zid = zone_components(len(idx), pos[I[e]], pos[J[e]], ok_all[idx])
+                agg = (pd.DataFrame({"zone_id": zid, "syntax_score": score[idx]})
+                         .dropna(subset=["zone_id"])
+                         .groupby("zone_id")
+                         .agg(n_manz=("syntax_score", "size"), syntax_score_mean=("syntax_score", "mean"))
+                         .reset_index())
+                valid = agg[agg["n_manz"] >= ZONES_MIN_MANZ]
+                top = valid.sort_values(["syntax_score_mean","n_manz"], ascending=[False, False]).head(ZONES_TOP_K)
+                keep = np.zeros(len(m), dtype=bool)
+                keep[idx[np.isin(zid, top["zone_id"].to_numpy())]] = True
+                masks.append(keep)
+                rows.append({**sc, "n_sel": len(idx), "n_zonas": len(agg),
+                             "n_zonas_min": len(valid), "n_zonas_top": len(top),
+                             "n_manz_zonas": int(keep.sum())})
+            RUN_TAG = datetime.now().strftime("%Y%m%d_%H%M")
+            write_sweep(rows, masks, gdf[col_id],
+                        INPUT_GPKG.with_name(INPUT_GPKG.stem + f"_syntaxONLY_sweep_{RUN_TAG}"))
+            sys.exit(0)
+
         gdf["syntax_score"] = SYNTAX_W_500*gdf["mob_500"] + SYNTAX_W_1500*gdf["mob_1500"]
         gdf["syntax_rank_pct"] = pct_rank(gdf["syntax_score"])  # 0-100
         thr_comp = 100.0*(1.0 - TOP_PCT_COMPOSITE)
@@ -195,36 +374,30 @@ if __name__ == "__main__":
         except Exception:
             metric_crs = "EPSG:3857"
         sel_m = sel.to_crs(metric_crs)
+        geoms_m = sel_m.geometry.to_numpy()
         if not sel_m.empty:
-            with np.errstate(all='ignore'):
-                buf = sel_m.buffer(ZONES_BUFFER_M)
-            dissolved = gpd.GeoSeries(buf.unary_union, crs=metric_crs)
-            zones = dissolved.explode(index_parts=False)
-            zones = gpd.GeoDataFrame(geometry=zones, crs=metric_crs)
-            zones = zones.reset_index(drop=True)
-            zones["zone_id"] = np.arange(1, len(zones)+1)
-            # asignar zona a cada manzana seleccionada
-            join = gpd.sjoin(sel_m, zones[["zone_id","geometry"]], how="left", predicate="intersects")
-            sel["zone_id"] = join["zone_id"].values
+            sel["zone_id"] = zone_labels(geoms_m, ZONES_BUFFER_M)
         else:
-            zones = gpd.GeoDataFrame(pd.DataFrame(), geometry=[], crs=metric_crs)
             sel["zone_id"] = np.nan
 
-        # ---- Agregar métricas por zona ----
-        if not zones.empty and "zone_id" in sel.columns:
+        # ---- Agregar métricas por zona (geometría solo para las Top-K) ----
+        zones = gpd.GeoDataFrame(pd.DataFrame(), geometry=[], crs=gdf.crs)
+        if sel["zone_id"].notna().any():
             agg = (sel.groupby("zone_id")
                      .agg(n_manz=(col_id, "size"),
                           syntax_score_mean=("syntax_score","mean"),
                           syntax_score_p90=("syntax_score", lambda s: pd.to_numeric(s, errors='coerce').quantile(0.90)))
                      .reset_index())
-            zones = zones.merge(agg, on="zone_id", how="left")
-            zones = zones[zones["n_manz"].fillna(0) >= ZONES_MIN_MANZ].copy()
-            zones = zones.sort_values(["syntax_score_mean","n_manz"], ascending=[False, False]).head(ZONES_TOP_K)
-            zones = zones.to_crs(gdf.crs)
+            agg["zone_id"] = agg["zone_id"].astype(int)
+            agg = agg[agg["n_manz"] >= ZONES_MIN_MANZ]
+            agg = agg.sort_values(["syntax_score_mean","n_manz"], ascending=[False, False]).head(ZONES_TOP_K)
+            geoms_z = zone_geoms(geoms_m, sel["zone_id"].to_numpy(), agg["zone_id"].to_numpy(), ZONES_BUFFER_M)
+            zones = gpd.GeoDataFrame(agg, geometry=gpd.GeoSeries(geoms_z, index=agg.index, crs=metric_crs))
+            zones = zones[["geometry"] + agg.columns.tolist()].to_crs(gdf.crs)
             # marcar solo manzanas que están dentro de las zonas seleccionadas
-            keep_ids = set(zones["zone_id"].dropna().astype(int))
-            sel = sel[sel["zone_id"].isin(keep_ids)].copy()
-        else:
+            sel = sel[sel["zone_id"].isin(set(agg["zone_id"]))].copy()
+            sel["zone_id"] = sel["zone_id"].astype(int)
+        if zones.empty:
             print("⚠️ No se pudieron formar zonas (selección vacía o sin vecinos).")
 
         # ---- Escribir resultados Syntax-Only ----
@@ -233,18 +406,15 @@ if __name__ == "__main__":
         layer_top   = f"syntax_only_TOP_{RUN_TAG}"
         layer_zones = f"syntax_only_ZONES_{RUN_TAG}"
 
-        if not sel.empty:
-            write_layer_safely(gpd.GeoDataFrame(sel, geometry=geom_col, crs=gdf.crs), out_gpkg, layer_top)
-        if 'zones' in locals() and not zones.empty:
-            write_layer_safely(zones, out_gpkg, layer_zones)
-
-        # CSVs
         base_dir = out_gpkg.parent
         stem = out_gpkg.stem
+        layers = []
         if not sel.empty:
-            sel.drop(columns=geom_col, errors="ignore").to_csv(base_dir / f"{stem}_manzanas.csv", index=False)
-        if 'zones' in locals() and not zones.empty:
-            zones.drop(columns="geometry", errors="ignore").to_csv(base_dir / f"{stem}_zones.csv", index=False)
+            layers.append((layer_top, gpd.GeoDataFrame(sel, geometry=geom_col, crs=gdf.crs),
+                           base_dir / f"{stem}_manzanas.csv"))
+        if not zones.empty:
+            layers.append((layer_zones, zones, base_dir / f"{stem}_zones.csv"))
+        write_run(out_gpkg, layers)
 
         print("Listo ✅ (modo SOLO Syntax)")
         sys.exit(0)
@@ -277,226 +447,177 @@ if __name__ == "__main__":
     gdf[col_hotcat] = pd.to_numeric(gdf[col_hotcat], errors="coerce")
 
     # conteos por tipología y hot_cat
-    grp = gdf.groupby([col_typ_c, col_typ_n])
-    n_total = grp.size().rename("n")
-    n_hot2  = grp.apply(lambda x: (x[col_hotcat]==2).sum()).rename("n_hot2")
-    n_hot1  = grp.apply(lambda x: (x[col_hotcat]==1).sum()).rename("n_hot1")
+    hot = gdf[col_hotcat].where(gdf[col_hotcat].isin([1, 2]), 0).astype(int)
+    xt = pd.crosstab([gdf[col_typ_c], gdf[col_typ_n]], hot).reindex(columns=[0, 1, 2], fill_value=0)
+    typo_cnt = pd.DataFrame({"n": xt.sum(axis=1), "n_hot2": xt[2], "n_hot1": xt[1]}).reset_index()
+
+    def rank_typologies(w2: float, w1: float):
+        typo_grp = typo_cnt.copy()
+        typo_grp["pct_hot2"] = typo_grp["n_hot2"] / typo_grp["n"].replace(0, np.nan)
+        typo_grp["pct_hot1"] = typo_grp["n_hot1"] / typo_grp["n"].replace(0, np.nan)
+        typo_grp["heat_index"] = w2*typo_grp["pct_hot2"] + w1*typo_grp["pct_hot1"]
+        # filtrar por mínimo n y ordenar
+        typo_grp = typo_grp[typo_grp["n"] >= MIN_N_TYPO].copy()
+        typo_rank = typo_grp.sort_values(["heat_index","pct_hot2","n"], ascending=[False, False, False])
+        return typo_rank, set(typo_rank.head(TOP_TYPO_K)[col_typ_c].astype(str))
+
+    typo_rank, top_codes = rank_typologies(HOT_WEIGHT_2, HOT_WEIGHT_1)
 
-    typo_grp = pd.concat([n_total, n_hot2, n_hot1], axis=1).reset_index()
-    typo_grp["pct_hot2"] = typo_grp["n_hot2"] / typo_grp["n"].replace(0, np.nan)
-    typo_grp["pct_hot1"] = typo_grp["n_hot1"] / typo_grp["n"].replace(0, np.nan)
-    typo_grp["heat_index"] = HOT_WEIGHT_2*typo_grp["pct_hot2"] + HOT_WEIGHT_1*typo_grp["pct_hot1"]
+# ==== Paso 2: movilidad dentro de esas tipologías ========================
+    print("→ Paso 2: priorización por movilidad (500 y 1500) en tipologías Top-K…")
+    def mobility_frame(top_codes):
+        """Manzanas hotspot de las tipologías Top-K con z-scores, percentiles y prioridad."""
+        d = gdf[(gdf[col_typ_c].astype(str).isin(top_codes)) & (pd.to_numeric(gdf.get("hot_cat_manz", 0), errors="coerce")>0)].copy()
 
-    # filtrar por mínimo n y ordenar
-    typo_grp = typo_grp[typo_grp["n"] >= MIN_N_TYPO].copy()
-    typo_rank = typo_grp.sort_values(["heat_index","pct_hot2","n"], ascending=[False, False, False])
+        # construir z-scores de movilidad
+        for c in [col_NAIN_500, col_NACH_500, col_NAIN_1500, col_NACH_1500]:
+            if c in d.columns:
+                d[c] = pd.to_numeric(d[c], errors="coerce")
 
-    top_typo = typo_rank.head(TOP_TYPO_K)[[col_typ_c, col_typ_n]]
-    top_codes = set(top_typo[col_typ_c].astype(str))
+        d["mob_500"]  = zscore(d[col_NAIN_500]) + zscore(d[col_NACH_500])
+        d["mob_1500"] = zscore(d[col_NAIN_1500]) + zscore(d[col_NACH_1500])
 
-# ==== Paso 2: movilidad dentro de esas tipologías ========================
-    print("→ Paso 2: priorización por movilidad (500 y 1500) en tipologías Top-K…")
-    d = gdf[(gdf[col_typ_c].astype(str).isin(top_codes)) & (pd.to_numeric(gdf.get("hot_cat_manz", 0), errors="coerce")>0)].copy()
+        # percentiles (0–100) por escala
+        d["rank_500_pct"]  = pct_rank(d["mob_500"])   # 0–100
+        d["rank_1500_pct"] = pct_rank(d["mob_1500"])  # 0–100
 
-    # construir z-scores de movilidad
-    for c in [col_NAIN_500, col_NACH_500, col_NAIN_1500, col_NACH_1500]:
-        if c in d.columns:
-            d[c] = pd.to_numeric(d[c], errors="coerce")
+        # prioridad final (doble peso 500m + calor)
+        d["priority_score"] = 2.0*d["mob_500"] + 1.0*d["mob_1500"] + zscore(d[col_lenp2])
 
-    d["mob_500"]  = zscore(d[col_NAIN_500]) + zscore(d[col_NACH_500])
-    d["mob_1500"] = zscore(d[col_NAIN_1500]) + zscore(d[col_NACH_1500])
+        # umbral para HEAT_POCKET (tercil superior de exposición)
+        heat_q66 = pd.to_numeric(d[col_lenp2], errors="coerce").quantile(0.66)
+        return d, heat_q66
 
-    # percentiles (0–100) y umbrales por escala
-    d["rank_500_pct"]  = pct_rank(d["mob_500"])   # 0–100
-    d["rank_1500_pct"] = pct_rank(d["mob_1500"])  # 0–100
+    d, heat_q66 = mobility_frame(top_codes)
     thr500 = 100.0 * (1.0 - TOP_FRAC_500)   # ej. 80
     thr1500 = 100.0 * (1.0 - TOP_FRAC_1500) # ej. 80
 
-    # prioridad final (doble peso 500m + calor)
-    d["priority_score"] = 2.0*d["mob_500"] + 1.0*d["mob_1500"] + zscore(d[col_lenp2])
-
-    # umbral para HEAT_POCKET (tercil superior de exposición)
-    heat_q66 = pd.to_numeric(d[col_lenp2], errors="coerce").quantile(0.66)
-
-    # Selecciones por modo
-    def select_by_mode(df_in, mode: str):
+    # Selecciones por modo (máscaras sobre d)
+    def mode_mask(df_in, mode: str, thr500: float, thr1500: float, heat_q66: float) -> pd.Series:
         if mode == "STRICT_AND":
-            m = (df_in["rank_500_pct"] >= thr500) & (df_in["rank_1500_pct"] >= thr1500)
-        elif mode == "BROAD_OR":
-            m = (df_in["rank_500_pct"] >= thr500) | (df_in["rank_1500_pct"] >= thr1500)
-        elif mode == "FIVEHUNDRED_ONLY":
-            m = (df_in["rank_500_pct"] >= thr500)
-        elif mode == "HEAT_POCKET":
-            m = (pd.to_numeric(df_in[col_lenp2], errors="coerce") >= heat_q66) & (df_in["rank_500_pct"] >= 50.0)
-        else:
-            m = pd.Series(False, index=df_in.index)
-        out = df_in[m].copy()
-        out["sel_mode"] = mode
-        return out
-
-    selections = {m: select_by_mode(d, m) for m in SELECTION_MODES}
-
-    # Balance territorial opcional por alcaldía
-    def apply_quota(gdf_in: gpd.GeoDataFrame, group_col: str, quota: int) -> gpd.GeoDataFrame:
-        if gdf_in.empty or (group_col not in gdf_in.columns):
-            return gdf_in
-        gdf_in = gdf_in.sort_values(["priority_score", "rank_500_pct", "rank_1500_pct"], ascending=False)
-        parts = []
-        for key, sub in gdf_in.groupby(group_col, group_keys=False):
-            parts.append(sub.head(quota))
-        return gpd.GeoDataFrame(pd.concat(parts, ignore_index=True), geometry=geom_col, crs=gdf_in.crs)
-
-    if APPLY_ALC_QUOTA and col_alc in d.columns:
-        for k in list(selections.keys()):
-            selections[k] = apply_quota(selections[k], col_alc, QUOTA_PER_ALC)
-
-    d["priority_score"] = 2.0*d["mob_500"] + 1.0*d["mob_1500"] + zscore(d[col_lenp2])
+            return (df_in["rank_500_pct"] >= thr500) & (df_in["rank_1500_pct"] >= thr1500)
+        if mode == "BROAD_OR":
+            return (df_in["rank_500_pct"] >= thr500) | (df_in["rank_1500_pct"] >= thr1500)
+        if mode == "FIVEHUNDRED_ONLY":
+            return (df_in["rank_500_pct"] >= thr500)
+        if mode == "HEAT_POCKET":
+            return (pd.to_numeric(df_in[col_lenp2], errors="coerce") >= heat_q66) & (df_in["rank_500_pct"] >= 50.0)
+        return pd.Series(False, index=df_in.index)
+
+    # Todas las selecciones en una tabla larga (modo × manzana), un solo sort por
+    # prioridad y cupo por alcaldía vía cumcount dentro de (modo, alcaldía)
+    def select_modes(d, thr500: float, thr1500: float, heat_q66: float, quota: int) -> dict:
+        long = pd.concat([d[mode_mask(d, m, thr500, thr1500, heat_q66)].assign(sel_mode=m) for m in SELECTION_MODES])
+        long = sort_priority(long)
+        if APPLY_ALC_QUOTA and col_alc in d.columns:
+            long = long[cap_per_group(long, ["sel_mode", col_alc], quota)]
+        return {m: long[long["sel_mode"] == m] for m in SELECTION_MODES}
+
+    selections = select_modes(d, thr500, thr1500, heat_q66, QUOTA_PER_ALC)
 
     # ==== Paso 3: selección final ===========================================
     print("→ Paso 3: selección Top-N por tipología y ranking global…")
     # Top-N por tipología (entre las que cumplen modo ESTRICTO)
-    strict = selections.get("STRICT_AND", d.iloc[0:0].copy())
-    final_rows = []
-    for tcode, tname in sorted(top_codes):
-        sub = strict[(strict[col_typ_c].astype(str) == tcode)].copy()
-        sub = sub.sort_values("priority_score", ascending=False).head(TOP_N_PER_TYPO)
-        sub["rank_en_tipologia"] = np.arange(1, len(sub)+1)
-        final_rows.append(sub)
-    if final_rows:
-        final = gpd.GeoDataFrame(pd.concat(final_rows, ignore_index=True), geometry=geom_col, crs=gdf.crs)
-    else:
-        final = gpd.GeoDataFrame(pd.DataFrame(), geometry=geom_col, crs=gdf.crs)
+    def top_n_per_typology(selections: dict, top_codes) -> gpd.GeoDataFrame:
+        strict = selections.get("STRICT_AND", d.iloc[0:0])
+        strict = strict[strict[col_typ_c].astype(str).isin(top_codes)].assign(_typ=lambda x: x[col_typ_c].astype(str))
+        strict = strict.sort_values(["_typ", "priority_score"], ascending=[True, False], kind="stable")
+        final = strict[cap_per_group(strict, ["_typ"], TOP_N_PER_TYPO)].copy()
+        final["rank_en_tipologia"] = final.groupby("_typ").cumcount() + 1
+        return gpd.GeoDataFrame(final.drop(columns="_typ").reset_index(drop=True), geometry=geom_col, crs=gdf.crs)
+
+    final = top_n_per_typology(selections, top_codes)
 
     # Ranking global de candidatas por cada modo
-    cand_modes = {k: v.sort_values("priority_score", ascending=False).reset_index(drop=True) for k, v in selections.items()}
+    cand_modes = {k: v.reset_index(drop=True) for k, v in selections.items()}  # ya en orden de prioridad
     for k, dfk in cand_modes.items():
         dfk["rank_global"] = np.arange(1, len(dfk)+1)
         cand_modes[k] = gpd.GeoDataFrame(dfk, geometry=geom_col, crs=gdf.crs)
 
-# ==== Escritura ==========================================================
-    print("→ Escribiendo resultados…")
-    # Sello de tiempo para nombres únicos
-    RUN_TAG = datetime.now().strftime("%Y%m%d_%H%M")
-    OUT_LAYER_TAGGED = OUT_LAYER + f"_{RUN_TAG}"
-
-    # 1) GPKG nuevo con sello de tiempo
-    out_gpkg = INPUT_GPKG.with_name(INPUT_GPKG.stem + f"_prioridad_{RUN_TAG}.gpkg")
-    # Escribir SIEMPRE varias capas: FINAL (estricto) y CANDIDATAS por modo
-    if not final.empty:
-        write_layer_safely(final, out_gpkg, OUT_LAYER_TAGGED)
-    else:
-        print("⚠️ No hubo Top-N por tipología en modo estricto.")
-    for k, dfk in cand_modes.items():
-        if not dfk.empty:
-            write_layer_safely(dfk, out_gpkg, OUT_LAYER_TAGGED + f"_{k}")
-
-    # 2) Unión UMEP: FIVEHUNDRED_ONLY ∪ BROAD_OR ∪ HEAT_POCKET
-    def union_umep(cand_modes: dict) -> gpd.GeoDataFrame:
+    # Unión UMEP: FIVEHUNDRED_ONLY ∪ BROAD_OR ∪ HEAT_POCKET
+    def union_umep(cand_modes: dict, max_typ: int = MAX_PER_TYP_PER_ALC,
+                   quota_alc: int = UNION_QUOTA_PER_ALC) -> gpd.GeoDataFrame:
         parts = [cand_modes[m] for m in UNION_MODES if m in cand_modes and not cand_modes[m].empty]
         if not parts:
-            return gpd.GeoDataFrame(pd.DataFrame(), geometry=geom_col, crs=gdf.crs)
+            return gpd.GeoDataFrame(d.iloc[0:0], geometry=geom_col, crs=gdf.crs)
         u = gpd.GeoDataFrame(pd.concat(parts, ignore_index=True), geometry=geom_col, crs=gdf.crs)
         # ordenar por prioridad y quitar duplicados por manzana (conservar la mejor)
         if col_id in u.columns:
-            u = u.sort_values(["priority_score","rank_500_pct","rank_1500_pct"], ascending=False)
+            u = sort_priority(u)
             u = u.drop_duplicates(subset=[col_id], keep="first")
         # aplicar límites tipología dentro de alcaldía, y luego cuota por alcaldía
         if col_alc in u.columns and col_typ_c in u.columns:
-            blocks = []
-            for alc_key, g_alc in u.groupby(col_alc, group_keys=False):
-                g_alc = g_alc.sort_values(["priority_score","rank_500_pct","rank_1500_pct"], ascending=False)
-                sub_parts = []
-                for typ_key, g_typ in g_alc.groupby(col_typ_c, group_keys=False):
-                    sub_parts.append(g_typ.head(MAX_PER_TYP_PER_ALC))
-                g_pack = pd.concat(sub_parts, ignore_index=True)
-                g_pack = g_pack.sort_values(["priority_score","rank_500_pct","rank_1500_pct"], ascending=False).head(UNION_QUOTA_PER_ALC)
-                blocks.append(g_pack)
-            u2 = gpd.GeoDataFrame(pd.concat(blocks, ignore_index=True), geometry=geom_col, crs=u.crs)
-        else:
-            u2 = u
-        return u2
-
-    umepl = union_umep(cand_modes)
-    if not umepl.empty:
-        write_layer_safely(umepl, out_gpkg, OUT_LAYER_TAGGED + "_UMEP_CANDIDATAS")
-    else:
-        print("⚠️ Unión UMEP vacía (revisa umbrales o modos seleccionados).")
-
-    # 3) CSVs con el mismo sello (junto al GPKG nuevo)
-    base_dir = out_gpkg.parent
-    stem = out_gpkg.stem  # incluye _prioridad_YYYYMMDD_HHMM
-
-    # Selección final Top-N tipología (estricto)
-    csv_sel = base_dir / f"{stem}_manzanas_FINAL.csv"
-    final.drop(columns=geom_col, errors="ignore").to_csv(csv_sel, index=False)
-
-    # Candidatas por modo (CSV por cada modo)
-    for k, dfk in cand_modes.items():
-        dfk.drop(columns=geom_col, errors="ignore").to_csv(base_dir / f"{stem}_candidatas_{k}.csv", index=False)
-
-    # Unión UMEP CSV
-    if not umepl.empty:
-        umepl.drop(columns=geom_col, errors="ignore").to_csv(base_dir / f"{stem}_UMEP_CANDIDATAS.csv", index=False)
-
-    # Ranking de tipologías por hot_cat
-    csv_typ = base_dir / f"{stem}_tipologias_hotcat_rank.csv"
-    typo_rank.to_csv(csv_typ, index=False)
-
-    # Umbrales usados
-    csv_thr = base_dir / f"{stem}_thresholds.csv"
-    pd.DataFrame({
-        "metric": ["rank_500_pct","rank_1500_pct","len_share_p2_q66"],
-        "threshold": [thr500, thr1500, heat_q66],
-        "note": [f"TOP_FRAC_500={TOP_FRAC_500}", f"TOP_FRAC_1500={TOP_FRAC_1500}", "HEAT_POCKET usa q66"]
-    }).to_csv(csv_thr, index=False)
+            u = sort_priority(u)
+            u = u[cap_per_group(u, [col_alc, col_typ_c], max_typ)]
+            u = sort_priority(u, extra=[col_alc])
+            u = u[cap_per_group(u, [col_alc], quota_alc)]
+            u = gpd.GeoDataFrame(u.reset_index(drop=True), geometry=geom_col, crs=gdf.crs)
+        return u
+
+    # ==== Barrido de escenarios (opcional) ==================================
+    if RUN_SWEEP:
+        print("→ Barrido de escenarios (tipologías × movilidad)…")
+        tops, frames, rows, masks = {}, {}, [], []
+        for sc in sweep_scenarios(SWEEP_GRID_TYPO):
+            w = (sc["HOT_WEIGHT_2"], sc["HOT_WEIGHT_1"])
+            if w not in tops:
+                tops[w] = frozenset(rank_typologies(*w)[1])
+            codes = tops[w]
+            if codes not in frames:  # z-scores/percentiles una vez por conjunto de tipologías
+                frames[codes] = mobility_frame(codes)
+            d_s, q66_s = frames[codes]
+            sel_s = select_modes(d_s, 100.0*(1.0 - sc["TOP_FRAC_500"]), 100.0*(1.0 - sc["TOP_FRAC_1500"]),
+                                 q66_s, sc["QUOTA_PER_ALC"])
+            u_s = union_umep(sel_s, sc["MAX_PER_TYP_PER_ALC"], sc["UNION_QUOTA_PER_ALC"])
+            masks.append(gdf[col_id].isin(u_s[col_id]).to_numpy() if col_id in u_s.columns
+                         else np.zeros(len(gdf), dtype=bool))
+            rows.append({**sc, "tipologias_top": ",".join(sorted(codes)),
+                         **{f"n_{m}": len(sel_s[m]) for m in SELECTION_MODES},
+                         "n_final": len(top_n_per_typology(sel_s, codes)), "n_umep": len(u_s)})
+        RUN_TAG = datetime.now().strftime("%Y%m%d_%H%M")
+        write_sweep(rows, masks, gdf[col_id],
+                    INPUT_GPKG.with_name(INPUT_GPKG.stem + f"_prioridad_sweep_{RUN_TAG}"))
+        sys.exit(0)
 
-    print("Listo ✅")
-    print("Layer base (estricto):", OUT_LAYER_TAGGED, "en", out_gpkg)
-    if not umepl.empty:
-        print("Layer consolidada UMEP:", OUT_LAYER_TAGGED + "_UMEP_CANDIDATAS")
-    print("CSVs en:", base_dir)
+# ==== Escritura ==========================================================
     print("→ Escribiendo resultados…")
     # Sello de tiempo para nombres únicos
     RUN_TAG = datetime.now().strftime("%Y%m%d_%H%M")
     OUT_LAYER_TAGGED = OUT_LAYER + f"_{RUN_TAG}"
 
-    # 1) GPKG nuevo con sello de tiempo
+    # GPKG nuevo con sello de tiempo; CSVs con el mismo sello (junto al GPKG)
     out_gpkg = INPUT_GPKG.with_name(INPUT_GPKG.stem + f"_prioridad_{RUN_TAG}.gpkg")
-    # Escribir SIEMPRE varias capas: FINAL (estricto) y CANDIDATAS por modo
-    if not final.empty:
-        write_layer_safely(final, out_gpkg, OUT_LAYER_TAGGED)
-    else:
-        print("⚠️ No hubo Top-N por tipología en modo estricto.")
-    for k, dfk in cand_modes.items():
-        if not dfk.empty:
-            write_layer_safely(dfk, out_gpkg, OUT_LAYER_TAGGED + f"_{k}")
-
-    # 2) CSVs con el mismo sello (junto al GPKG nuevo)
     base_dir = out_gpkg.parent
     stem = out_gpkg.stem  # incluye _prioridad_YYYYMMDD_HHMM
 
-    # Selección final Top-N tipología (estricto)
-    csv_sel = base_dir / f"{stem}_manzanas_FINAL.csv"
-    final.drop(columns=geom_col, errors="ignore").to_csv(csv_sel, index=False)
+    umepl = union_umep(cand_modes)
+    if final.empty:
+        print("⚠️ No hubo Top-N por tipología en modo estricto.")
+    if umepl.empty:
+        print("⚠️ Unión UMEP vacía (revisa umbrales o modos seleccionados).")
 
-    # Candidatas por modo (CSV por cada modo)
-    for k, dfk in cand_modes.items():
-        dfk.drop(columns=geom_col, errors="ignore").to_csv(base_dir / f"{stem}_candidatas_{k}.csv", index=False)
+    # Capas: FINAL (estricto), CANDIDATAS por modo y unión UMEP (+ espejo CSV de cada una)
+    csv_sel = base_dir / f"{stem}_manzanas_FINAL.csv"
+    layers = [(OUT_LAYER_TAGGED, final, csv_sel)]
+    layers += [(OUT_LAYER_TAGGED + f"_{k}", dfk, base_dir / f"{stem}_candidatas_{k}.csv")
+               for k, dfk in cand_modes.items()]
+    if not umepl.empty:
+        layers.append((OUT_LAYER_TAGGED + "_UMEP_CANDIDATAS", umepl, base_dir / f"{stem}_UMEP_CANDIDATAS.csv"))
 
-    # Ranking de tipologías por hot_cat
+    # Tablas: ranking de tipologías por hot_cat y umbrales usados
     csv_typ = base_dir / f"{stem}_tipologias_hotcat_rank.csv"
-    typo_rank.to_csv(csv_typ, index=False)
-
-    # Umbrales usados
     csv_thr = base_dir / f"{stem}_thresholds.csv"
-    pd.DataFrame({
+    thresholds = pd.DataFrame({
         "metric": ["rank_500_pct","rank_1500_pct","len_share_p2_q66"],
         "threshold": [thr500, thr1500, heat_q66],
         "note": [f"TOP_FRAC_500={TOP_FRAC_500}", f"TOP_FRAC_1500={TOP_FRAC_1500}", "HEAT_POCKET usa q66"]
-    }).to_csv(csv_thr, index=False)
+    })
+    write_run(out_gpkg, layers, [(typo_rank, csv_typ), (thresholds, csv_thr)])
 
     print("Listo ✅")
     print("Layer base (estricto):", OUT_LAYER_TAGGED, "en", out_gpkg)
+    if not umepl.empty:
+        print("Layer consolidada UMEP:", OUT_LAYER_TAGGED + "_UMEP_CANDIDATAS")
     print("CSV selección FINAL:", csv_sel)
     print("CSV tipologías por hot_cat:", csv_typ)
     print("CSV umbrales:", csv_thr)
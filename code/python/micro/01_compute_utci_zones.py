@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+UTCI por píxel para las zonas micro (post-proceso de SOLWEIG)
+==============================================================
+
+Las corridas UMEP/SOLWEIG de las zonas de estudio (`zone_01..03`, 10:00,
+12:00 y 14:00) entregan rásters de Tmrt; la conversión a UTCI y a categorías
+de estrés térmico se hacía fuera del pipeline, zona por zona y hora por hora.
+
+Este script:
+1. Localiza los `Tmrt_<año>_<doy>_<HHMM>D.tif` de SOLWEIG de cada zona y
+   hora, y toma Ta / HR / viento del mismo archivo meteorológico UMEP que
+   alimentó la corrida (fila `iy, id, it` que codifica el nombre del ráster).
+   Si en la carpeta de la zona existe `Ta_<HHMM>.tif`, `RH_<HHMM>.tif` o
+   `Wind_<HHMM>.tif` (p. ej. viento de URock), se usa el ráster en lugar del
+   valor escalar.
+2. Evalúa la **aproximación polinomial de 6.º orden** del UTCI (Bröde et al.
+   2012, 210 coeficientes) en **float32** y **por bloques** de `BLOCK`
+   píxeles. Todas las zonas y horas se concatenan y se evalúan en **una sola
+   llamada** (`utci_batch`), en lugar de un bucle por ráster.
+   - Presión de vapor de saturación: Hardy (1998), ITS-90.
+   - Viento recortado a 0.5–17 m/s (rango de validez del polinomio).
+   - Píxeles fuera de rango (Ta ∉ [−50, 50] °C, Tmrt−Ta ∉ [−30, 70] K,
+     Pa > 5 kPa) quedan como nodata y se cuentan en el resumen.
+3. Escribe por zona y hora el ráster UTCI (°C) y el ráster de **categorías de
+   estrés** (10 clases UTCI, uint8 con paleta), más un **resumen por zona**.
+
+Salida
+------
+- `<OUT_DIR>/<zona>/UTCI_<HHMM>.tif`      (float32, nodata = `NODATA`)
+- `<OUT_DIR>/<zona>/UTCI_cat_<HHMM>.tif`  (uint8 1–10, nodata = 0)
+- `<OUT_DIR>/<zona>/utci_resumen_<zona>.csv` (una fila por hora: media,
+  percentiles, máximo y % de píxeles por categoría)
+
+Nota: el UTCI espera viento a 10 m; el archivo met de UMEP ya lo trae a esa
+altura. Un ráster de viento a nivel peatón debe reescalarse antes de usarlo.
+
+Requisitos: numpy, pandas, rasterio.
+"""
+
+from pathlib import Path
+import re
+import numpy as np
+import pandas as pd
+import rasterio
+
+# ================== RUTAS ====================================================
+DIR_UMEP = Path("/Users/danielaresendiz/Library/CloudStorage/OneDrive-UniversityCollegeLondon(2)/Dissertation/01_data/UMEP")
+MET_FILE = DIR_UMEP / "met_cdmx_verano.txt"      # forzante UMEP usado en SOLWEIG
+OUT_DIR  = DIR_UMEP / "utci"
+
+ZONES = ["zone_01", "zone_02", "zone_03"]
+HOURS = [10, 12, 14]
+
+# ================== PARÁMETROS ===============================================
+BLOCK      = 1 << 20          # píxeles por bloque de evaluación
+NODATA     = -9999.0
+CAT_NODATA = 0
+VA_MIN, VA_MAX = 0.5, 17.0    # m/s, validez del polinomio
+
+# Límites inferiores de las clases 2..10 (°C); clase 1 = < −40
+UTCI_EDGES = np.array([-40, -27, -13, 0, 9, 26, 32, 38, 46], dtype=np.float32)
+UTCI_CLASSES = {
+    1:  ("estres_frio_extremo",        (  0,   0, 128)),
+    2:  ("estres_frio_muy_fuerte",     (  0,  64, 192)),
+    3:  ("estres_frio_fuerte",         (  0, 128, 255)),
+    4:  ("estres_frio_moderado",       (  0, 192, 255)),
+    5:  ("estres_frio_ligero",         (128, 224, 255)),
+    6:  ("sin_estres",                 (  0, 176,  80)),
+    7:  ("estres_calor_moderado",      (255, 192,   0)),
+    8:  ("estres_calor_fuerte",        (255, 128,   0)),
+    9:  ("estres_calor_muy_fuerte",    (255,   0,   0)),
+    10: ("estres_calor_extremo",       (128,   0,   0)),
+}
+
+# Coeficientes del polinomio UTCI (Bröde et al. 2012), en el orden del código
+# Fortran de referencia: Pa^l · ΔT^k · va^j · Ta^i con i+j+k+l ≤ 6, Ta más
+# interno. Cada línea es un polinomio en Ta (potencias 0..n).
+UTCI_COEF = np.array([
+    6.07562052e-01, -2.27712343e-02, 8.06470249e-04, -1.54271372e-04, -3.24651735e-06, 7.32602852e-08, 1.35959073e-09,  # va^0 ΔT^0 Pa^0
+    -2.25836520e+00, 8.80326035e-02, 2.16844454e-03, -1.53347087e-05, -5.72983704e-07, -2.55090145e-09,  # va^1 ΔT^0 Pa^0
+    -7.51269505e-01, -4.08350271e-03, -5.21670675e-05, 1.94544667e-06, 1.14099531e-08,  # va^2 ΔT^0 Pa^0
+    1.58137256e-01, -6.57263143e-05, 2.22697524e-07, -4.16117031e-08,  # va^3 ΔT^0 Pa^0
+    -1.27762753e-02, 9.66891875e-06, 2.52785852e-09,  # va^4 ΔT^0 Pa^0
+    4.56306672e-04, -1.74202546e-07,  # va^5 ΔT^0 Pa^0
+    -5.91491269e-06,  # va^6 ΔT^0 Pa^0
+    3.98374029e-01, 1.83945314e-04, -1.73754510e-04, -7.60781159e-07, 3.77830287e-08, 5.43079673e-10,  # va^0 ΔT^1 Pa^0
+    -2.00518269e-02, 8.92859837e-04, 3.45433048e-06, -3.77925774e-07, -1.69699377e-09,  # va^1 ΔT^1 Pa^0
+    1.69992415e-04, -4.99204314e-05, 2.47417178e-07, 1.07596466e-08,  # va^2 ΔT^1 Pa^0
+    8.49242932e-05, 1.35191328e-06, -6.21531254e-09,  # va^3 ΔT^1 Pa^0
+    -4.99410301e-06, -1.89489258e-08,  # va^4 ΔT^1 Pa^0
+    8.15300114e-08,  # va^5 ΔT^1 Pa^0
+    7.55043090e-04, -5.65095215e-05, -4.52166564e-07, 2.46688878e-08, 2.42674348e-10,  # va^0 ΔT^2 Pa^0
+    1.54547250e-04, 5.24110970e-06, -8.75874982e-08, -1.50743064e-09,  # va^1 ΔT^2 Pa^0
+    -1.56236307e-05, -1.33895614e-07, 2.49709824e-09,  # va^2 ΔT^2 Pa^0
+    6.51711721e-07, 1.94960053e-09,  # va^3 ΔT^2 Pa^0
+    -1.00361113e-08,  # va^4 ΔT^2 Pa^0
+    -1.21206673e-05, -2.18203660e-07, 7.51269482e-09, 9.79063848e-11,  # va^0 ΔT^3 Pa^0
+    1.25006734e-06, -1.81584736e-09, -3.52197671e-10,  # va^1 ΔT^3 Pa^0
+    -3.36514630e-08, 1.35908359e-10,  # va^2 ΔT^3 Pa^0
+    4.17032620e-10,  # va^3 ΔT^3 Pa^0
+    -1.30369025e-09, 4.13908461e-10, 9.22652254e-12,  # va^0 ΔT^4 Pa^0
+    -5.08220384e-09, -2.24730961e-11,  # va^1 ΔT^4 Pa^0
+    1.17139133e-10,  # va^2 ΔT^4 Pa^0
+    6.62154879e-10, 4.03863260e-13,  # va^0 ΔT^5 Pa^0
+    1.95087203e-12,  # va^1 ΔT^5 Pa^0
+    -4.73602469e-12,  # va^0 ΔT^6 Pa^0
+    5.12733497e+00, -3.12788561e-01, -1.96701861e-02, 9.99690870e-04, 9.51738512e-06, -4.66426341e-07,  # va^0 ΔT^0 Pa^1
+    5.48050612e-01, -3.30552823e-03, -1.64119440e-03, -5.16670694e-06, 9.52692432e-07,  # va^1 ΔT^0 Pa^1
+    -4.29223622e-02, 5.00845667e-03, 1.00601257e-06, -1.81748644e-06,  # va^2 ΔT^0 Pa^1
+    -1.25813502e-03, -1.79330391e-04, 2.34994441e-06,  # va^3 ΔT^0 Pa^1
+    1.29735808e-04, 1.29064870e-06,  # va^4 ΔT^0 Pa^1
+    -2.28558686e-06,  # va^5 ΔT^0 Pa^1
+    -3.69476348e-02, 1.62325322e-03, -3.14279680e-05, 2.59835559e-06, -4.77136523e-08,  # va^0 ΔT^1 Pa^1
+    8.64203390e-03, -6.87405181e-04, -9.13863872e-06, 5.15916806e-07,  # va^1 ΔT^1 Pa^1
+    -3.59217476e-05, 3.28696511e-05, -7.10542454e-07,  # va^2 ΔT^1 Pa^1
+    -1.24382300e-05, -7.38584400e-09,  # va^3 ΔT^1 Pa^1
+    2.20609296e-07,  # va^4 ΔT^1 Pa^1
+    -7.32469180e-04, -1.87381964e-05, 4.80925239e-06, -8.75492040e-08,  # va^0 ΔT^2 Pa^1
+    2.77862930e-05, -5.06004592e-06, 1.14325367e-07,  # va^1 ΔT^2 Pa^1
+    2.53016723e-06, -1.72857035e-08,  # va^2 ΔT^2 Pa^1
+    -3.95079398e-08,  # va^3 ΔT^2 Pa^1
+    -3.59413173e-07, 7.04388046e-07, -1.89309167e-08,  # va^0 ΔT^3 Pa^1
+    -4.79768731e-07, 7.96079978e-09,  # va^1 ΔT^3 Pa^1
+    1.62897058e-09,  # va^2 ΔT^3 Pa^1
+    3.94367674e-08, -1.18566247e-09,  # va^0 ΔT^4 Pa^1
+    3.34678041e-10,  # va^1 ΔT^4 Pa^1
+    -1.15606447e-10,  # va^0 ΔT^5 Pa^1
+    -2.80626406e+00, 5.48712484e-01, -3.99428410e-03, -9.54009191e-04, 1.93090978e-05,  # va^0 ΔT^0 Pa^2
+    -3.08806365e-01, 1.16952364e-02, 4.95271903e-04, -1.90710882e-05,  # va^1 ΔT^0 Pa^2
+    2.10787756e-03, -6.98445738e-04, 2.30109073e-05,  # va^2 ΔT^0 Pa^2
+    4.17856590e-04, -1.27043871e-05,  # va^3 ΔT^0 Pa^2
+    -3.04620472e-06,  # va^4 ΔT^0 Pa^2
+    5.14507424e-02, -4.32510997e-03, 8.99281156e-05, -7.14663943e-07,  # va^0 ΔT^1 Pa^2
+    -2.66016305e-04, 2.63789586e-04, -7.01199003e-06,  # va^1 ΔT^1 Pa^2
+    -1.06823306e-04, 3.61341136e-06,  # va^2 ΔT^1 Pa^2
+    2.29748967e-07,  # va^3 ΔT^1 Pa^2
+    3.04788893e-04, -6.42070836e-05, 1.16257971e-06,  # va^0 ΔT^2 Pa^2
+    7.68023384e-06, -5.47446896e-07,  # va^1 ΔT^2 Pa^2
+    -3.59937910e-08,  # va^2 ΔT^2 Pa^2
+    -4.36497725e-06, 1.68737969e-07,  # va^0 ΔT^3 Pa^2
+    2.67489271e-08,  # va^1 ΔT^3 Pa^2
+    3.23926897e-09,  # va^0 ΔT^4 Pa^2
+    -3.53874123e-02, -2.21201190e-01, 1.55126038e-02, -2.63917279e-04,  # va^0 ΔT^0 Pa^3
+    4.53433455e-02, -4.32943862e-03, 1.45389826e-04,  # va^1 ΔT^0 Pa^3
+    2.17508610e-04, -6.66724702e-05,  # va^2 ΔT^0 Pa^3
+    3.33217140e-05,  # va^3 ΔT^0 Pa^3
+    -2.26921615e-03, 3.80261982e-04, -5.45314314e-09,  # va^0 ΔT^1 Pa^3
+    -7.96355448e-04, 2.53458034e-05,  # va^1 ΔT^1 Pa^3
+    -6.31223658e-06,  # va^2 ΔT^1 Pa^3
+    3.02122035e-04, -4.77403547e-06,  # va^0 ΔT^2 Pa^3
+    1.73825715e-06,  # va^1 ΔT^2 Pa^3
+    -4.09087898e-07,  # va^0 ΔT^3 Pa^3
+    6.14155345e-01, -6.16755931e-02, 1.33374846e-03,  # va^0 ΔT^0 Pa^4
+    3.55375387e-03, -5.13027851e-04,  # va^1 ΔT^0 Pa^4
+    1.02449757e-04,  # va^2 ΔT^0 Pa^4
+    -1.48526421e-03, -4.11469183e-05,  # va^0 ΔT^1 Pa^4
+    -6.80434415e-06,  # va^1 ΔT^1 Pa^4
+    -9.77675906e-06,  # va^0 ΔT^2 Pa^4
+    8.82773108e-02, -3.01859306e-03,  # va^0 ΔT^0 Pa^5
+    1.04452989e-03,  # va^1 ΔT^0 Pa^5
+    2.47090539e-04,  # va^0 ΔT^1 Pa^5
+    1.48348065e-03,  # va^0 ΔT^0 Pa^6
+], dtype=np.float32)
+assert UTCI_COEF.size == 210
+
+# Hardy (1998), ITS-90: ln(es[Pa]) = Σ g_i·T^(i−2) + g7·ln(T)
+HARDY_G  = np.array([-2836.5744, -6028.076559, 19.54263612, -0.02737830188,
+                     1.6261698e-5, 7.0229056e-10, -1.8680009e-13], dtype=np.float32)
+HARDY_G7 = np.float32(2.7150305)
+
+TMRT_RE = re.compile(r"Tmrt_(\d{4})_(\d{1,3})_(\d{2})(\d{2})D\.tif$")
+
+# ================== HELPERS ==================================================
+def vapour_pressure_kpa(ta, rh):
+    """Presión de vapor (kPa) a partir de Ta (°C) y HR (%), Hardy ITS-90."""
+    tk = ta + np.float32(273.15)
+    ln_es = HARDY_G7 * np.log(tk)
+    tk_pow = tk ** -2
+    for g in HARDY_G:
+        ln_es += g * tk_pow
+        tk_pow = tk_pow * tk
+    return np.exp(ln_es) * (rh / np.float32(100.0)) / np.float32(1000.0)
+
+
+def utci_poly(ta, dtr, va, pa):
+    """Polinomio de 6.º orden (Horner en Ta anidado en va, ΔT y Pa), float32."""
+    out = ta.copy()
+    idx = 0
+    pa_l = np.ones_like(ta)
+    for l in range(7):
+        dt_k = pa_l.copy()
+        for k in range(7 - l):
+            va_j = dt_k.copy()
+            for j in range(7 - l - k):
+                n = 7 - l - k - j
+                c = UTCI_COEF[idx:idx + n]
+                idx += n
+                p = np.full_like(ta, c[-1])
+                for ci in c[-2::-1]:
+                    p *= ta
+                    p += ci
+                p *= va_j
+                out += p
+                va_j *= va
+            dt_k *= dtr
+        pa_l *= pa
+    return out
+
+
+def utci_block(ta, tmrt, va, rh):
+    """UTCI (°C) de un bloque 1-D; NaN donde las entradas salen del rango válido."""
+    rh = np.clip(rh, 0, 100)
+    va = np.clip(va, VA_MIN, VA_MAX)
+    pa = vapour_pressure_kpa(ta, rh)
+    dtr = tmrt - ta
+    utci = utci_poly(ta, dtr, va, pa)
+    fuera = (ta < -50) | (ta > 50) | (dtr < -30) | (dtr > 70) | (pa > 5)
+    utci[fuera] = np.nan
+    return utci
+
+
+def utci_batch(stacks):
+    """
+    Evalúa UTCI para varias zonas/horas en una sola pasada.
+    `stacks`: lista de tuplas (ta, tmrt, va, rh) de rásters 2-D (NaN = sin dato).
+    Devuelve una lista de rásters UTCI float32 con la forma de cada entrada.
+    """
+    valid = [np.isfinite(ta) & np.isfinite(tm) & np.isfinite(va) & np.isfinite(rh)
+             for ta, tm, va, rh in stacks]
+    flat = [np.concatenate([a[m] for a, m in zip(arrs, valid)]).astype(np.float32)
+            for arrs in zip(*stacks)]
+    ta, tmrt, va, rh = flat
+
+    utci = np.empty(ta.size, dtype=np.float32)
+    for s in range(0, ta.size, BLOCK):
+        sl = slice(s, s + BLOCK)
+        utci[sl] = utci_block(ta[sl], tmrt[sl], va[sl], rh[sl])
+
+    out, start = [], 0
+    for m in valid:
+        arr = np.full(m.shape, np.nan, dtype=np.float32)
+        n = int(m.sum())
+        arr[m] = utci[start:start + n]
+        start += n
+        out.append(arr)
+    return out
+
+
+def stress_category(utci):
+    """Clase UTCI 1–10 (uint8); 0 donde no hay dato."""
+    cat = (np.digitize(utci, UTCI_EDGES) + 1).astype(np.uint8)
+    cat[~np.isfinite(utci)] = CAT_NODATA
+    return cat
+
+
+def read_met(path):
+    """Archivo met de UMEP (separado por espacios) indexado por (iy, id, it)."""
+    met = pd.read_csv(path, sep=r"\s+")
+    met = met.rename(columns={"%iy": "iy"})
+    return met.set_index(["iy", "id", "it"])[["Tair", "RH", "U"]]
+
+
+def find_tmrt(zone_dir, hour):
+    """Ráster Tmrt de SOLWEIG para la hora dada → (ruta, (año, doy, hora)) o None."""
+    for p in sorted(zone_dir.glob(f"Tmrt_*_{hour:02d}00D.tif")):
+        m = TMRT_RE.search(p.name)
+        if m:
+            return p, (int(m.group(1)), int(m.group(2)), int(m.group(3)))
+    return None
+
+
+def read_band(path):
+    """Banda 1 como float32 con NaN en nodata, más el perfil."""
+    with rasterio.open(path) as ds:
+        arr = ds.read(1, masked=True).astype(np.float32).filled(np.nan)
+        return arr, ds.profile.copy()
+
+
+def load_forcing(zone_dir, name, hour, shape, value):
+    """Ráster `<name>_<HHMM>.tif` de la zona si existe; si no, el escalar del met."""
+    p = zone_dir / f"{name}_{hour:02d}00.tif"
+    if p.exists():
+        arr, _ = read_band(p)
+        if arr.shape != shape:
+            raise ValueError(f"{p.name}: forma {arr.shape} ≠ Tmrt {shape}")
+        return arr, "ráster"
+    return np.full(shape, value, dtype=np.float32), "met"
+
+
+def write_outputs(zone_out, hour, utci, cat, profile):
+    """Escribe UTCI (float32) y categorías (uint8 con paleta) con la grilla de Tmrt."""
+    base = dict(profile, driver="GTiff", count=1, tiled=True,
+                blockxsize=256, blockysize=256, compress="DEFLATE")
+    base.pop("photometric", None)
+    with rasterio.open(zone_out / f"UTCI_{hour:02d}00.tif", "w",
+                       **dict(base, dtype="float32", nodata=NODATA, predictor=3)) as ds:
+        ds.write(np.where(np.isfinite(utci), utci, NODATA).astype(np.float32), 1)
+    with rasterio.open(zone_out / f"UTCI_cat_{hour:02d}00.tif", "w",
+                       **dict(base, dtype="uint8", nodata=CAT_NODATA, predictor=1)) as ds:
+        ds.write(cat, 1)
+        ds.write_colormap(1, {k: rgb + (255,) for k, (_, rgb) in UTCI_CLASSES.items()})
+
+
+def summarize(zone, hour, utci, cat, n_in):
+    """Fila de resumen: estadísticos de UTCI y % de píxeles por categoría."""
+    v = utci[np.isfinite(utci)]
+    row = {"zona": zone, "hora": f"{hour:02d}:00", "n_pix": int(v.size),
+           "fuera_rango": int(n_in - v.size)}
+    if v.size:
+        p10, p50, p90 = np.percentile(v, [10, 50, 90])
+        row.update(utci_media=float(v.mean()), utci_p10=float(p10),
+                   utci_p50=float(p50), utci_p90=float(p90), utci_max=float(v.max()))
+    counts = np.bincount(cat.ravel(), minlength=11)
+    for k, (label, _) in UTCI_CLASSES.items():
+        row[f"pct_{label}"] = 100.0 * counts[k] / v.size if v.size else np.nan
+    return row
+
+# ================== MAIN =====================================================
+if __name__ == "__main__":
+    met = read_met(MET_FILE)
+    print(f"✔ Met UMEP: {MET_FILE.name} ({len(met)} filas)")
+
+    jobs, stacks = [], []
+    for zone in ZONES:
+        zone_dir = DIR_UMEP / zone
+        for hour in HOURS:
+            found = find_tmrt(zone_dir, hour)
+            if found is None:
+                print(f"⚠️ {zone} {hour:02d}:00 sin Tmrt de SOLWEIG (se omite)")
+                continue
+            path, key = found
+            if key not in met.index:
+                raise KeyError(f"{path.name}: sin fila {key} en {MET_FILE.name}")
+            ta0, rh0, va0 = met.loc[key, ["Tair", "RH", "U"]].astype(float)
+
+            tmrt, profile = read_band(path)
+            ta, src_ta = load_forcing(zone_dir, "Ta", hour, tmrt.shape, ta0)
+            rh, src_rh = load_forcing(zone_dir, "RH", hour, tmrt.shape, rh0)
+            va, src_va = load_forcing(zone_dir, "Wind", hour, tmrt.shape, va0)
+            stacks.append((ta, tmrt, va, rh))
+            jobs.append((zone, hour, profile))
+            print(f"   · {zone} {hour:02d}:00 → {path.name} {tmrt.shape} "
+                  f"(Ta {src_ta}, HR {src_rh}, viento {src_va})")
+
+    if not jobs:
+        raise FileNotFoundError(f"Sin rásters Tmrt en {DIR_UMEP}/<zona>")
+
+    n_pix = sum(s[1].size for s in stacks)
+    print(f"→ UTCI en lote: {len(jobs)} zona·hora, {n_pix:,} píxeles, bloques de {BLOCK:,}")
+    utcis = utci_batch(stacks)
+
+    rows = {}
+    for (zone, hour, profile), utci, (_, tmrt, _, _) in zip(jobs, utcis, stacks):
+        zone_out = OUT_DIR / zone
+        zone_out.mkdir(parents=True, exist_ok=True)
+        cat = stress_category(utci)
+        write_outputs(zone_out, hour, utci, cat, profile)
+        rows.setdefault(zone, []).append(
+            summarize(zone, hour, utci, cat, int(np.isfinite(tmrt).sum())))
+
+    for zone, zone_rows in rows.items():
+        df = pd.DataFrame(zone_rows)
+        out_csv = OUT_DIR / zone / f"utci_resumen_{zone}.csv"
+        df.to_csv(out_csv, index=False, float_format="%.2f")
+        for r in zone_rows:
+            print(f"   · {zone} {r['hora']}: UTCI medio {r.get('utci_media', np.nan):.1f} °C, "
+                  f"p90 {r.get('utci_p90', np.nan):.1f} °C, fuera de rango {r['fuera_rango']}")
+
+    print(f"Listo ✅  UTCI y categorías en {OUT_DIR}")
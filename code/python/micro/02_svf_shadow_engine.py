@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Sky-view factor y sombras horarias sobre el DSM de cada zona micro
+==================================================================
+
+Las metas de diseño pasivo de las zonas elegidas por el priorizador UMEP
+(`meso/08_prioritize_umep_study_zones.py`) dependen de la sombra y del
+sky-view factor (SVF). Hasta ahora ambos salían de la cadena UMEP externa,
+una zona y una hora a la vez.
+
+Este script:
+1. Lee el DSM de cada zona (`<zona>/DSM.tif`, alturas sobre el terreno) y, si
+   existe, el dosel `<zona>/CDSM.tif`; la superficie de obstáculos es el
+   máximo de ambos (la vegetación se trata como opaca).
+2. Calcula el **horizonte por sectores de azimut** con una marcha de rayos por
+   desplazamientos: en cada paso se leen, para todos los sectores a la vez,
+   las celdas desplazadas sobre el DSM acolchado y se acumula la tangente
+   máxima de elevación (bloques de `CHUNK_PX` píxeles).
+   - **SVF** (superficie horizontal) = media sobre sectores de cos²(β).
+   - **Sombra** a una hora = horizonte en el azimut solar > altura solar.
+3. Posición solar con el algoritmo **NOAA** para `SUN_DATE` a las 10, 12 y
+   14 h locales (UTC−6), en el centro de cada zona.
+4. Procesa las zonas en paralelo (`ProcessPoolExecutor`) y guarda cada
+   resultado en caché por (zona, hash del DSM, posición solar): si el DSM no
+   cambia, una nueva corrida solo lee los `.npz`.
+5. Resume SVF y sombra solo en el interior del ráster (sin la franja de
+   `SVF_RADIUS`): el DSM de `03_build_zone_dsm.py` trae ese margen de
+   contexto, cuyas celdas no ven su horizonte completo.
+
+Salida
+------
+- `<OUT_DIR>/<zona>/SVF.tif`              (float32, 0–1)
+- `<OUT_DIR>/<zona>/shadow_<HHMM>.tif`   (uint8, 1 = sol, 0 = sombra; convención UMEP)
+- `<OUT_DIR>/<zona>/svf_sombra_resumen.csv` (posición solar, SVF medio y % de
+  sombra en el nivel de calle por hora, interior de la zona)
+- `<OUT_DIR>/svf_sombra_resumen.csv`     (unión de los resúmenes de todas las
+  zonas procesadas; una corrida con `--zones` no borra las demás)
+
+Requisitos: numpy, pandas, rasterio.
+"""
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+import argparse
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.warp import transform as warp_transform
+
+# ================== RUTAS ====================================================
+DIR_UMEP  = Path("/Users/danielaresendiz/Library/CloudStorage/OneDrive-UniversityCollegeLondon(2)/Dissertation/01_data/UMEP")
+OUT_DIR   = DIR_UMEP / "svf_sombra"
+CACHE_DIR = OUT_DIR / "_cache"
+
+ZONES = ["zone_01", "zone_02", "zone_03"]
+HOURS = [10, 12, 14]
+
+# ================== PARÁMETROS ===============================================
+SUN_DATE   = datetime(2023, 6, 21)  # verano en CDMX (mismo día que el met de SOLWEIG)
+UTC_OFFSET = -6                     # CDMX sin horario de verano
+N_SECTORS  = 36                     # sectores de azimut para el SVF (cada 10°)
+SVF_RADIUS = 100.0                  # m, alcance de los rayos del SVF
+GROUND_TOL = 0.5                    # m; celdas por debajo = nivel de calle
+CHUNK_PX   = 1 << 16                # píxeles por bloque en la marcha de rayos
+PAD_LOW    = np.float32(-1e6)       # fuera del ráster: sin obstáculos
+WORKERS    = max(1, min(len(ZONES), (os.cpu_count() or 2) - 1))
+
+# ================== HELPERS ==================================================
+def _file_hash(p: Path, chunk: int = 1 << 20) -> str:
+    h = hashlib.blake2b(digest_size=10)
+    with open(p, "rb") as fh:
+        for block in iter(lambda: fh.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def solar_position(when_local: datetime, lat: float, lon: float, utc_offset: float = UTC_OFFSET):
+    """Azimut (° desde el norte, horario) y altura solar (°), algoritmo NOAA."""
+    when_utc = (when_local - timedelta(hours=utc_offset)).replace(tzinfo=timezone.utc)
+    jd = 2440587.5 + when_utc.timestamp() / 86400.0
+    jc = (jd - 2451545.0) / 36525.0
+
+    l0 = (280.46646 + jc * (36000.76983 + jc * 0.0003032)) % 360
+    m = 357.52911 + jc * (35999.05029 - 0.0001537 * jc)
+    e = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+    mr = np.radians(m)
+    c = (np.sin(mr) * (1.914602 - jc * (0.004817 + 0.000014 * jc))
+         + np.sin(2 * mr) * (0.019993 - 0.000101 * jc)
+         + np.sin(3 * mr) * 0.000289)
+    omega = np.radians(125.04 - 1934.136 * jc)
+    app_long = np.radians(l0 + c - 0.00569 - 0.00478 * np.sin(omega))
+    eps0 = 23 + (26 + (21.448 - jc * (46.815 + jc * (0.00059 - jc * 0.001813))) / 60) / 60
+    eps = np.radians(eps0 + 0.00256 * np.cos(omega))
+    decl = np.arcsin(np.sin(eps) * np.sin(app_long))
+
+    y = np.tan(eps / 2) ** 2
+    l0r = np.radians(l0)
+    eot = 4 * np.degrees(y * np.sin(2 * l0r) - 2 * e * np.sin(mr)
+                         + 4 * e * y * np.sin(mr) * np.cos(2 * l0r)
+                         - 0.5 * y * y * np.sin(4 * l0r) - 1.25 * e * e * np.sin(2 * mr))
+
+    minutes = when_local.hour * 60 + when_local.minute + when_local.second / 60
+    tst = (minutes + eot + 4 * lon - 60 * utc_offset) % 1440
+    ha = np.radians(tst / 4 + 180 if tst < 0 else tst / 4 - 180)
+
+    latr = np.radians(lat)
+    cos_zen = np.sin(latr) * np.sin(decl) + np.cos(latr) * np.cos(decl) * np.cos(ha)
+    zen = np.arccos(np.clip(cos_zen, -1, 1))
+    cos_az = (np.sin(latr) * np.cos(zen) - np.sin(decl)) / (np.cos(latr) * np.sin(zen))
+    az_deg = np.degrees(np.arccos(np.clip(cos_az, -1, 1)))
+    az = (az_deg + 180) % 360 if ha > 0 else (540 - az_deg) % 360
+    return float(az), float(90 - np.degrees(zen))
+
+
+def _horizon_chunks(dsm, res, azimuths, radius):
+    """
+    Tangente máxima de elevación del horizonte por bloques de CHUNK_PX píxeles:
+    genera (inicio, tan (K, n)) para K azimuts. Marcha por desplazamientos
+    enteros: un píxel por paso en el eje dominante de cada sector; todos los
+    sectores se leen en una sola indexación.
+    """
+    h, w = dsm.shape
+    r = max(1, int(np.ceil(radius / res)))
+    pad = np.pad(dsm.astype(np.float32), r, constant_values=PAD_LOW)
+    wp = w + 2 * r
+    flat = pad.ravel()
+
+    az = np.radians(np.asarray(azimuths, dtype=float))
+    ux, uy = np.sin(az), -np.cos(az)                      # columna, fila hacia el azimut
+    m = np.maximum(np.abs(ux), np.abs(uy))[:, None]
+    steps = np.arange(1, r + 1)[None, :]
+    dj = np.rint(steps * ux[:, None] / m).astype(np.int64)
+    di = np.rint(steps * uy[:, None] / m).astype(np.int64)
+    dist = (np.hypot(di, dj) * res).astype(np.float32)    # (K, T)
+    dist[dist > radius] = np.inf                          # fuera del alcance → sin aporte
+    offs = di * wp + dj
+
+    rows, cols = np.indices((h, w))
+    base = ((rows + r) * wp + cols + r).ravel()
+    z = dsm.ravel().astype(np.float32)
+
+    for s in range(0, h * w, CHUNK_PX):
+        b, zc = base[s:s + CHUNK_PX], z[s:s + CHUNK_PX]
+        acc = np.zeros((len(az), b.size), dtype=np.float32)
+        for t in range(offs.shape[1]):
+            if not np.isfinite(dist[:, t]).any():
+                break
+            vals = flat[b[None, :] + offs[:, t, None]]
+            vals -= zc
+            vals /= dist[:, t, None]
+            np.maximum(acc, vals, out=acc)
+        yield s, acc
+
+
+def horizon_tan(dsm, res, azimuths, radius):
+    """Horizonte completo (K, H, W); para pocos azimuts (sombras), el SVF reduce por bloque."""
+    h, w = dsm.shape
+    out = np.empty((len(azimuths), h * w), dtype=np.float32)
+    for s, acc in _horizon_chunks(dsm, res, azimuths, radius):
+        out[:, s:s + acc.shape[1]] = acc
+    return out.reshape(len(azimuths), h, w)
+
+
+def sky_view_factor(dsm, res, n_sectors=N_SECTORS, radius=SVF_RADIUS):
+    """
+    SVF de superficie horizontal: media de cos²(β) = 1 / (1 + tan²β) por sector,
+    reducida dentro de cada bloque (memoria: N_SECTORS × CHUNK_PX, no × H × W).
+    """
+    az = np.arange(n_sectors) * (360.0 / n_sectors)
+    svf = np.empty(dsm.size, dtype=np.float32)
+    for s, tan_h in _horizon_chunks(dsm, res, az, radius):
+        tan_h *= tan_h
+        tan_h += 1.0
+        np.reciprocal(tan_h, out=tan_h)
+        svf[s:s + tan_h.shape[1]] = tan_h.mean(axis=0, dtype=np.float32)
+    return svf.reshape(dsm.shape)
+
+
+def shadow_mask(dsm, res, azimuth, altitude):
+    """1 = sol, 0 = sombra (uint8). Alcance del rayo: desnivel máximo / tan(altura)."""
+    if altitude <= 0:
+        return np.zeros(dsm.shape, dtype=np.uint8)
+    tan_alt = np.tan(np.radians(altitude))
+    relief = float(np.nanmax(dsm) - np.nanmin(dsm))
+    radius = max(res, relief / tan_alt)
+    tan_h = horizon_tan(dsm, res, [azimuth], radius)[0]
+    return (tan_h <= tan_alt).astype(np.uint8)
+
+
+def _cached(path: Path, compute):
+    """Lee `arr` de un .npz de caché o lo calcula y lo publica con os.replace."""
+    if path.exists():
+        try:
+            with np.load(path) as npz:
+                return npz["arr"], True
+        except Exception:
+            pass  # caché corrupta → se recalcula
+    arr = compute()
+    tmp = path.with_name(path.stem + ".tmp.npz")
+    np.savez_compressed(tmp, arr=arr)
+    os.replace(tmp, path)
+    return arr, False
+
+
+def read_surface(zone_dir: Path):
+    """DSM (+ CDSM si existe) como float32 sin nodata, perfil y hash de las entradas."""
+    paths = [zone_dir / "DSM.tif"] + [p for p in [zone_dir / "CDSM.tif"] if p.exists()]
+    with rasterio.open(paths[0]) as ds:
+        dsm = ds.read(1, masked=True).astype(np.float32).filled(0.0)
+        profile = ds.profile.copy()
+    for p in paths[1:]:
+        with rasterio.open(p) as ds:
+            cdsm = ds.read(1, masked=True).astype(np.float32).filled(0.0)
+        if cdsm.shape != dsm.shape:
+            raise ValueError(f"{p}: forma {cdsm.shape} ≠ DSM {dsm.shape}")
+        dsm = np.maximum(dsm, cdsm)
+    key = "-".join(_file_hash(p) for p in paths)
+    return dsm, profile, key
+
+
+def zone_center_lonlat(profile):
+    """Centro de la grilla en lon/lat (WGS84)."""
+    t = profile["transform"]
+    x, y = t * (profile["width"] / 2, profile["height"] / 2)
+    lon, lat = warp_transform(profile["crs"], "EPSG:4326", [x], [y])
+    return lon[0], lat[0]
+
+
+def _write(path, arr, profile, dtype, nodata=None):
+    prof = dict(profile, driver="GTiff", count=1, dtype=dtype, nodata=nodata,
+                tiled=True, blockxsize=256, blockysize=256, compress="DEFLATE")
+    with rasterio.open(path, "w", **prof) as ds:
+        ds.write(arr.astype(dtype), 1)
+
+
+def interior_mask(shape, res):
+    """True fuera de la franja de SVF_RADIUS del borde (margen de contexto del DSM)."""
+    m = int(np.ceil(SVF_RADIUS / res))
+    inner = np.zeros(shape, dtype=bool)
+    inner[m:shape[0] - m, m:shape[1] - m] = True
+    return inner
+
+
+def process_zone(zone: str):
+    """SVF + sombras horarias de una zona (worker). Devuelve filas de resumen."""
+    zone_dir = DIR_UMEP / zone
+    dsm, profile, key = read_surface(zone_dir)
+    res = abs(profile["transform"].a)
+    lon, lat = zone_center_lonlat(profile)
+    inner = interior_mask(dsm.shape, res)
+    ground = inner & (dsm < GROUND_TOL)
+    zone_out = OUT_DIR / zone
+    zone_out.mkdir(parents=True, exist_ok=True)
+
+    svf, hit = _cached(CACHE_DIR / f"{zone}.{key}.svf_{N_SECTORS}_{SVF_RADIUS:g}.npz",
+                       lambda: sky_view_factor(dsm, res))
+    _write(zone_out / "SVF.tif", svf, profile, "float32")
+    svf_calle = float(svf[ground].mean()) if ground.any() else np.nan
+    log = [f"SVF {'caché' if hit else 'calculado'}"]
+    if not inner.any():
+        log.append(f"⚠️ ráster menor que 2×{SVF_RADIUS:g} m: sin interior para el resumen")
+
+    rows = []
+    for hour in HOURS:
+        az, alt = solar_position(SUN_DATE.replace(hour=hour), lat, lon)
+        sh, hit = _cached(CACHE_DIR / f"{zone}.{key}.sh_{az:.2f}_{alt:.2f}.npz",
+                          lambda: shadow_mask(dsm, res, az, alt))
+        _write(zone_out / f"shadow_{hour:02d}00.tif", sh, profile, "uint8")
+        log.append(f"{hour:02d}h {'caché' if hit else 'calculada'}")
+        rows.append({
+            "zona": zone, "hora": f"{hour:02d}:00",
+            "sol_azimut": round(az, 2), "sol_altura": round(alt, 2),
+            "svf_medio_calle": svf_calle,
+            "pct_sombra_calle": 100.0 * float((sh[ground] == 0).mean()) if ground.any() else np.nan,
+            "pct_sombra_total": 100.0 * float((sh[inner] == 0).mean()) if inner.any() else np.nan,
+            "dsm_hash": key,
+        })
+    pd.DataFrame(rows).to_csv(zone_out / "svf_sombra_resumen.csv", index=False, float_format="%.3f")
+    return zone, dsm.shape, res, log, rows
+
+# ================== MAIN =====================================================
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--zones", nargs="+", default=ZONES)
+    ap.add_argument("--workers", type=int, default=WORKERS)
+    args = ap.parse_args()
+
+    zones = [z for z in args.zones if (DIR_UMEP / z / "DSM.tif").exists()]
+    faltan = sorted(set(args.zones) - set(zones))
+    if faltan:
+        print(f"⚠️ Sin DSM.tif (se omiten): {faltan}")
+    if not zones:
+        raise FileNotFoundError(f"Sin DSM de zonas en {DIR_UMEP}/<zona>/DSM.tif")
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    print(f"→ SVF ({N_SECTORS} sectores, {SVF_RADIUS:g} m) y sombras {HOURS} h "
+          f"para {len(zones)} zonas en {args.workers} procesos…", flush=True)
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=args.workers) as ex:
+        for zone, shape, res, log, zone_rows in ex.map(process_zone, zones):
+            print(f"   · {zone}: {shape[1]}×{shape[0]} @ {res:g} m · " + " · ".join(log), flush=True)
+            rows.extend(zone_rows)
+
+    df = pd.DataFrame(rows)
+    print(df[["zona", "hora", "sol_azimut", "sol_altura", "svf_medio_calle", "pct_sombra_calle"]]
+          .to_string(index=False))
+
+    # Resumen global = unión de los resúmenes por zona (incluye zonas de corridas previas)
+    todas = pd.concat([pd.read_csv(p) for p in sorted(OUT_DIR.glob("*/svf_sombra_resumen.csv"))],
+                      ignore_index=True)
+    todas.to_csv(OUT_DIR / "svf_sombra_resumen.csv", index=False, float_format="%.3f")
+    print(f"→ Resumen global: {todas['zona'].nunique()} zonas en {OUT_DIR / 'svf_sombra_resumen.csv'}")
+    print(f"Listo ✅  SVF y sombras en {OUT_DIR}")
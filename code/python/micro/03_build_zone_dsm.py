@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+DSM de edificios por zona UMEP (huellas + alturas Spacematrix/catastro)
+=======================================================================
+
+SOLWEIG y el motor de SVF/sombras (`02_svf_shadow_engine.py`) necesitan un
+DSM de edificios por zona, pero el pipeline solo tiene huellas 2-D
+(`85d_buildings_filtered`) y los niveles estimados por manzana (L_equiv).
+
+Este script:
+1. Toma las zonas de la última corrida SOLO Syntax del priorizador
+   (`syntax_only_ZONES_*` en `analisis_final_tipologias_syntaxONLY_*.gpkg`);
+   por defecto las `N_ZONES` primeras (mayor score medio), o las de `ZONE_IDS`.
+   Se nombran `zone_01`, `zone_02`, … en ese orden.
+2. Asigna altura a cada huella (`FLOOR_H_M` por nivel), en este orden:
+   - **catastro**: Σ superficie_construccion de los puntos dentro de la
+     huella / área de la huella;
+   - **L_equiv** de la manzana que contiene el centroide de la huella;
+   - **default**: `DEFAULT_LEVELS`.
+   El punto de catastro lleva la superficie de todo el predio, que puede
+   tener varias huellas: si el valor de catastro supera `CAT_MAX_RATIO` ×
+   L_equiv se usa L_equiv. Los niveles se recortan a [`MIN_LEVELS`,
+   `MAX_LEVELS`]; el resumen cuenta ambos casos.
+3. Rasteriza a `RES_M` m la zona + `ZONE_MARGIN_M` (contexto para sombras y
+   SVF), con las huellas ordenadas por altura (la más alta gana en solapes).
+
+Las zonas se procesan en paralelo (`ProcessPoolExecutor`). Cada worker lee
+solo su bbox de huellas, puntos y manzanas: el filtro espacial usa el índice
+R-tree de los GPKG, así que ninguna zona recorre la capa completa.
+
+Salida
+------
+- `<DIR_UMEP>/<zona>/DSM.tif`              (float32, altura sobre el terreno en m; 0 = calle)
+- `<DIR_UMEP>/<zona>/edificios_<zona>.gpkg` (huellas con `niveles`, `altura_m`, `fuente_altura`)
+- `<DIR_UMEP>/dsm_resumen.csv`              (zona, grilla, huellas por fuente, alturas,
+                                             catastro descartado, recortes en MAX_LEVELS)
+
+Requisitos: numpy, pandas, geopandas, pyogrio, shapely, rasterio.
+"""
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyogrio
+import shapely
+import rasterio
+from rasterio.features import rasterize
+from rasterio.transform import from_origin
+
+# ================== RUTAS ====================================================
+DATA_DIR  = Path("/Users/danielaresendiz/Library/CloudStorage/OneDrive-UniversityCollegeLondon(2)/Dissertation/01_data")
+ZONES_DIR = DATA_DIR / "01_Manzana"
+ZONES_GPKG = None           # None → último analisis_final_tipologias_syntaxONLY_*.gpkg
+ZONES_LAYER = None          # None → capa syntax_only_ZONES_* del GPKG
+
+SM_GPKG  = DATA_DIR / "GWR/GWR_merge/manzanas_master_con_GWR_spacematrix_v3lite_fixBF.gpkg"
+SM_LAYER = "manzanas_v3lite_fixBF"
+CITY_GPKG = DATA_DIR / "Data_catastro/citywide_build/cdmx_citywide.gpkg"
+BUILDINGS_GPKG  = DATA_DIR / "space_matrix/Catastro/85d_buildings_filtered.gpkg"
+BUILDINGS_LAYER = "85d_buildings_filtered"
+
+DIR_UMEP = DATA_DIR / "UMEP"
+
+# ================== PARÁMETROS ===============================================
+CRS_METERS    = 32614
+ZONE_IDS      = None        # p. ej. [12, 4, 31]; None → las N_ZONES primeras
+N_ZONES       = 3
+RES_M         = 1.0         # resolución del DSM (1–2 m)
+ZONE_MARGIN_M = 100.0       # contexto alrededor de la zona (= alcance del SVF)
+FLOOR_H_M     = 3.0         # altura por nivel
+MIN_LEVELS, MAX_LEVELS = 1.0, 60.0
+DEFAULT_LEVELS = 1.0
+CAT_MAX_RATIO = 4.0         # catastro > 4× L_equiv → predio con varias huellas; usa L_equiv
+MIN_B_AREA_M2 = 10.0        # filtra slivers de huella (igual que Spacematrix)
+WORKERS       = max(1, (os.cpu_count() or 2) - 1)
+
+# ================== HELPERS ==================================================
+def _bbox_mask(bbox):
+    """bbox (xmin, ymin, xmax, ymax) en CRS_METERS → máscara para read_file."""
+    return gpd.GeoSeries([shapely.box(*bbox)], crs=CRS_METERS)
+
+
+def find_zones_source():
+    """GPKG y capa de zonas de la corrida SOLO Syntax más reciente."""
+    gpkg = ZONES_GPKG
+    if gpkg is None:
+        runs = sorted(p for p in ZONES_DIR.glob("analisis_final_tipologias_syntaxONLY_*.gpkg")
+                      if "_sweep_" not in p.name)
+        if not runs:
+            raise FileNotFoundError(f"Sin GPKG syntaxONLY en {ZONES_DIR}; corre meso/08 primero.")
+        gpkg = runs[-1]
+    layer = ZONES_LAYER
+    if layer is None:
+        names = [n for n, _ in pyogrio.list_layers(gpkg) if n.startswith("syntax_only_ZONES_")]
+        if not names:
+            raise ValueError(f"{gpkg.name}: sin capa syntax_only_ZONES_*")
+        layer = sorted(names)[-1]
+    return Path(gpkg), layer
+
+
+def check_spatial_index(path, layer):
+    """Avisa si la capa no tiene índice espacial (el filtro bbox recorrería todo)."""
+    info = pyogrio.read_info(path, layer=layer)
+    if not info.get("capabilities", {}).get("fast_spatial_filter", False):
+        print(f"⚠️ {Path(path).name}:{layer} sin índice espacial; cada zona leerá la capa "
+              f"completa (crea el R-tree con: ogrinfo <gpkg> -sql \"SELECT CreateSpatialIndex('{layer}', 'geom')\")")
+
+
+def grid_for(bounds, res):
+    """Grilla alineada a múltiplos de `res` que cubre `bounds` → (transform, ancho, alto)."""
+    xmin, ymin, xmax, ymax = bounds
+    xmin, ymin = np.floor(xmin / res) * res, np.floor(ymin / res) * res
+    xmax, ymax = np.ceil(xmax / res) * res, np.ceil(ymax / res) * res
+    width, height = int(round((xmax - xmin) / res)), int(round((ymax - ymin) / res))
+    return from_origin(xmin, ymax, res, res), width, height
+
+
+def footprint_levels(build: gpd.GeoDataFrame, cat: gpd.GeoDataFrame, manz: gpd.GeoDataFrame):
+    """
+    Niveles por huella (alineados con `build`) y fuente: catastro → L_equiv → default.
+    Un punto de catastro cuenta en una sola huella (la primera que lo contiene);
+    si sus niveles superan CAT_MAX_RATIO × L_equiv se descartan a favor de L_equiv.
+    Devuelve (niveles, fuente, catastro_descartado, recortado_en_MAX_LEVELS).
+    """
+    bg = build.geometry.to_numpy()
+    area = shapely.area(bg)
+    n = len(bg)
+
+    f_cat = np.zeros(n)
+    if not cat.empty:
+        sup = pd.to_numeric(cat["superficie_construccion"], errors="coerce").to_numpy(dtype=float)
+        ok = np.isfinite(sup) & (sup > 0)
+        ip, ib = build.sindex.query(cat.geometry.to_numpy()[ok], predicate="within")
+        ip, first = np.unique(ip, return_index=True)
+        f_cat = np.bincount(ib[first], weights=sup[ok][ip], minlength=n)
+    lv_cat = np.where(f_cat > 0, f_cat / area, np.nan)
+
+    lv_sm = np.full(n, np.nan)
+    if not manz.empty:
+        ic, im = manz.sindex.query(shapely.centroid(bg), predicate="within")
+        ic, first = np.unique(ic, return_index=True)
+        l_eq = pd.to_numeric(manz["L_equiv"], errors="coerce").to_numpy(dtype=float)
+        lv_sm[ic] = l_eq[im[first]]
+    lv_sm[~(lv_sm > 0)] = np.nan
+
+    # superficie de todo el predio concentrada en una huella → niveles inflados
+    excess = lv_cat > CAT_MAX_RATIO * lv_sm   # False si alguno es NaN
+    lv_cat[excess] = np.nan
+
+    levels = np.where(np.isfinite(lv_cat), lv_cat, np.where(np.isfinite(lv_sm), lv_sm, DEFAULT_LEVELS))
+    source = np.where(np.isfinite(lv_cat), "catastro", np.where(np.isfinite(lv_sm), "L_equiv", "default"))
+    return np.clip(levels, MIN_LEVELS, MAX_LEVELS), source, excess, levels > MAX_LEVELS
+
+
+def build_zone_dsm(job):
+    """Worker: huellas de la zona (lectura por bbox) → alturas → DSM.tif. Devuelve resumen."""
+    name, zone_id, zone_wkb = job
+    zone = shapely.from_wkb(zone_wkb)
+    area_geom = shapely.buffer(zone, ZONE_MARGIN_M)
+    transform, width, height = grid_for(area_geom.bounds, RES_M)
+    bbox = (transform.c, transform.f - height * RES_M, transform.c + width * RES_M, transform.f)
+    mask = _bbox_mask(bbox)
+
+    build = gpd.read_file(BUILDINGS_GPKG, layer=BUILDINGS_LAYER, bbox=mask, engine="pyogrio",
+                          columns=[], use_arrow=True).to_crs(CRS_METERS)
+    build = build[build.geometry.notna() & build.is_valid].copy()
+    build["geometry"] = build.buffer(0)
+    build = build[build.intersects(area_geom) & (build.area >= MIN_B_AREA_M2)].reset_index(drop=True)
+
+    cat = gpd.read_file(CITY_GPKG, layer="catastro_puntos", bbox=mask, engine="pyogrio",
+                        use_arrow=True).to_crs(CRS_METERS)
+    if "superficie_construccion" not in cat.columns and "sup_const_tot_m2" in cat.columns:
+        cat = cat.rename(columns={"sup_const_tot_m2": "superficie_construccion"})
+    if "superficie_construccion" not in cat.columns:
+        cat["superficie_construccion"] = np.nan
+    manz = gpd.read_file(SM_GPKG, layer=SM_LAYER, bbox=mask, engine="pyogrio",
+                         columns=["L_equiv"], use_arrow=True).to_crs(CRS_METERS)
+
+    levels, source, excess, clip_max = footprint_levels(build, cat, manz)
+    build["niveles"] = levels
+    build["altura_m"] = levels * FLOOR_H_M
+    build["fuente_altura"] = source
+
+    order = np.argsort(build["altura_m"].to_numpy(), kind="stable")  # la más alta se escribe al final
+    dsm = rasterize(zip(build.geometry.to_numpy()[order], build["altura_m"].to_numpy()[order]),
+                    out_shape=(height, width), transform=transform, fill=0.0, dtype="float32")
+
+    zone_dir = DIR_UMEP / name
+    zone_dir.mkdir(parents=True, exist_ok=True)
+    profile = dict(driver="GTiff", width=width, height=height, count=1, dtype="float32",
+                   crs=f"EPSG:{CRS_METERS}", transform=transform, tiled=True,
+                   blockxsize=256, blockysize=256, compress="DEFLATE", predictor=3)
+    with rasterio.open(zone_dir / "DSM.tif", "w", **profile) as ds:
+        ds.write(dsm, 1)
+    pyogrio.write_dataframe(build, zone_dir / f"edificios_{name}.gpkg", layer=f"edificios_{name}",
+                            driver="GPKG", use_arrow=True)
+
+    h = build["altura_m"].to_numpy()
+    row = {"zona": name, "zone_id": zone_id, "ancho_px": width, "alto_px": height, "res_m": RES_M,
+           "n_edificios": len(build),
+           **{f"n_{s}": int((source == s).sum()) for s in ("catastro", "L_equiv", "default")},
+           "n_cat_a_L_equiv": int(excess.sum()), "n_clip_max": int(clip_max.sum()),
+           "altura_med_m": float(np.median(h)) if h.size else np.nan,
+           "altura_p90_m": float(np.percentile(h, 90)) if h.size else np.nan,
+           "altura_max_m": float(h.max()) if h.size else np.nan,
+           "pct_huella": 100.0 * float((dsm > 0).mean())}
+    return row
+
+# ================== MAIN =====================================================
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--zone-ids", nargs="+", type=int, default=ZONE_IDS)
+    ap.add_argument("--n-zones", type=int, default=N_ZONES)
+    ap.add_argument("--workers", type=int, default=WORKERS)
+    args = ap.parse_args()
+
+    zones_gpkg, zones_layer = find_zones_source()
+    zones = gpd.read_file(zones_gpkg, layer=zones_layer).to_crs(CRS_METERS)
+    zones["zone_id"] = zones["zone_id"].astype(int)
+    if args.zone_ids:
+        faltan = sorted(set(args.zone_ids) - set(zones["zone_id"]))
+        if faltan:
+            raise ValueError(f"zone_id no encontrados en {zones_layer}: {faltan}")
+        zones = zones.set_index("zone_id").loc[args.zone_ids].reset_index()
+    else:
+        zones = zones.head(args.n_zones)
+    print(f"✔ {len(zones)} zonas de {zones_gpkg.name}:{zones_layer} → ids {zones['zone_id'].tolist()}")
+
+    for path, layer in [(BUILDINGS_GPKG, BUILDINGS_LAYER), (CITY_GPKG, "catastro_puntos"), (SM_GPKG, SM_LAYER)]:
+        check_spatial_index(path, layer)
+
+    jobs = [(f"zone_{k:02d}", int(z), shapely.to_wkb(g))
+            for k, (z, g) in enumerate(zip(zones["zone_id"], zones.geometry), start=1)]
+    workers = max(1, min(args.workers, len(jobs)))
+    print(f"→ DSM a {RES_M:g} m (+{ZONE_MARGIN_M:g} m de contexto) en {workers} procesos…", flush=True)
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        for row in ex.map(build_zone_dsm, jobs):
+            print(f"   · {row['zona']} (id {row['zone_id']}): {row['ancho_px']}×{row['alto_px']} px, "
+                  f"{row['n_edificios']} edificios (catastro {row['n_catastro']}, "
+                  f"L_equiv {row['n_L_equiv']}, default {row['n_default']}), "
+                  f"altura p90 {row['altura_p90_m']:.1f} m", flush=True)
+            if row["n_cat_a_L_equiv"] or row["n_clip_max"]:
+                print(f"     ⚠️ catastro > {CAT_MAX_RATIO:g}×L_equiv → L_equiv en {row['n_cat_a_L_equiv']} huellas; "
+                      f"{row['n_clip_max']} recortadas a {MAX_LEVELS:g} niveles", flush=True)
+            rows.append(row)
+
+    DIR_UMEP.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame(rows).to_csv(DIR_UMEP / "dsm_resumen.csv", index=False, float_format="%.2f")
+    print(f"Listo ✅  DSM por zona en {DIR_UMEP}/<zona>/DSM.tif")
+    print(f"→ Siguiente paso: python 02_svf_shadow_engine.py --zones {' '.join(j[0] for j in jobs)}")
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Cubo térmico multianual (Zarr) a partir de los GeoTIFF anuales de Landsat
+=========================================================================
+
+Objetivo
+--------
+Los rásters por año exportados desde GEE (`LST_day_YYYY`, `Ta_clim_YYYY`,
+`UHI_air_YYYY`, `UTFVI_air_YYYY`; y `NDVI_YYYY`, `NDBI_YYYY`, `Albedo_YYYY`
+si existen) se leían archivo por archivo en cada análisis. Este script los
+apila en **un solo arreglo comprimido y fragmentado** con dimensiones
+`(time, variable, y, x)`.
+
+- Chunks espaciales de `CHUNK_XY × CHUNK_XY` píxeles con **todos los años en
+  el mismo chunk** y una variable por chunk: una ventana de 2 km (~67 px a
+  30 m) a lo largo de 11 años toca a lo sumo 4 chunks por variable.
+- La escritura se hace por **franjas de `CHUNK_XY` filas** alineadas a los
+  chunks (lecturas por ventana con rasterio), así que la memoria queda
+  acotada por `n_años × CHUNK_XY × ancho` y no por el ráster completo.
+- Años/variables sin archivo se dejan en NaN (se reporta en consola).
+
+Lectura perezosa
+----------------
+`open_cube()` devuelve el arreglo Zarr sin leer datos y `read_window()`
+extrae solo los chunks que cubren una ventana (x, y, tamaño en m);
+`window_transform()` da el affine de esa misma ventana. Las etapas
+de extracción, tendencias y escenarios deben usar estas funciones en lugar de
+abrir los GeoTIFF anuales. `meso/03_extract_thermal_to_segments.py` ya lee el
+cubo con estas funciones, una ventana por lote de segmentos, para las medias
+anuales por segmento.
+
+Salida
+------
+- `<DIR_RASTERS>/thermal_cube.zarr` (atributos: years, variables, crs,
+  transform, nodata).
+
+Run:
+  python 02_build_thermal_cube.py                       # construir el cubo
+  python 02_build_thermal_cube.py --window -99.13 19.43 # serie 2 km de prueba
+
+Requisitos: numpy, rasterio, zarr.
+"""
+
+from pathlib import Path
+import argparse
+import math
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+from rasterio.windows import Window
+import zarr
+
+# ================== RUTAS ====================================================
+DIR_RASTERS = Path("/Users/danielaresendiz/Library/CloudStorage/OneDrive-UniversityCollegeLondon(2)/Dissertation/01_data/Heat")
+CUBE_PATH   = DIR_RASTERS / "thermal_cube.zarr"
+
+# ================== PARÁMETROS ===============================================
+YEARS    = list(range(2014, 2025))
+CHUNK_XY = 128        # píxeles por lado de cada chunk espacial
+WINDOW_M = 2000.0     # tamaño por defecto de la ventana de lectura (m)
+
+# Variable del cubo → patrón del GeoTIFF anual (nombres de exportación GEE)
+VARIABLES = {
+    "Ta":      "Ta_clim_{year}.tif",
+    "LST":     "LST_day_{year}.tif",
+    "NDVI":    "NDVI_{year}.tif",
+    "NDBI":    "NDBI_{year}.tif",
+    "Albedo":  "Albedo_{year}.tif",
+    "UHI_air": "UHI_air_{year}.tif",
+    "UTFVI":   "UTFVI_air_{year}.tif",
+}
+
+# ================== HELPERS ==================================================
+def _inventory(dir_rasters: Path):
+    """Mapa (variable, año) → ruta existente y grilla de referencia común."""
+    found = {}
+    for var, pattern in VARIABLES.items():
+        for y in YEARS:
+            p = dir_rasters / pattern.format(year=y)
+            if p.exists():
+                found[(var, y)] = p
+    if not found:
+        raise FileNotFoundError(f"No encontré GeoTIFF anuales en {dir_rasters}")
+
+    ref = None
+    for (var, y), p in found.items():
+        with rasterio.open(p) as ds:
+            grid = (ds.crs, ds.transform, ds.width, ds.height)
+        if ref is None:
+            ref = grid
+        elif grid != ref:
+            raise ValueError(f"{p.name} no está alineado con la grilla de referencia "
+                             f"(crs/transform/tamaño distintos). Remuestrea antes de apilar.")
+    return found, ref
+
+
+def build_cube(dir_rasters: Path = DIR_RASTERS, cube_path: Path = CUBE_PATH):
+    found, (crs, transform, width, height) = _inventory(dir_rasters)
+    variables = list(VARIABLES)
+    n_t, n_v = len(YEARS), len(variables)
+
+    missing = [f"{v}_{y}" for v in variables for y in YEARS if (v, y) not in found]
+    if missing:
+        print(f"⚠️ {len(missing)} combinaciones variable/año sin archivo → NaN "
+              f"(p.ej. {', '.join(missing[:4])}{'…' if len(missing) > 4 else ''})")
+
+    cube = zarr.open_array(
+        str(cube_path), mode="w",
+        shape=(n_t, n_v, height, width),
+        chunks=(n_t, 1, CHUNK_XY, CHUNK_XY),
+        dtype="f4", fill_value=np.nan,
+    )
+    cube.attrs.update({
+        "dims": ["time", "variable", "y", "x"],
+        "years": YEARS,
+        "variables": variables,
+        "crs": crs.to_string() if crs else None,
+        "transform": list(transform)[:6],
+        "nodata": "NaN",
+    })
+
+    print(f"→ Cubo {cube.shape} (chunks {cube.chunks}) en {cube_path.name}")
+    for vi, var in enumerate(variables):
+        paths = [found.get((var, y)) for y in YEARS]
+        if not any(paths):
+            continue
+        handles = [rasterio.open(p) if p else None for p in paths]
+        try:
+            for r0 in range(0, height, CHUNK_XY):
+                h = min(CHUNK_XY, height - r0)
+                win = Window(0, r0, width, h)
+                stripe = np.full((n_t, h, width), np.nan, dtype="f4")
+                for ti, ds in enumerate(handles):
+                    if ds is None:
+                        continue
+                    band = ds.read(1, window=win, masked=True).astype("f4")
+                    stripe[ti] = band.filled(np.nan)
+                cube[:, vi, r0:r0 + h, :] = stripe
+        finally:
+            for ds in handles:
+                if ds is not None:
+                    ds.close()
+        print(f"   · {var}: {sum(p is not None for p in paths)}/{n_t} años")
+    print(f"✅ Cubo escrito: {cube_path}")
+    return cube
+
+# ================== LECTURA PEREZOSA =========================================
+def open_cube(cube_path: Path = CUBE_PATH):
+    """Abre el cubo en modo lectura; no carga datos hasta indexar."""
+    return zarr.open_array(str(cube_path), mode="r")
+
+
+def _window_pixels(cube, x: float, y: float, size_m: float):
+    """Ventana (fila/columna) centrada en (x, y) en el CRS del cubo."""
+    a, b, c, d, e, f = cube.attrs["transform"]
+    half_x = half_y = size_m / 2.0
+    crs = (cube.attrs.get("crs") or "").upper()
+    if crs in ("EPSG:4326", "OGC:CRS84"):
+        # grados ↔ metros (aprox. local; suficiente para recortes de ventanas)
+        half_y = half_y / 111_320.0
+        half_x = half_x / (111_320.0 * math.cos(math.radians(y)))
+    col0 = int(math.floor((x - half_x - c) / a))
+    col1 = int(math.ceil((x + half_x - c) / a))
+    row0 = int(math.floor((y + half_y - f) / e))
+    row1 = int(math.ceil((y - half_y - f) / e))
+    _, _, H, W = cube.shape
+    return max(row0, 0), min(row1, H), max(col0, 0), min(col1, W)
+
+
+def read_window(x: float, y: float, size_m: float = WINDOW_M, variables=None, years=None,
+                cube=None):
+    """
+    Lee solo los chunks que cubren la ventana (x, y, size_m).
+    Devuelve (arr[time, variable, y, x], years, variables).
+    """
+    cube = cube if cube is not None else open_cube()
+    all_years = list(cube.attrs["years"])
+    all_vars = list(cube.attrs["variables"])
+    years = list(years) if years is not None else all_years
+    variables = list(variables) if variables is not None else all_vars
+    ti = [all_years.index(yv) for yv in years]
+    vi = [all_vars.index(v) for v in variables]
+
+    r0, r1, c0, c1 = _window_pixels(cube, x, y, size_m)
+    if r0 >= r1 or c0 >= c1:
+        return np.empty((len(ti), len(vi), 0, 0), dtype="f4"), years, variables
+    # un slice por variable: cada chunk ya contiene todos los años
+    t_sl = slice(min(ti), max(ti) + 1)
+    block = np.stack([np.asarray(cube[t_sl, v, r0:r1, c0:c1]) for v in vi], axis=1)
+    block = block[[t - t_sl.start for t in ti]]
+    return block, years, variables
+
+
+def window_transform(x: float, y: float, size_m: float = WINDOW_M, cube=None):
+    """Affine de la ventana que devuelve read_window() con los mismos argumentos."""
+    cube = cube if cube is not None else open_cube()
+    a, b, c, d, e, f = cube.attrs["transform"]
+    r0, _, c0, _ = _window_pixels(cube, x, y, size_m)
+    return Affine(a, b, c + c0 * a, d, e, f + r0 * e)
+
+# ================== MAIN =====================================================
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--window", nargs=2, type=float, metavar=("X", "Y"),
+                    help="Solo lectura: serie anual media en una ventana centrada en X Y (CRS del cubo)")
+    ap.add_argument("--size-m", type=float, default=WINDOW_M, help="Tamaño de la ventana (m)")
+    args = ap.parse_args()
+
+    if args.window:
+        arr, yrs, vars_ = read_window(args.window[0], args.window[1], args.size_m)
+        print(f"Ventana {arr.shape[-2]}×{arr.shape[-1]} px")
+        with np.errstate(all="ignore"):
+            means = np.nanmean(arr.reshape(arr.shape[0], arr.shape[1], -1), axis=2)
+        for t, yv in enumerate(yrs):
+            print(yv, "  ".join(f"{v}={means[t, k]:.2f}" for k, v in enumerate(vars_)))
+    else:
+        build_cube()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Preparación de rásters de climatología como Cloud-Optimized GeoTIFF (COG)
+=========================================================================
+
+Los rásters de climatología (`Albedo_clim.tif`, `LST_day_clim.tif`,
+`Ta_clim.tif`, …) salen de GEE en franjas (strips) a resolución completa:
+la extracción por segmentos (`meso/03_extract_thermal_to_segments.py`) y
+los estilos de `qgis/*.qml` terminan leyendo franjas enteras aunque solo
+necesiten una ventana o una vista general.
+
+Este script:
+1. **Verifica que todas las grillas estén alineadas** (CRS, transform y
+   tamaño idénticos). Si no, se detiene: mezclar grillas desalineadas en la
+   extracción produce medias sesgadas sin aviso.
+2. Reescribe cada ráster como **COG teselado** (`BLOCKSIZE`×`BLOCKSIZE`) con
+   **overviews internas** (promedio) y compresión DEFLATE + predictor.
+3. Unifica el **nodata** a `NODATA` (los NaN y el nodata original pasan a
+   `NODATA`), para que rasterstats/QGIS lo interpreten igual en todas las capas.
+
+Salida
+------
+- `<DIR_RASTERS>/cog/<nombre>.tif` (mismo nombre que el original).
+  La extracción por segmentos usa esta carpeta automáticamente si existe.
+
+Requisitos: numpy, rasterio (GDAL ≥ 3.1 para el driver COG).
+"""
+
+from pathlib import Path
+import tempfile
+import numpy as np
+import rasterio
+from rasterio.shutil import copy as rio_copy
+
+# ================== RUTAS ====================================================
+DIR_RASTERS = Path("/Users/danielaresendiz/Library/CloudStorage/OneDrive-UniversityCollegeLondon(2)/Dissertation/01_data/Heat")
+OUT_DIR     = DIR_RASTERS / "cog"
+
+CLIM_RASTERS = [
+    "Albedo_clim.tif", "LST_day_clim.tif", "NDVI_clim.tif", "NDBI_clim.tif",
+    "Ta_clim.tif", "UHI_air_clim.tif", "UTFVI_air_clim.tif",
+]
+
+# ================== PARÁMETROS ===============================================
+NODATA    = -9999.0
+BLOCKSIZE = 512
+COG_OPTS  = {
+    "COMPRESS": "DEFLATE",
+    "PREDICTOR": "YES",          # predictor flotante para Float32
+    "OVERVIEWS": "AUTO",
+    "OVERVIEW_RESAMPLING": "AVERAGE",
+    "NUM_THREADS": "ALL_CPUS",
+    "BIGTIFF": "IF_SAFER",
+}
+
+# ================== HELPERS ==================================================
+def check_alignment(paths):
+    """Falla si algún ráster no comparte CRS/transform/tamaño con el primero."""
+    ref, ref_name, bad = None, None, []
+    for p in paths:
+        with rasterio.open(p) as ds:
+            grid = (ds.crs, ds.transform, ds.width, ds.height)
+        if ref is None:
+            ref, ref_name = grid, p.name
+        elif grid != ref:
+            bad.append(p.name)
+    if bad:
+        raise ValueError(f"Grillas desalineadas respecto a {ref_name}: {bad}. "
+                         f"Remuestrea a la grilla de referencia antes de convertir.")
+    return ref
+
+
+def to_cog(src_path: Path, dst_path: Path, nodata: float = NODATA):
+    """Copia por bloques a un GTiff teselado con nodata unificado y lo traduce a COG."""
+    with rasterio.open(src_path) as src:
+        profile = src.profile.copy()
+        profile.update(driver="GTiff", dtype="float32", nodata=nodata,
+                       tiled=True, blockxsize=BLOCKSIZE, blockysize=BLOCKSIZE,
+                       compress="DEFLATE")
+        with tempfile.TemporaryDirectory(dir=dst_path.parent) as tmp_dir:
+            tmp = Path(tmp_dir) / src_path.name
+            with rasterio.open(tmp, "w", **profile) as tmp_ds:
+                for _, win in tmp_ds.block_windows(1):
+                    for b in range(1, src.count + 1):
+                        arr = src.read(b, window=win, masked=True).astype("float32")
+                        arr = np.ma.masked_invalid(arr)
+                        tmp_ds.write(arr.filled(nodata), b, window=win)
+            rio_copy(tmp, dst_path, driver="COG", BLOCKSIZE=BLOCKSIZE, **COG_OPTS)
+
+    with rasterio.open(dst_path) as ds:
+        n_ovr = len(ds.overviews(1))
+        blocks = ds.block_shapes[0]
+    return n_ovr, blocks
+
+# ================== MAIN =====================================================
+if __name__ == "__main__":
+    paths = [DIR_RASTERS / n for n in CLIM_RASTERS if (DIR_RASTERS / n).exists()]
+    faltan = [n for n in CLIM_RASTERS if not (DIR_RASTERS / n).exists()]
+    if faltan:
+        print(f"⚠️ No encontrados (se omiten): {faltan}")
+    if not paths:
+        raise FileNotFoundError(f"Sin rásters de climatología en {DIR_RASTERS}")
+
+    crs, transform, width, height = check_alignment(paths)
+    print(f"✔ {len(paths)} grillas alineadas ({width}×{height}, {crs})")
+
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
+    for p in paths:
+        n_ovr, blocks = to_cog(p, OUT_DIR / p.name)
+        print(f"   · {p.name}: bloques {blocks}, {n_ovr} overviews, nodata={NODATA}")
+
+    print(f"Listo ✅  COGs en {OUT_DIR}")
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Motor local de compuestos de verano Landsat (réplica de landsat_thermal_climatology.js)
+======================================================================================
+
+Reproduce **sin Google Earth Engine** los productos térmicos del script
+`code/gee/landsat_thermal_climatology.js` a partir de escenas Landsat 8/9
+Collection 2 Level-2 descargadas localmente (USGS EarthExplorer / M2M):
+
+- `preprocess`: factores de escala (ópticas ×0.0000275 − 0.2; térmica
+  ×0.00341802 + 149.0) y máscara QA_PIXEL con los **mismos bits** que el JS
+  (3, 4 y 5 → nube, sombra de nube y nieve en C2; el JS los comenta como
+  sombra/cirros/nubes). Los píxeles de relleno (DN = 0) también se enmascaran.
+- Filtro `CLOUD_COVER < 20` (leído del `_MTL.txt`) y ventana de fechas
+  `[1-jun, 31-ago)` igual que `ee.Date.fromYMD(y,6,1)`/`fromYMD(y,8,31)`.
+- **Mediana por píxel y por banda** de cada verano y **media de los
+  veranos** (`summerClim`).
+- NDVI, NDBI, albedo (media B2–B4), emisividad desde NDVI, LST diurna,
+  `Ta = COEF_A·LST + COEF_B`.
+- Capas anuales `LST_day_YYYY`, `Ta_clim_YYYY` (emisividad climatológica,
+  como en el JS) y además `NDVI_YYYY`, `NDBI_YYYY`, `Albedo_YYYY` para el
+  cubo multianual.
+- UHI_air y UTFVI_air (climatología y anuales) se calculan después con
+  `05_normalize_uhi_utfvi.py --dir OUT_DIR` (estadísticos en streaming).
+
+Procesamiento
+-------------
+- La grilla destino es el AOI en EPSG:4326 a ~30 m (como el export de GEE).
+  Cada escena se reproyecta al vuelo con `WarpedVRT` (vecino más cercano) y
+  solo se lee la ventana del bloque.
+- **Bloque por bloque** (`BLOCK`×`BLOCK` px) en un **pool de procesos**; solo
+  se leen las escenas cuyo footprint toca el bloque. La memoria por worker
+  queda acotada por `n_escenas_año × 7 bandas × BLOCK²`.
+
+Estructura esperada de `SCENES_DIR`
+----------------------------------
+  <SCENES_DIR>/**/LC08_L2SP_026047_20190615_20200827_02_T1_SR_B2.TIF
+  … _SR_B3/_SR_B4/_SR_B5/_SR_B6/_ST_B10/_QA_PIXEL.TIF y _MTL.txt
+
+Run:
+  python 04_landsat_summer_composite.py --workers 6
+  python 04_landsat_summer_composite.py --aoi -99.2 19.3 -99.0 19.5
+
+Requisitos: numpy, rasterio.
+"""
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+import argparse
+import os
+import re
+import warnings
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+
+# ================== RUTAS ====================================================
+SCENES_DIR = Path("/Users/danielaresendiz/Library/CloudStorage/OneDrive-UniversityCollegeLondon(2)/Dissertation/01_data/Landsat_C2L2")
+OUT_DIR    = Path("/Users/danielaresendiz/Library/CloudStorage/OneDrive-UniversityCollegeLondon(2)/Dissertation/01_data/Heat/local_engine")
+
+# ================== PARÁMETROS (idénticos al JS) =============================
+AOI       = (-99.400, 19.100, -98.900, 19.700)   # lon_min, lat_min, lon_max, lat_max
+SCALE_M   = 30.0
+DST_CRS   = "EPSG:4326"
+YEARS     = list(range(2014, 2025))
+COEF_A    = 0.554038    # pendiente LST→Ta
+COEF_B    = 5.760580    # intercepto LST→Ta
+MAX_CLOUD = 20.0
+QA_BITS   = (3, 4, 5)   # bits enmascarados de QA_PIXEL
+
+BANDS = ["SR_B2", "SR_B3", "SR_B4", "SR_B5", "SR_B6", "ST_B10", "QA_PIXEL"]
+BLOCK   = 256
+WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+# Productos por bloque: climatología + anuales
+CLIM_PRODUCTS = ["NDVI_clim", "NDBI_clim", "Albedo_clim", "LST_day_clim", "Ta_clim"]
+YEAR_PRODUCTS = ["NDVI_{y}", "NDBI_{y}", "Albedo_{y}", "LST_day_{y}", "Ta_clim_{y}"]
+
+PRODUCT_RE = re.compile(r"(L[CO]0[89]_L2SP_\d{6}_(\d{8})_\d{8}_02_T[12])")
+
+# ================== INVENTARIO DE ESCENAS ====================================
+def _cloud_cover(mtl: Path) -> float:
+    for line in mtl.read_text(errors="ignore").splitlines():
+        if line.strip().startswith("CLOUD_COVER ="):
+            return float(line.split("=")[1].strip().strip('"'))
+    return np.nan
+
+
+def find_scenes(scenes_dir: Path, years=YEARS, max_cloud=MAX_CLOUD):
+    """Escenas de verano completas (7 bandas + MTL) con nubosidad < max_cloud."""
+    groups = {}
+    for tif in scenes_dir.rglob("*.TIF"):
+        m = PRODUCT_RE.search(tif.name)
+        if not m:
+            continue
+        band = tif.stem[len(m.group(1)) + 1:]
+        if band in BANDS:
+            groups.setdefault(m.group(1), {})[band] = tif
+
+    scenes = []
+    for pid, paths in sorted(groups.items()):
+        acq = PRODUCT_RE.search(pid).group(2)
+        d = date(int(acq[:4]), int(acq[4:6]), int(acq[6:]))
+        # filterDate(fromYMD(y,6,1), fromYMD(y,8,31)) → fin exclusivo
+        if d.year not in years or not (date(d.year, 6, 1) <= d < date(d.year, 8, 31)):
+            continue
+        if len(paths) < len(BANDS):
+            print(f"   ⚠️ {pid}: bandas incompletas → salto")
+            continue
+        mtl = next(iter(paths.values())).with_name(f"{pid}_MTL.txt")
+        cc = _cloud_cover(mtl) if mtl.exists() else np.nan
+        if not (cc < max_cloud):
+            continue
+        with rasterio.open(paths["QA_PIXEL"]) as ds:
+            bounds = transform_bounds(ds.crs, DST_CRS, *ds.bounds)
+        scenes.append({"id": pid, "year": d.year, "paths": paths, "bounds": bounds})
+    return scenes
+
+
+def target_grid(aoi=AOI, scale_m=SCALE_M):
+    res = scale_m / 111_319.49   # grados equivalentes al export de GEE a 30 m
+    width = int(np.ceil((aoi[2] - aoi[0]) / res))
+    height = int(np.ceil((aoi[3] - aoi[1]) / res))
+    return {"crs": DST_CRS, "transform": from_origin(aoi[0], aoi[3], res, res),
+            "width": width, "height": height}
+
+# ================== WORKER ===================================================
+_SCENES, _GRID = None, None
+
+def _init_worker(scenes, grid):
+    global _SCENES, _GRID
+    _SCENES, _GRID = scenes, grid
+
+
+def _read_scene_block(scene, win: Window, grid):
+    """Lee y escala las 6 bandas de una escena en la ventana destino; NaN = enmascarado."""
+    out = {}
+    for band in BANDS:
+        with rasterio.open(scene["paths"][band]) as src, \
+             WarpedVRT(src, crs=grid["crs"], transform=grid["transform"],
+                       width=grid["width"], height=grid["height"],
+                       resampling=Resampling.nearest, src_nodata=0, nodata=0) as vrt:
+            out[band] = vrt.read(1, window=win)
+    qa = out.pop("QA_PIXEL").astype(np.uint16)
+    mask = np.ones(qa.shape, dtype=bool)
+    for bit in QA_BITS:
+        mask &= (qa & (1 << bit)) == 0
+
+    res = {}
+    for band, dn in out.items():
+        valid = mask & (dn != 0)
+        if band.startswith("SR_"):
+            v = dn.astype(np.float32) * np.float32(0.0000275) - np.float32(0.2)
+        else:
+            v = dn.astype(np.float32) * np.float32(0.00341802) + np.float32(149.0)
+        res[band] = np.where(valid, v, np.nan).astype(np.float32)
+    return res
+
+
+def _indices(c):
+    """NDVI, NDBI, albedo a partir de un compuesto (dict banda → array)."""
+    with np.errstate(all="ignore"):
+        ndvi = (c["SR_B5"] - c["SR_B4"]) / (c["SR_B5"] + c["SR_B4"])
+        ndbi = (c["SR_B6"] - c["SR_B5"]) / (c["SR_B6"] + c["SR_B5"])
+        albedo = (c["SR_B2"] + c["SR_B3"] + c["SR_B4"]) / 3.0
+    return ndvi, ndbi, albedo
+
+
+def _lst(tb, ndvi_clim):
+    """LST (°C) con emisividad derivada del NDVI climatológico (S0169204624002548)."""
+    with np.errstate(all="ignore"):
+        fv = ((ndvi_clim + 1.0) / 2.0) ** 2
+        em = fv * 0.004 + 0.986
+        return tb / (1.0 + (11.5 * (tb / 14380.0)) * np.log(em)) - 273.15
+
+
+def _process_block(job):
+    """Compuestos de un bloque: devuelve la ventana y los productos."""
+    row, col, h, w = job
+    win = Window(col, row, w, h)
+    x0, y0 = _GRID["transform"] * (col, row)
+    x1, y1 = _GRID["transform"] * (col + w, row + h)
+    bx = (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+
+    yearly = {}
+    for y in YEARS:
+        stacks = {b: [] for b in BANDS if b != "QA_PIXEL"}
+        for sc in _SCENES:
+            if sc["year"] != y:
+                continue
+            sb = sc["bounds"]
+            if sb[0] > bx[2] or sb[2] < bx[0] or sb[1] > bx[3] or sb[3] < bx[1]:
+                continue
+            for b, arr in _read_scene_block(sc, win, _GRID).items():
+                stacks[b].append(arr)
+        if not stacks["SR_B2"]:
+            continue
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)   # All-NaN slice
+            yearly[y] = {b: np.nanmedian(np.stack(v), axis=0) for b, v in stacks.items()}
+
+    products = {}
+    if not yearly:
+        return job, products
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        clim = {b: np.nanmean(np.stack([yearly[y][b] for y in yearly]), axis=0)
+                for b in yearly[next(iter(yearly))]}
+
+    ndvi, ndbi, albedo = _indices(clim)
+    lst = _lst(clim["ST_B10"], ndvi)
+    ta = COEF_A * lst + COEF_B
+    products.update({"NDVI_clim": ndvi, "NDBI_clim": ndbi, "Albedo_clim": albedo,
+                     "LST_day_clim": lst, "Ta_clim": ta})
+
+    for y, comp in yearly.items():
+        nd_y, nb_y, al_y = _indices(comp)
+        lst_y = _lst(comp["ST_B10"], ndvi)       # emisividad climatológica (igual que el JS)
+        ta_y = COEF_A * lst_y + COEF_B
+        products.update({f"NDVI_{y}": nd_y, f"NDBI_{y}": nb_y, f"Albedo_{y}": al_y,
+                         f"LST_day_{y}": lst_y, f"Ta_clim_{y}": ta_y})
+
+    products = {k: v.astype(np.float32) for k, v in products.items()}
+    return job, products
+
+# ================== ESCRITURA ================================================
+def _open_outputs(names, grid, out_dir: Path):
+    profile = {"driver": "GTiff", "dtype": "float32", "count": 1, "nodata": np.nan,
+               "crs": grid["crs"], "transform": grid["transform"],
+               "width": grid["width"], "height": grid["height"],
+               "tiled": True, "blockxsize": BLOCK, "blockysize": BLOCK,
+               "compress": "DEFLATE", "predictor": 3}
+    return {n: rasterio.open(out_dir / f"{n}.tif", "w", **profile) for n in names}
+
+
+def _blocks(grid):
+    for row in range(0, grid["height"], BLOCK):
+        for col in range(0, grid["width"], BLOCK):
+            yield (row, col, min(BLOCK, grid["height"] - row), min(BLOCK, grid["width"] - col))
+
+# ================== MAIN =====================================================
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--aoi", nargs=4, type=float, default=AOI,
+                    metavar=("LON_MIN", "LAT_MIN", "LON_MAX", "LAT_MAX"))
+    ap.add_argument("--workers", type=int, default=WORKERS)
+    args = ap.parse_args()
+
+    print("→ Inventario de escenas…", flush=True)
+    scenes = find_scenes(SCENES_DIR)
+    if not scenes:
+        raise FileNotFoundError(f"Sin escenas de verano válidas en {SCENES_DIR}")
+    years_ok = sorted({s["year"] for s in scenes})
+    print(f"   · {len(scenes)} escenas ({years_ok[0]}–{years_ok[-1]}, CLOUD_COVER<{MAX_CLOUD})")
+
+    grid = target_grid(tuple(args.aoi))
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
+    names = CLIM_PRODUCTS + [p.format(y=y) for y in years_ok for p in YEAR_PRODUCTS]
+    outs = _open_outputs(names, grid, OUT_DIR)
+    jobs = list(_blocks(grid))
+    print(f"→ {len(jobs)} bloques de {BLOCK}px en {args.workers} procesos "
+          f"(grilla {grid['width']}×{grid['height']})…", flush=True)
+
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                                 initargs=(scenes, grid)) as ex:
+            pending, it, done = set(), iter(jobs), 0
+            while True:
+                # como mucho 2 bloques en vuelo por worker → memoria acotada en el proceso principal
+                while len(pending) < 2 * args.workers:
+                    nxt = next(it, None)
+                    if nxt is None:
+                        break
+                    pending.add(ex.submit(_process_block, nxt))
+                if not pending:
+                    break
+                fut = next(as_completed(pending))
+                pending.discard(fut)
+                (row, col, h, w), products = fut.result()
+                win = Window(col, row, w, h)
+                for name, arr in products.items():
+                    outs[name].write(arr, 1, window=win)
+                done += 1
+                print(f"     [{done:>5}/{len(jobs)}]", end="\r", flush=True)
+    finally:
+        for ds in outs.values():
+            ds.close()
+    print("")
+
+    print(f"Listo ✅  Productos en {OUT_DIR}")
+    print(f"→ Siguiente paso: python 05_normalize_uhi_utfvi.py --dir \"{OUT_DIR}\"")
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Normalización UHI_air / UTFVI_air en dos pasadas por bloques (streaming)
+=======================================================================
+
+`UHI_air = (Ta − μ)/σ` y `UTFVI_air = (Ta − μ)/Ta` necesitan la media y la
+desviación estándar **de toda el AOI**. En GEE eso lo resuelve
+`reduceRegion`; localmente implicaba cargar la banda completa. Aquí:
+
+1. **Pasada 1 (estadísticos)**: cada franja de filas produce un acumulador
+   *combinable* `(n, μ, M2, min, max, histograma)`; los acumuladores se
+   combinan con la fórmula de Chan et al. (media/varianza en paralelo,
+   numéricamente estable) y sumando histogramas. Las franjas se reparten en
+   un pool de procesos.
+2. Percentiles (p05, p50, p95) desde el histograma de rango fijo
+   `HIST_RANGE` con `HIST_BINS` bins (resolución 0.01 °C), interpolando
+   dentro del bin.
+3. **Pasada 2 (escritura)**: bloque por bloque se escriben `UHI_air_*` y
+   `UTFVI_air_*`.
+
+La memoria queda acotada por el tamaño de franja/bloque, no por el AOI.
+
+Entradas
+--------
+- `<DIR>/Ta_clim.tif` y `<DIR>/Ta_clim_YYYY.tif` (exports de GEE o de
+  `04_landsat_summer_composite.py`).
+
+Salidas
+-------
+- `<DIR>/UHI_air_clim.tif`, `<DIR>/UTFVI_air_clim.tif`, `…_YYYY.tif`
+- `<DIR>/ta_stats_streaming.csv` (n, media, std, min, max, percentiles)
+
+Run:
+  python 05_normalize_uhi_utfvi.py --dir /ruta/a/Heat/local_engine
+
+Requisitos: numpy, pandas, rasterio.
+"""
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.windows import Window
+
+# ================== RUTAS ====================================================
+DIR_RASTERS = Path("/Users/danielaresendiz/Library/CloudStorage/OneDrive-UniversityCollegeLondon(2)/Dissertation/01_data/Heat")
+
+# ================== PARÁMETROS ===============================================
+STRIPE_ROWS = 512                 # filas por tarea de la pasada 1
+HIST_RANGE  = (-10.0, 60.0)       # °C (valores fuera se acumulan en los bins extremos)
+HIST_BINS   = 7000                # 0.01 °C por bin
+PERCENTILES = (5, 50, 95)
+WORKERS     = max(1, (os.cpu_count() or 2) - 1)
+
+# ================== ACUMULADORES COMBINABLES =================================
+def acc_empty():
+    return (0, 0.0, 0.0, np.inf, -np.inf, np.zeros(HIST_BINS, dtype=np.int64))
+
+
+def acc_from_array(a: np.ndarray):
+    """Acumulador de un bloque (ignora NaN/nodata ya convertidos a NaN)."""
+    v = a[np.isfinite(a)].astype(np.float64)
+    if v.size == 0:
+        return acc_empty()
+    mean = v.mean()
+    m2 = np.square(v - mean).sum()
+    idx = np.floor((v - HIST_RANGE[0]) / (HIST_RANGE[1] - HIST_RANGE[0]) * HIST_BINS).astype(np.int64)
+    hist = np.bincount(np.clip(idx, 0, HIST_BINS - 1), minlength=HIST_BINS)
+    return (v.size, mean, m2, v.min(), v.max(), hist)
+
+
+def acc_merge(a, b):
+    """Combina dos acumuladores (Chan et al., 1979)."""
+    na, ma, m2a, mina, maxa, ha = a
+    nb, mb, m2b, minb, maxb, hb = b
+    n = na + nb
+    if n == 0:
+        return acc_empty()
+    delta = mb - ma
+    mean = ma + delta * nb / n
+    m2 = m2a + m2b + delta * delta * na * nb / n
+    return (n, mean, m2, min(mina, minb), max(maxa, maxb), ha + hb)
+
+
+def acc_percentile(acc, q: float) -> float:
+    n, _, _, vmin, vmax, hist = acc
+    if n == 0:
+        return np.nan
+    width = (HIST_RANGE[1] - HIST_RANGE[0]) / HIST_BINS
+    target = q / 100.0 * n
+    cum = np.cumsum(hist)
+    k = int(np.searchsorted(cum, target, side="left"))
+    k = min(k, HIST_BINS - 1)
+    prev = cum[k - 1] if k > 0 else 0
+    frac = (target - prev) / hist[k] if hist[k] else 0.0
+    val = HIST_RANGE[0] + (k + frac) * width
+    return float(np.clip(val, vmin, vmax))
+
+
+def acc_summary(acc) -> dict:
+    n, mean, m2, vmin, vmax, _ = acc
+    out = {"n": int(n), "mean": mean, "std": np.sqrt(m2 / n) if n else np.nan,
+           "min": vmin, "max": vmax}
+    for q in PERCENTILES:
+        out[f"p{q:02d}"] = acc_percentile(acc, q)
+    return out
+
+# ================== PASADAS ==================================================
+def _stripe_acc(job):
+    path, row0, nrows = job
+    with rasterio.open(path) as ds:
+        a = ds.read(1, window=Window(0, row0, ds.width, nrows), masked=True)
+    return acc_from_array(a.astype(np.float64).filled(np.nan))
+
+
+def streaming_stats(path: Path, workers: int = WORKERS):
+    """Pasada 1: acumulador global combinando franjas en paralelo."""
+    with rasterio.open(path) as ds:
+        height = ds.height
+    jobs = [(str(path), r, min(STRIPE_ROWS, height - r)) for r in range(0, height, STRIPE_ROWS)]
+    acc = acc_empty()
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        for part in ex.map(_stripe_acc, jobs):
+            acc = acc_merge(acc, part)
+    return acc
+
+
+def write_normalized(ta_path: Path, uhi_path: Path, utfvi_path: Path, mean: float, std: float):
+    """Pasada 2: UHI = (Ta − μ)/σ y UTFVI = (Ta − μ)/Ta, bloque por bloque."""
+    with rasterio.open(ta_path) as src:
+        prof = src.profile.copy()
+        prof.update(dtype="float32", nodata=np.nan)
+        with rasterio.open(uhi_path, "w", **prof) as d_uhi, \
+             rasterio.open(utfvi_path, "w", **prof) as d_utf:
+            for _, win in src.block_windows(1):
+                ta = src.read(1, window=win, masked=True).astype(np.float64).filled(np.nan)
+                with np.errstate(all="ignore"):
+                    d_uhi.write(((ta - mean) / std).astype(np.float32), 1, window=win)
+                    d_utf.write(((ta - mean) / ta).astype(np.float32), 1, window=win)
+
+
+def ta_inputs(dir_rasters: Path):
+    """Pares (sufijo, ruta) para Ta_clim y Ta_clim_YYYY."""
+    out = []
+    clim = dir_rasters / "Ta_clim.tif"
+    if clim.exists():
+        out.append(("clim", clim))
+    for p in sorted(dir_rasters.glob("Ta_clim_[0-9][0-9][0-9][0-9].tif")):
+        out.append((p.stem.rsplit("_", 1)[-1], p))
+    return out
+
+# ================== MAIN =====================================================
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dir", type=Path, default=DIR_RASTERS, help="Carpeta con Ta_clim*.tif")
+    ap.add_argument("--workers", type=int, default=WORKERS)
+    args = ap.parse_args()
+
+    inputs = ta_inputs(args.dir)
+    if not inputs:
+        raise FileNotFoundError(f"Sin Ta_clim*.tif en {args.dir}")
+
+    rows = []
+    for suffix, ta_path in inputs:
+        print(f"→ {ta_path.name}: pasada 1 (estadísticos)…", flush=True)
+        acc = streaming_stats(ta_path, args.workers)
+        s = acc_summary(acc)
+        if s["n"] == 0 or not np.isfinite(s["std"]) or s["std"] == 0:
+            print("   ⚠️ sin píxeles válidos o σ=0 → salto")
+            continue
+        print(f"   · μ={s['mean']:.3f} σ={s['std']:.3f} p05={s['p05']:.2f} "
+              f"p50={s['p50']:.2f} p95={s['p95']:.2f} (n={s['n']})")
+        print(f"   pasada 2 → UHI_air_{suffix}.tif / UTFVI_air_{suffix}.tif", flush=True)
+        write_normalized(ta_path, args.dir / f"UHI_air_{suffix}.tif",
+                         args.dir / f"UTFVI_air_{suffix}.tif", s["mean"], s["std"])
+        rows.append({"raster": ta_path.name, **s})
+
+    out_csv = args.dir / "ta_stats_streaming.csv"
+    pd.DataFrame(rows).to_csv(out_csv, index=False)
+    print(f"Listo ✅  Estadísticos en {out_csv}")
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Calibración LST→Ta geográficamente variable (regresión local por kernel)
+=======================================================================
+
+El script de GEE usa una sola recta `Ta = coef_a·LST + coef_b` para toda la
+cuenca, aunque las 16 estaciones RedMet van de ~2,200 a ~3,000 m s.n.m.
+Aquí se ajusta una **regresión local ponderada por kernel gaussiano** (tipo
+GWR) sobre las estaciones:
+
+    Ta_i = β0(u) + β1(u)·LST_i + β2(u)·z_i        (z = elevación, m)
+
+- Los coeficientes se resuelven en una **grilla de nodos gruesa**
+  (`NODE_STEP_PX` píxeles) con la matriz de pesos kernel **precalculada**
+  `W[nodo, estación]` (cacheada en disco; solo depende de la posición de las
+  estaciones, de la grilla y del ancho de banda).
+- Con 16 estaciones el ajuste local puede quedar mal condicionado: se aplica
+  un término ridge `RIDGE_LAMBDA` (predictores estandarizados) que encoge
+  cada ajuste local hacia el ajuste global (OLS); lejos de las estaciones
+  el resultado converge a la recta global.
+- El ráster de Ta se evalúa **por bloques vectorizados**: interpolación
+  bilineal de β en el bloque + elevación del DEM remuestreada al vuelo.
+
+Cambiar años o estaciones solo re-resuelve sistemas 3×3 por nodo (los pesos
+se reutilizan si las estaciones no cambian), así que recalibrar es rápido.
+
+Entradas
+--------
+- `estaciones_operacion_CDMX.csv` (cve_estac, longitud, latitud, alt)
+- `procesados/verano_14-24_long.parquet` (de `01_process_redmet_stations.py`)
+- `LST_day_clim.tif` (o `LST_day_YYYY.tif` con `--lst`) y un DEM (SRTM).
+
+Salidas
+-------
+- `<DIR_RASTERS>/Ta_clim_local.tif` (o `--out`)
+- `<DIR_RASTERS>/Ta_local_calibracion.csv` (LOO-CV global vs local por estación)
+
+Run:
+  python 06_calibrate_lst_ta_local.py
+  python 06_calibrate_lst_ta_local.py --years 2019 --lst /ruta/LST_day_2019.tif --out Ta_local_2019.tif
+
+Requisitos: numpy, pandas, rasterio.
+"""
+
+from pathlib import Path
+import argparse
+import hashlib
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform as warp_transform
+
+# ================== RUTAS ====================================================
+BASE_REDMET = Path("/Users/danielaresendiz/Library/CloudStorage/OneDrive-UniversityCollegeLondon(2)/Dissertation/Data/RedMet")
+CSV_EST     = BASE_REDMET / "estaciones_operacion_CDMX.csv"
+PARQUET_TA  = BASE_REDMET / "procesados" / "verano_14-24_long.parquet"
+
+DIR_RASTERS = Path("/Users/danielaresendiz/Library/CloudStorage/OneDrive-UniversityCollegeLondon(2)/Dissertation/01_data/Heat")
+LST_TIF     = DIR_RASTERS / "LST_day_clim.tif"
+DEM_TIF     = DIR_RASTERS / "DEM_SRTM_30m.tif"
+CACHE_DIR   = DIR_RASTERS / "_cache_calibracion"
+
+# ================== PARÁMETROS ===============================================
+CRS_METERS   = 32614
+DAY_HOURS    = range(10, 17)     # mismas horas que Ta_mean_day en 01_process_redmet_stations.py
+BANDWIDTH_M  = 15_000.0          # σ del kernel gaussiano
+RIDGE_LAMBDA = 1.0               # encogimiento hacia el ajuste global
+NODE_STEP_PX = 32                # ~1 km entre nodos a 30 m
+BLOCK        = 512
+
+# ================== DATOS DE ESTACIÓN ========================================
+def load_stations(years=None) -> pd.DataFrame:
+    """Ta media diurna de verano por estación (filtrada por años si se indica)."""
+    est = pd.read_csv(CSV_EST)
+    ta = pd.read_parquet(PARQUET_TA)
+    ta = ta[ta["datetime"].dt.hour.isin(DAY_HOURS)]
+    if years:
+        ta = ta[ta["year"].isin(years)]
+    ta_day = ta.groupby("estacion_id")["Ta"].mean().rename("Ta_obs")
+    st = est.merge(ta_day, left_on="cve_estac", right_index=True, how="inner")
+    st = st.dropna(subset=["longitud", "latitud", "alt", "Ta_obs"]).reset_index(drop=True)
+    return st
+
+
+def sample_raster(path: Path, lon, lat) -> np.ndarray:
+    with rasterio.open(path) as ds:
+        xs, ys = warp_transform("EPSG:4326", ds.crs, list(lon), list(lat))
+        vals = np.array([v[0] for v in ds.sample(zip(xs, ys))], dtype=float)
+        if ds.nodata is not None and not np.isnan(ds.nodata):
+            vals[vals == ds.nodata] = np.nan
+    return vals
+
+
+def to_meters(lon, lat, src_crs="EPSG:4326"):
+    x, y = warp_transform(src_crs, f"EPSG:{CRS_METERS}", list(lon), list(lat))
+    return np.asarray(x), np.asarray(y)
+
+# ================== AJUSTE ===================================================
+def design(lst, elev, scaler=None):
+    """[1, LST, z] estandarizados con la media/σ de las estaciones (ridge comparable)."""
+    A = np.stack([lst] + ([elev] if elev is not None else []), axis=-1)
+    if scaler is None:
+        scaler = (A.mean(axis=0), A.std(axis=0))
+    mu, sd = scaler
+    X = np.concatenate([np.ones(A.shape[:-1] + (1,)), (A - mu) / sd], axis=-1)
+    return X, scaler
+
+
+def fit_global(X, y):
+    beta, *_ = np.linalg.lstsq(X, y, rcond=None)
+    return beta
+
+
+def kernel_weights(node_xy, st_xy, bandwidth=BANDWIDTH_M):
+    """W[nodo, estación] gaussiano (precalculable y cacheable)."""
+    d2 = ((node_xy[:, None, :] - st_xy[None, :, :]) ** 2).sum(-1)
+    return np.exp(-0.5 * d2 / bandwidth ** 2)
+
+
+def fit_local(W, X, y, beta_global, lam=RIDGE_LAMBDA):
+    """β por nodo: (XᵀWX + λI)β = XᵀWy + λβ_global, resuelto en lote."""
+    k = X.shape[1]
+    XtWX = np.einsum("ns,si,sj->nij", W, X, X)
+    XtWy = np.einsum("ns,si,s->ni", W, X, y)
+    A = XtWX + lam * np.eye(k)[None]
+    b = XtWy + lam * beta_global[None]
+    return np.linalg.solve(A, b[..., None])[..., 0]
+
+
+def loo_cv(st_xy, X, y, bandwidth=BANDWIDTH_M):
+    """Leave-one-out: error de predicción del ajuste global vs local (mismo `bandwidth`) en cada estación."""
+    rows = []
+    for i in range(len(y)):
+        keep = np.arange(len(y)) != i
+        bg = fit_global(X[keep], y[keep])
+        W = kernel_weights(st_xy[i:i + 1], st_xy[keep], bandwidth)
+        bl = fit_local(W, X[keep], y[keep], bg)[0]
+        rows.append({"err_global": X[i] @ bg - y[i], "err_local": X[i] @ bl - y[i]})
+    return pd.DataFrame(rows)
+
+
+def node_grid(ds):
+    """Centros de nodo (fila/col fraccionaria) y sus coordenadas en metros."""
+    rows = np.arange(0, ds.height + NODE_STEP_PX, NODE_STEP_PX, dtype=float)
+    cols = np.arange(0, ds.width + NODE_STEP_PX, NODE_STEP_PX, dtype=float)
+    rr, cc = np.meshgrid(rows, cols, indexing="ij")
+    xs, ys = ds.transform * (cc.ravel() + 0.5, rr.ravel() + 0.5)
+    mx, my = to_meters(xs, ys, ds.crs)
+    return rows, cols, np.column_stack([mx, my])
+
+
+def cached_weights(node_xy, st_xy, bandwidth=BANDWIDTH_M):
+    key = hashlib.sha1(np.round(node_xy, 1).tobytes() + np.round(st_xy, 1).tobytes()
+                       + str(bandwidth).encode()).hexdigest()[:16]
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = CACHE_DIR / f"W_{key}.npy"
+    if path.exists():
+        return np.load(path), True
+    W = kernel_weights(node_xy, st_xy, bandwidth)
+    np.save(path, W)
+    return W, False
+
+# ================== EVALUACIÓN POR BLOQUES ===================================
+def _bilinear(grid, rows, cols, r, c):
+    """Interpola grid[nr, nc] (nodos en rows/cols) en las posiciones r, c."""
+    step = NODE_STEP_PX
+    i = np.clip((r // step).astype(int), 0, len(rows) - 2)
+    j = np.clip((c // step).astype(int), 0, len(cols) - 2)
+    fr = (r - rows[i]) / step
+    fc = (c - cols[j]) / step
+    g00, g01 = grid[i, j], grid[i, j + 1]
+    g10, g11 = grid[i + 1, j], grid[i + 1, j + 1]
+    return (g00 * (1 - fr) * (1 - fc) + g01 * (1 - fr) * fc
+            + g10 * fr * (1 - fc) + g11 * fr * fc)
+
+
+def write_calibrated(lst_path: Path, out_path: Path, beta_nodes, rows, cols, scaler, use_dem: bool):
+    with rasterio.open(lst_path) as src:
+        prof = src.profile.copy()
+        prof.update(dtype="float32", nodata=np.nan, tiled=True,
+                    blockxsize=BLOCK, blockysize=BLOCK, compress="DEFLATE")
+        betas = beta_nodes.reshape(len(rows), len(cols), -1)
+        dem_ctx = rasterio.open(DEM_TIF) if use_dem else None
+        try:
+            dem = (WarpedVRT(dem_ctx, crs=src.crs, transform=src.transform, width=src.width,
+                             height=src.height, resampling=Resampling.bilinear)
+                   if use_dem else None)
+            with rasterio.open(out_path, "w", **prof) as dst:
+                for _, win in dst.block_windows(1):
+                    lst = src.read(1, window=win, masked=True).astype(np.float64).filled(np.nan)
+                    rr, cc = np.mgrid[win.row_off:win.row_off + win.height,
+                                      win.col_off:win.col_off + win.width].astype(float)
+                    b = [_bilinear(betas[..., k], rows, cols, rr, cc) for k in range(betas.shape[-1])]
+                    mu, sd = scaler
+                    ta = b[0] + b[1] * (lst - mu[0]) / sd[0]
+                    if use_dem:
+                        z = dem.read(1, window=win, masked=True).astype(np.float64).filled(np.nan)
+                        ta = ta + b[2] * (z - mu[1]) / sd[1]
+                    dst.write(ta.astype(np.float32), 1, window=win)
+        finally:
+            if dem_ctx is not None:
+                dem_ctx.close()
+
+# ================== MAIN =====================================================
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--years", nargs="*", type=int, default=None, help="Años de Ta observada (default: todos)")
+    ap.add_argument("--lst", type=Path, default=LST_TIF)
+    ap.add_argument("--out", type=Path, default=DIR_RASTERS / "Ta_clim_local.tif")
+    ap.add_argument("--bandwidth", type=float, default=BANDWIDTH_M)
+    args = ap.parse_args()
+
+    st = load_stations(args.years)
+    st["LST"] = sample_raster(args.lst, st["longitud"], st["latitud"])
+    st = st.dropna(subset=["LST"]).reset_index(drop=True)
+    use_dem = DEM_TIF.exists()
+    print(f"→ {len(st)} estaciones con Ta y LST | elevación {'sí' if use_dem else 'no (sin DEM)'}")
+
+    X, scaler = design(st["LST"].to_numpy(float), st["alt"].to_numpy(float) if use_dem else None)
+    y = st["Ta_obs"].to_numpy(float)
+    st_xy = np.column_stack(to_meters(st["longitud"], st["latitud"]))
+
+    beta_g = fit_global(X, y)
+    slopes = beta_g[1:] / scaler[1]
+    print(f"   · ajuste global: pendiente LST={slopes[0]:.6f}"
+          + (f", gradiente z={slopes[1] * 1000:.3f} °C/km" if use_dem else ""))
+
+    cv = loo_cv(st_xy, X, y, args.bandwidth)
+    cv.insert(0, "cve_estac", st["cve_estac"].values)
+    rmse = lambda e: float(np.sqrt(np.mean(np.square(e))))
+    print(f"   · LOO-RMSE global={rmse(cv['err_global']):.3f} °C | local={rmse(cv['err_local']):.3f} °C")
+    cv.to_csv(args.out.with_name("Ta_local_calibracion.csv"), index=False)
+
+    with rasterio.open(args.lst) as ds:
+        rows, cols, node_xy = node_grid(ds)
+    W, hit = cached_weights(node_xy, st_xy, args.bandwidth)
+    print(f"   · pesos kernel {W.shape} ({'cache' if hit else 'calculados'})")
+    beta_nodes = fit_local(W, X, y, beta_g)
+
+    print(f"→ Escribiendo {args.out.name} por bloques…", flush=True)
+    write_calibrated(args.lst, args.out, beta_nodes, rows, cols, scaler, use_dem)
+    print("Listo ✅")